@@ -1,7 +1,7 @@
 from typing import Optional
 
 from pydantic import BaseModel, Field, EmailStr
-from sqlalchemy import Column, Integer, String, Boolean, LargeBinary
+from sqlalchemy import Column, Integer, String, Boolean, LargeBinary, DateTime
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -16,6 +16,7 @@ class User(Base):
     email: String
     is_active: Boolean
     is_admin: Boolean
+    deleted_at: DateTime, the user is hidden from then and deleted in the background, see apps.dimatech.deletions
     """
     __tablename__ = 'user'
 
@@ -26,6 +27,7 @@ class User(Base):
     email = Column(String(150), default='', nullable=False)
     is_active = Column(Boolean, default=False, nullable=False)
     is_admin = Column(Boolean, default=False, nullable=False)
+    deleted_at = Column(DateTime(timezone=True))
 
 
 class UserValidator(BaseModel):
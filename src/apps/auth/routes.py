@@ -3,8 +3,21 @@ import apps.auth.views as views
 
 blueprint = Blueprint('auth_app', url_prefix='/auth', version=1)
 
-blueprint.add_route(views.UserAPI.as_view(), '/users')
-blueprint.add_route(views.UserDetailAPI.as_view(), '/users/<pk:int>')
+blueprint.add_route(views.UserAPI.as_view(), '/users', ctx_admission='admin', ctx_admission_write='default')
+blueprint.add_route(views.UserImportAPI.as_view(), '/users/import', ctx_admission='admin')
+blueprint.add_route(views.UserDetailAPI.as_view(), '/users/<pk:int>', ctx_admission_write='admin')
 blueprint.add_route(views.activate_account, '/activate/<token:str>')
 blueprint.add_route(views.login, '/login/', methods=['POST'])
 blueprint.add_route(views.get_refresh_token, '/refresh/', methods=['POST'])
+
+
+@blueprint.listener('before_server_start')
+async def setup_import_pool(app, loop):
+    # the processes hashing the passwords of the imports are started by the first import, see views.import_pool
+    app.ctx.import_pool = None
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_import_pool(app, loop):
+    if app.ctx.import_pool is not None:
+        app.ctx.import_pool.shutdown(wait=False, cancel_futures=True)
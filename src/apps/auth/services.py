@@ -0,0 +1,178 @@
+import asyncio
+import csv
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import pbkdf2_hmac
+from os import urandom
+
+import asyncpg
+from pydantic import ValidationError
+
+from apps.auth.models import UserValidator
+from core.helpers.sharding import jump_hash
+
+PASSWORD_ITERATIONS = 100000
+# columns of the imported users, copied to a temporary table then inserted into user
+IMPORT_COLUMNS = ('username', 'password_hash', 'salt', 'email', 'is_active', 'is_admin')
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+
+def hash_password(password: str, salt: bytes) -> bytes:
+    return pbkdf2_hmac(hash_name='sha256', password=password.encode('utf-8'), salt=salt,
+                       iterations=PASSWORD_ITERATIONS)
+
+
+def hash_passwords(passwords: list) -> list:
+    """Returns the salt and the hash of every password, runs in the processes of the import"""
+    hashes = []
+    for password in passwords:
+        salt = urandom(32)
+        hashes.append((salt, hash_password(password, salt)))
+    return hashes
+
+
+def import_error(row: int, username, status: int, message: str) -> dict:
+    return {'row': row, 'username': username, 'status': status, 'msg': message}
+
+
+def parse_users(data: bytes, content_format: str) -> tuple:
+    """Parses and validates the users of a CSV file with a header or of a NDJSON file
+
+    Rows are numbered from 1, the header of a CSV file excluded. Empty CSV values are left unset.
+    A username repeated in the file is an error of the rows after the first one.
+
+    Returns:
+        The row numbers and the validated users, the errors of the invalid rows
+
+    Raises:
+        ValueError: if the file is not UTF-8 or not CSV
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError('The file is not UTF-8')
+    if content_format == 'csv':
+        try:
+            records = [(row, {key: value for key, value in record.items() if key and value not in ('', None)})
+                       for row, record in enumerate(csv.DictReader(io.StringIO(text)), start=1)]
+        except csv.Error as error:
+            raise ValueError(f'The file is not CSV: {error}')
+    else:
+        records = []
+        for row, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                records.append((row, json.loads(line)))
+            except ValueError:
+                records.append((row, None))
+
+    users, errors, usernames = [], [], set()
+    for row, record in records:
+        if not isinstance(record, dict):
+            errors.append(import_error(row, None, 400, 'Row is not a JSON object'))
+            continue
+        try:
+            # the ids are drawn by the database, an id of the file is not imported
+            user = UserValidator(**{key: value for key, value in record.items() if key != 'id'})
+        except ValidationError as error:
+            details = '; '.join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+            errors.append(import_error(row, record.get('username'), 400, details))
+            continue
+        user.username = user.username.lower()
+        if user.username in usernames:
+            errors.append(import_error(row, user.username, 409, 'Username is repeated in the file'))
+            continue
+        usernames.add(user.username)
+        users.append((row, user))
+    return users, errors
+
+
+async def import_users(url: str, shard_urls: list, users: list, bills: bool = False, pool=None,
+                       chunk_size: int = 100) -> dict:
+    """Creates the users in bulk, with a customer bill each if bills is set
+
+    The passwords are hashed by chunks of chunk_size across a pool of processes, the users are copied
+    to a temporary table and inserted at once, skipping the usernames taken meanwhile. The bills are copied
+    to the database of the ledger of every user, in the transaction of the users when it is the global database.
+
+    Args:
+        url: asyncpg url of the global database
+        shard_urls: asyncpg urls of the shards, empty when the ledger is in the global database
+        users: Row numbers and validated users, see parse_users
+        bills: Whether a bill with a zero balance is created for every user
+        pool: Pool of processes hashing the passwords, left running for the next imports,
+            a pool of a process per CPU is created for the import by default
+        chunk_size: Number of passwords hashed by a task of a process
+
+    Returns:
+        The number of created users and bills and the errors of the usernames already taken
+    """
+    report = {'created': 0, 'bills': 0, 'errors': []}
+    connection = await asyncpg.connect(url)
+    try:
+        # the usernames taken are not hashed for nothing
+        taken = await connection.fetch('SELECT username FROM "user" WHERE username = ANY($1::text[])',
+                                       [user.username for row, user in users])
+        taken = {row[0] for row in taken}
+        report['errors'] = [import_error(row, user.username, 409, 'Username already exists')
+                            for row, user in users if user.username in taken]
+        users = [(row, user) for row, user in users if user.username not in taken]
+        if not users:
+            return report
+
+        loop = asyncio.get_running_loop()
+        executor = pool or ProcessPoolExecutor()
+        try:
+            passwords = [user.password for row, user in users]
+            chunks = await asyncio.gather(*(
+                loop.run_in_executor(executor, hash_passwords, passwords[start:start + chunk_size])
+                for start in range(0, len(passwords), chunk_size)))
+        finally:
+            if pool is None:
+                executor.shutdown(wait=False, cancel_futures=True)
+        records = [(user.username, password_hash, salt, user.email or '', bool(user.is_active), bool(user.is_admin))
+                   for (row, user), (salt, password_hash) in zip(users, (item for chunk in chunks for item in chunk))]
+
+        async with connection.transaction():
+            await connection.execute('CREATE TEMPORARY TABLE user_import (username varchar(150), password_hash bytea, '
+                                     'salt bytea, email varchar(150), is_active boolean, is_admin boolean) '
+                                     'ON COMMIT DROP')
+            await connection.copy_records_to_table('user_import', records=records, columns=IMPORT_COLUMNS)
+            columns = ', '.join(IMPORT_COLUMNS)
+            created = dict(await connection.fetch(
+                f'INSERT INTO "user" ({columns}) SELECT {columns} FROM user_import '
+                f'ON CONFLICT (username) DO NOTHING RETURNING username, id'))
+            report['created'] = len(created)
+            report['errors'].extend(import_error(row, user.username, 409, 'Username already exists')
+                                    for row, user in users if user.username not in created)
+            if bills and not shard_urls:
+                report['bills'] = await create_bills(connection, list(created.values()))
+    finally:
+        await connection.close()
+
+    if bills and shard_urls:
+        # foreign keys do not cross databases, the bills of a shard are copied after the users are committed
+        user_ids = [[] for _ in shard_urls]
+        for user_id in created.values():
+            user_ids[jump_hash(user_id, len(shard_urls))].append(user_id)
+        report['bills'] = sum(await asyncio.gather(*(
+            create_shard_bills(shard_url, ids) for shard_url, ids in zip(shard_urls, user_ids) if ids)))
+    report['errors'].sort(key=lambda error: error['row'])
+    return report
+
+
+async def create_bills(connection, user_ids: list) -> int:
+    """Copies a bill with a zero balance for every user, returns the number of bills"""
+    await connection.copy_records_to_table('customer_bill', records=[(user_id, 0) for user_id in user_ids],
+                                           columns=('user_id', 'balance_minor'))
+    return len(user_ids)
+
+
+async def create_shard_bills(url: str, user_ids: list) -> int:
+    connection = await asyncpg.connect(url)
+    try:
+        return await create_bills(connection, user_ids)
+    finally:
+        await connection.close()
@@ -1,4 +1,5 @@
-from hashlib import pbkdf2_hmac
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 from os import urandom
 
 import jwt
@@ -9,20 +10,41 @@ from sanic_ext import validate
 from sanic_jwt_extended import JWT
 from sanic_jwt_extended.decorators import refresh_jwt_required, jwt_required
 from sanic_jwt_extended.tokens import Token
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, func
 
 from apps.auth.models import User, UserValidator, UserDetailValidator
+from apps.auth.services import hash_password, parse_users, import_users
+from apps.dimatech.services import bump_data_version, hide_ledger, schedule_deletion, scheduled_deletion
+import apps.dimatech.views as dimatech_views
+
+# formats of the bulk imports by content type
+IMPORT_CONTENT_TYPES = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson'}
+
+
+def database_url(engine) -> str:
+    # url of the database of the engine for asyncpg connections outside of the pool
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+def import_pool(app: Sanic) -> ProcessPoolExecutor:
+    """
+    Returns the pool of IMPORT_PROCESSES processes hashing the passwords of the imports of the worker,
+    created on the first import. The chunks of concurrent imports wait for a free process of the pool.
+    """
+    if app.ctx.import_pool is None:
+        app.ctx.import_pool = ProcessPoolExecutor(app.config.IMPORT_PROCESSES)
+    return app.ctx.import_pool
 
 
 async def get_password_hash(password: str) -> tuple:
     salt = urandom(32)
 
-    password_hash = pbkdf2_hmac(hash_name='sha256', password=password.encode('utf-8'), salt=salt, iterations=100000)
+    password_hash = hash_password(password, salt)
     return salt, password_hash
 
 
 async def check_password(salt, current_password_hash, new_password: str) -> bool:
-    password_hash = pbkdf2_hmac(hash_name='sha256', password=new_password.encode('utf-8'), salt=salt, iterations=100000)
+    password_hash = hash_password(new_password, salt)
     return current_password_hash == password_hash
 
 
@@ -39,7 +61,7 @@ class UserAPI(HTTPMethodView):
         """
         session = request.ctx.session
         async with session.begin():
-            users = await session.execute(select(User).order_by(User.id))
+            users = await session.execute(select(User).where(User.deleted_at.is_(None)).order_by(User.id))
         users = users.scalars().all()
         users = {'users': [{'username': user.username, 'is_active': user.is_active} for user in users]}
         return json(users)
@@ -62,12 +84,12 @@ class UserAPI(HTTPMethodView):
         Returns: activation_url
         """
         host = request.headers.get('host')
+        body = kwargs['body']
 
         session = request.ctx.session
         async with session.begin():
-            _salt, _password = await get_password_hash(request.json.get('password'))
-            user = User(username=request.json.get('username').lower(), password_hash=_password, salt=_salt,
-                        email=request.json.get('email', ''))
+            _salt, _password = await get_password_hash(body.password)
+            user = User(username=body.username.lower(), password_hash=_password, salt=_salt, email=body.email or '')
             session.add(user)
 
         activation_url = f'http://{host}/v1/auth/activate/' \
@@ -75,6 +97,41 @@ class UserAPI(HTTPMethodView):
         return json(activation_url, status=201)
 
 
+class UserImportAPI(HTTPMethodView):
+    @jwt_required(allow=['Admin'])
+    async def post(self, request: Request, *args, **kwargs) -> response:
+        """
+        Creates users in bulk from a CSV file with a header (Content-Type: text/csv) or a NDJSON file
+        (Content-Type: application/x-ndjson) of users as in UserAPI.post, at most IMPORT_MAX_ROWS rows.
+        Imported users are active or administrators as given. ?bills=true creates a bill for every user.
+        Bigger files are imported with python manage.py import-users
+        Args:
+            request: the file
+            *args: None
+            **kwargs: token
+
+        Returns: HTTP 201 Created, the number of created users and bills and the errors of the rows not created
+        """
+        content_format = IMPORT_CONTENT_TYPES.get(request.content_type.split(';')[0].strip())
+        if content_format is None:
+            return json({'status': 415, 'msg': 'Expected text/csv or application/x-ndjson'}, status=415)
+        try:
+            users, errors = parse_users(request.body, content_format)
+        except ValueError as error:
+            return json({'status': 400, 'msg': str(error)}, status=400)
+
+        config = request.app.config
+        if len(users) + len(errors) > config.IMPORT_MAX_ROWS:
+            return json({'status': 413, 'msg': f'More than {config.IMPORT_MAX_ROWS} rows'}, status=413)
+
+        report = await import_users(database_url(request.app.ctx.engine),
+                                    [database_url(engine) for engine in request.app.ctx.shard_engines], users,
+                                    request.args.get('bills') in ('1', 'true'), import_pool(request.app),
+                                    config.IMPORT_CHUNK_SIZE)
+        report['errors'] = sorted(errors + report['errors'], key=itemgetter('row'))
+        return json(report, status=201 if report['created'] else 400)
+
+
 class UserDetailAPI(HTTPMethodView):
     """
     The class provides basic endpoints for getting detailed information about the User and editing it
@@ -86,8 +143,10 @@ class UserDetailAPI(HTTPMethodView):
         """
         session = request.ctx.session
         async with session.begin():
-            user = await session.execute(select(User).where(User.id == pk))
+            user = await session.execute(select(User).where(User.id == pk, User.deleted_at.is_(None)))
         user = user.scalars().first()
+        if user is None:
+            return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
         user = {'username': user.username, 'email': user.email, 'is_active': user.is_active, 'is_admin': user.is_admin}
         return json(user)
 
@@ -95,50 +154,91 @@ class UserDetailAPI(HTTPMethodView):
     @validate(json=UserValidator)
     async def put(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
-        Implements the PUT method for the REST API
+        Implements the PUT method for the REST API, a deleted user is not found
         """
         session = request.ctx.session
-        user_data = request.json.copy()
+        user_data = kwargs['body'].dict(exclude_unset=True)
+        await dimatech_views.current_user_id(request, kwargs['token'])
 
         salt, password_hash = await get_password_hash(user_data.pop('password'))
         user_data.update({'salt': salt, 'password_hash': password_hash})
 
+        ledger = request.ctx.shards.for_user(pk)
         async with session.begin():
             user = await session.execute(select(User).where(User.id == pk))
-            if user.scalar_one_or_none():
-                await session.execute(update(User).values(**user_data).where(User.id == pk))
-                return json(request.json, status=200)
-            else:
+            user = user.scalar_one_or_none()
+            if user and user.deleted_at is not None:
+                return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
+            if not user:
                 user = User(**user_data)
                 session.add(user)
                 return json(request.json, status=201)
+            await session.execute(update(User).values(**user_data).where(User.id == pk))
+            # his cached lists show his username, the version is in the same transaction without shards
+            if ledger is session:
+                await bump_data_version(session, pk)
+        if ledger is not session:
+            async with ledger.begin():
+                await bump_data_version(ledger, pk)
+        return json(request.json, status=200)
 
     @jwt_required(allow=['Admin'])
     @validate(json=UserDetailValidator)
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
-        Implements the PATCH method for the REST API
+        Implements the PATCH method for the REST API, a deleted user is not found
         """
         session = request.ctx.session
-        user_data = request.json.copy()
+        user_data = kwargs['body'].dict(exclude_unset=True)
+        await dimatech_views.current_user_id(request, kwargs['token'])
 
+        ledger = request.ctx.shards.for_user(pk)
         async with session.begin():
             if user_data.get('password'):
                 salt, password_hash = await get_password_hash(user_data.pop('password'))
                 user_data.update({'salt': salt, 'password_hash': password_hash})
 
-            await session.execute(update(User).values(**user_data).where(User.id == pk))
+            updated = await session.execute(update(User).values(**user_data).
+                                            where(User.id == pk, User.deleted_at.is_(None)))
+            if updated.rowcount and ledger is session:
+                await bump_data_version(session, pk)
+        if not updated.rowcount:
+            return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
+        if ledger is not session:
+            async with ledger.begin():
+                await bump_data_version(ledger, pk)
         return json(request.json, status=200)
 
     @jwt_required(allow=['Admin'])
     async def delete(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
-        Implements the DELETE method for the REST API
+        Implements the DELETE method for the REST API.
+        The user and his bills are hidden at once, his ledger is deleted by batches in the background,
+        the progress is given by GET /v1/api/deletions/<id>. Deleting him again gives the same deletion.
+
+        Returns: HTTP 202 Accepted and the id of the deletion
         """
         session = request.ctx.session
         async with session.begin():
-            await session.execute(delete(User).where(User.id == pk))
-        return empty(status=200)
+            user = await session.execute(select(User.deleted_at).where(User.id == pk))
+            user = user.one_or_none()
+            # a user marked deleted before is not scheduled again
+            deletion = await scheduled_deletion(session, 'user', pk) if user and user.deleted_at else None
+
+        if user is not None and user.deleted_at is None:
+            # the bills are hidden before the deletion is scheduled, it may be run as soon as it is committed
+            ledger = request.ctx.shards.for_user(pk)
+            async with ledger.begin():
+                await hide_ledger(ledger, pk)
+            async with session.begin():
+                marked = await session.execute(update(User).values(deleted_at=func.now()).
+                                               where(User.id == pk, User.deleted_at.is_(None)))
+                # unless a concurrent request marked him first and scheduled the deletion
+                deletion = await (schedule_deletion(session, 'user', pk, pk) if marked.rowcount else
+                                  scheduled_deletion(session, 'user', pk))
+        if deletion is None:
+            return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
+        return json({'deletion': deletion.id}, status=202, headers={'Location': f'/v1/api/deletions/{deletion.id}'})
 
 
 async def activate_account(request: Request, token: str, *args, **kwargs) -> response:
@@ -175,15 +275,17 @@ async def login(request: Request, *args, **kwargs) -> response:
 
     Returns: Error or JWT access and refresh tokens
     """
-    username = request.json.get('username')
-    password = request.json.get('password')
+    username = kwargs['body'].username
+    password = kwargs['body'].password
 
     session = request.ctx.session
 
     async with session.begin():
-        user = await session.execute(select(User).where(User.username == username))
+        user = await session.execute(select(User).where(User.username == username, User.deleted_at.is_(None)))
     user = user.scalars().first()
 
+    if user is None:
+        return json({'status': 400, 'message': 'Wrong user data'}, status=400)
     if not user.is_active:
         return json({'status': 400, 'message': 'User disabled'}, status=400)
 
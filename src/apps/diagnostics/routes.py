@@ -0,0 +1,23 @@
+from sanic import Blueprint
+
+import apps.diagnostics.views as views
+from core.helpers.profiler import Profiler
+
+blueprint = Blueprint('diagnostics_app', url_prefix='/diagnostics', version=1)
+
+# diagnostics do not use the database and are not queued by the admission control
+blueprint.add_route(views.metrics, '/metrics', methods=['GET'], ctx_admission=False)
+blueprint.add_route(views.profile, '/profile', methods=['GET'], ctx_admission=False)
+blueprint.add_route(views.MemoryAPI.as_view(), '/memory', ctx_admission=False)
+blueprint.add_route(views.MemorySnapshotAPI.as_view(), '/memory/snapshots/<name:slug>', ctx_admission=False)
+
+
+@blueprint.listener('before_server_start')
+async def setup_profiler(app, loop):
+    app.ctx.profiler = Profiler(app.config.DIAGNOSTICS_DIR)
+    app.ctx.profiler.register(loop)
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_profiler(app, loop):
+    app.ctx.profiler.unregister(loop)
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import tracemalloc
+from http import HTTPStatus
+
+from sanic import Request, response
+from sanic.response import json, text, empty
+from sanic.views import HTTPMethodView
+from sanic_jwt_extended.decorators import jwt_required
+
+from core.extentions.exceptions import InvalidParameter
+from core.helpers import jsonapi, profiler
+from core.helpers.memory import tracer
+from core.helpers.metrics import counters
+
+GROUPS = ('lineno', 'filename', 'traceback')
+
+
+def float_argument(request, name, default, minimum, maximum):
+    """Reads a number query parameter in the range [minimum, maximum]"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        value = None
+    if value is None or not minimum <= value <= maximum:
+        raise InvalidParameter(jsonapi.format_error(status=400, title='Invalid parameter',
+                                                    detail=f'{name}: must be a number from {minimum} to {maximum}'))
+    return value
+
+
+def statistics_arguments(request):
+    """Reads the ?group=lineno&limit=20 parameters of the memory statistics"""
+    group = request.args.get('group', 'lineno')
+    if group not in GROUPS:
+        raise InvalidParameter(jsonapi.format_error(status=400, title='Invalid parameter',
+                                                    detail=f"group: must be one of {', '.join(GROUPS)}"))
+    return group, int(float_argument(request, 'limit', 20, 1, 1000))
+
+
+def snapshot_not_found(name):
+    error = jsonapi.format_error(status=HTTPStatus.NOT_FOUND, title='Snapshot not found',
+                                 detail=f"The worker {os.getpid()} has no snapshot '{name}'")
+    return json(jsonapi.return_an_error(error), status=HTTPStatus.NOT_FOUND)
+
+
+@jwt_required(allow=['Admin'])
+async def metrics(request: Request, *args, **kwargs) -> response:
+    """
+    Counters and state of the worker serving the request.
+
+    Args:
+        request: None
+        *args: None
+        **kwargs: token
+
+    Returns: {pid, startup: {warm, first_request}, counters, admission: {inflight, queued, service_time},
+              events: {connected, streams, buffered, dropped}, breakers: {database: {state, failures, opened}}}
+    """
+    admission = request.app.ctx.admission
+    events = request.app.ctx.events
+    return json({
+        'pid': os.getpid(),
+        'startup': {
+            'warm': request.app.ctx.warm,
+            'first_request': request.app.ctx.first_request,
+        },
+        'counters': counters.snapshot(),
+        'admission': {
+            'inflight': admission.inflight,
+            'queued': admission.queued,
+            'service_time': admission.service_time,
+        },
+        'events': {
+            'connected': events.connected,
+            'streams': events.streams,
+            'buffered': len(events.buffer),
+            'dropped': events.dropped,
+        },
+        'breakers': {name: breaker.snapshot() for name, breaker in request.app.ctx.breakers.items()},
+    })
+
+
+@jwt_required(allow=['Admin'])
+async def profile(request: Request, *args, **kwargs) -> response:
+    """
+    Samples the stacks of the worker serving the request, or of all workers, for some seconds.
+    The event loop keeps serving requests while it is sampled.
+
+    Args:
+        request: ?seconds=10&interval=0.005&workers=all
+        *args: None
+        **kwargs: token
+
+    Returns: collapsed stacks 'route;outer;...;inner count', e.g. for flamegraph.pl
+    """
+    seconds = float_argument(request, 'seconds', 10.0, 0.1, request.app.config.PROFILE_MAX_SECONDS)
+    interval = float_argument(request, 'interval', 0.005, 0.001, 1.0)
+    workers = request.args.get('workers', 'one')
+    if workers not in ('one', 'all'):
+        raise InvalidParameter(jsonapi.format_error(status=400, title='Invalid parameter',
+                                                    detail="workers: must be 'one' or 'all'"))
+
+    if request.app.ctx.profiler.busy:
+        error = jsonapi.format_error(status=HTTPStatus.CONFLICT, title='Profiler busy',
+                                     detail='The worker is already being profiled')
+        return json(jsonapi.return_an_error(error), status=HTTPStatus.CONFLICT)
+
+    stacks, pids = await request.app.ctx.profiler.profile(seconds, interval, all_workers=workers == 'all')
+    return text(profiler.collapse(stacks), headers={'X-Profiled-Workers': ','.join(map(str, pids))})
+
+
+class MemoryAPI(HTTPMethodView):
+    """Memory tracing of the worker serving the request"""
+
+    @jwt_required(allow=['Admin'])
+    async def get(self, request: Request, *args, **kwargs) -> response:
+        """
+        Args:
+            request: None
+            *args: None
+            **kwargs: token
+
+        Returns: {pid, tracing, traced, peak, snapshots, routes: {route: peak}}
+        """
+        traced, peak = tracemalloc.get_traced_memory()
+        return json({
+            'pid': os.getpid(),
+            'tracing': tracer.enabled,
+            'traced': traced,
+            'peak': peak,
+            'snapshots': list(tracer.snapshots),
+            'routes': dict(sorted(tracer.peaks.items(), key=lambda item: -item[1])),
+        })
+
+    @jwt_required(allow=['Admin'])
+    async def post(self, request: Request, *args, **kwargs) -> response:
+        """
+        Starts tracing, ?frames=1 is the number of frames stored per allocation.
+        Tracing slows the worker down, stop it when done.
+
+        Args:
+            request: ?frames=1
+            *args: None
+            **kwargs: token
+
+        Returns: None
+        """
+        tracer.start(int(float_argument(request, 'frames', 1, 1, 50)))
+        return empty(status=201)
+
+    @jwt_required(allow=['Admin'])
+    async def delete(self, request: Request, *args, **kwargs) -> response:
+        """
+        Stops tracing and drops the snapshots and route peaks.
+
+        Args:
+            request: None
+            *args: None
+            **kwargs: token
+
+        Returns: None
+        """
+        tracer.stop()
+        return empty()
+
+
+class MemorySnapshotAPI(HTTPMethodView):
+    """Named tracemalloc snapshots of the worker serving the request"""
+
+    @jwt_required(allow=['Admin'])
+    async def get(self, request: Request, name: str, *args, **kwargs) -> response:
+        """
+        Top allocation sites of the snapshot, or the sites that grew most since
+        the snapshot ?baseline was taken.
+
+        Args:
+            request: ?baseline=name&group=lineno&limit=20
+            name: snapshot name
+            *args: None
+            **kwargs: token
+
+        Returns: {pid, snapshot, baseline, sites: [{site, size, count[, size_diff, count_diff]}]}
+        """
+        group, limit = statistics_arguments(request)
+        baseline = request.args.get('baseline')
+        for snapshot in (name, baseline):
+            if snapshot is not None and snapshot not in tracer.snapshots:
+                return snapshot_not_found(snapshot)
+
+        # statistics of a large heap take a while, let the loop serve requests meanwhile
+        loop = asyncio.get_running_loop()
+        if baseline is None:
+            sites = await loop.run_in_executor(None, tracer.top, name, group, limit)
+        else:
+            sites = await loop.run_in_executor(None, tracer.diff, name, baseline, group, limit)
+        return json({'pid': os.getpid(), 'snapshot': name, 'baseline': baseline, 'sites': sites})
+
+    @jwt_required(allow=['Admin'])
+    async def post(self, request: Request, name: str, *args, **kwargs) -> response:
+        """
+        Takes a snapshot under the name, replacing the snapshot of the same name.
+        The snapshot is taken in the default executor so the worker keeps serving, but copying
+        the traces holds the GIL: with a million traced blocks the loop stalls up to about 0.6s.
+
+        Args:
+            request: None
+            name: snapshot name
+            *args: None
+            **kwargs: token
+
+        Returns: {pid, snapshot, traced}
+        """
+        if not tracer.enabled:
+            error = jsonapi.format_error(status=HTTPStatus.CONFLICT, title='Tracing disabled',
+                                         detail='Start memory tracing before taking snapshots')
+            return json(jsonapi.return_an_error(error), status=HTTPStatus.CONFLICT)
+        tracer.take(name, await asyncio.get_running_loop().run_in_executor(None, tracer.capture))
+        return json({'pid': os.getpid(), 'snapshot': name, 'traced': tracemalloc.get_traced_memory()[0]}, status=201)
+
+    @jwt_required(allow=['Admin'])
+    async def delete(self, request: Request, name: str, *args, **kwargs) -> response:
+        """
+        Args:
+            request: None
+            name: snapshot name
+            *args: None
+            **kwargs: token
+
+        Returns: None
+        """
+        if tracer.snapshots.pop(name, None) is None:
+            return snapshot_not_found(name)
+        return empty()
@@ -0,0 +1,123 @@
+import asyncio
+
+import asyncpg
+from sanic.log import logger
+
+from core.helpers.sharding import jump_hash
+
+# the oldest pending deletion whose lease is free, a deletion left by a stopped worker is resumed once its lease ends
+CLAIM_DELETION = """
+UPDATE deletion SET locked_until = now() + make_interval(secs => $1)
+WHERE id = (SELECT id FROM deletion WHERE status = 'pending' AND (locked_until IS NULL OR locked_until < now())
+            ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+RETURNING id, kind, target_id, user_id, total
+"""
+PROGRESS = "UPDATE deletion SET deleted = deleted + $2, locked_until = now() + make_interval(secs => $3) WHERE id = $1"
+FINISH = "UPDATE deletion SET status = $2, finished_at = now(), locked_until = NULL WHERE id = $1"
+# primary keys of the tables of the ledger, the partitioned ones include created_at
+TABLE_KEYS = {'transaction': 'id, created_at', 'purchase': 'id, created_at', 'customer_bill': 'id',
+              'user_data_version': 'user_id'}
+
+
+async def deletion_steps(ledger, kind: str, target_id: int) -> list:
+    """Returns the table, condition and arguments of the rows to delete, the dependent rows first"""
+    if kind == 'bill':
+        return [('transaction', 'bill_id = $1', (target_id,)), ('purchase', 'bill_id = $1', (target_id,)),
+                ('customer_bill', 'id = $1', (target_id,))]
+    # transactions and purchases may be made by another user on the bills of the user
+    bill_ids = [row[0] for row in await ledger.fetch('SELECT id FROM customer_bill WHERE user_id = $1', target_id)]
+    condition = 'user_id = $1 OR bill_id = ANY($2::int[])'
+    return [('transaction', condition, (target_id, bill_ids)), ('purchase', condition, (target_id, bill_ids)),
+            ('customer_bill', 'user_id = $1', (target_id,)), ('user_data_version', 'user_id = $1', (target_id,))]
+
+
+async def run_deletion(connection, ledger_url: str, deletion, batch_size: int, pause: float, lease: float) -> str:
+    """Deletes the rows of the ledger of a marked user or bill by batches, then the user
+
+    Every batch is a transaction of its own holding the locks of batch_size rows at most, the worker sleeps
+    pause seconds between two batches so the payment path keeps the database. The progress is saved and
+    the lease extended after every batch, an interrupted deletion is resumed by the next worker.
+
+    Args:
+        connection: asyncpg connection to the global database
+        ledger_url: asyncpg url of the database of the ledger of the user
+        deletion: row of the claimed deletion
+        batch_size: Number of rows deleted by a batch
+        pause: Seconds between two batches
+        lease: Seconds the deletion is held by the worker after a batch
+
+    Returns:
+        The status of the deletion, cancelled if the bill is no longer marked deleted
+    """
+    kind, target_id = deletion['kind'], deletion['target_id']
+    ledger = await asyncpg.connect(ledger_url)
+    try:
+        if kind == 'bill':
+            bill = await ledger.fetchrow('SELECT deleted_at FROM customer_bill WHERE id = $1', target_id)
+            if bill is not None and bill['deleted_at'] is None:
+                await connection.execute(FINISH, deletion['id'], 'cancelled')
+                return 'cancelled'
+        else:
+            # the bills of the user are marked with him, in case the worker stopped before
+            await ledger.execute('UPDATE customer_bill SET deleted_at = now() WHERE user_id = $1 '
+                                 'AND deleted_at IS NULL', target_id)
+
+        steps = await deletion_steps(ledger, kind, target_id)
+        if deletion['total'] is None:
+            total = 0
+            for table, condition, arguments in steps:
+                total += await ledger.fetchval(f'SELECT count(*) FROM "{table}" WHERE {condition}', *arguments)
+            await connection.execute('UPDATE deletion SET total = $2 WHERE id = $1', deletion['id'], total)
+
+        for table, condition, arguments in steps:
+            key = TABLE_KEYS[table]
+            statement = (f'DELETE FROM "{table}" WHERE ({key}) IN (SELECT {key} FROM "{table}" '
+                         f'WHERE {condition} LIMIT ${len(arguments) + 1})')
+            while True:
+                deleted = int((await ledger.execute(statement, *arguments, batch_size)).split()[-1])
+                if deleted:
+                    await connection.execute(PROGRESS, deletion['id'], deleted, lease)
+                if deleted < batch_size:
+                    break
+                await asyncio.sleep(pause)
+
+        if kind == 'bill':
+            # the cached responses of the owner drop the bill
+            await ledger.execute('INSERT INTO user_data_version (user_id, version) VALUES ($1, 1) ON CONFLICT '
+                                 '(user_id) DO UPDATE SET version = user_data_version.version + 1',
+                                 deletion['user_id'])
+    finally:
+        await ledger.close()
+
+    async with connection.transaction():
+        if kind == 'user':
+            # the ledger in the global database is already deleted, the user is deleted without cascade
+            await connection.execute('DELETE FROM "user" WHERE id = $1', target_id)
+        await connection.execute(FINISH, deletion['id'], 'done')
+    return 'done'
+
+
+async def delete_periodically(url: str, ledger_urls: list, batch_size: int = 1000, pause: float = 0.1,
+                              interval: float = 5.0, lease: float = 60.0) -> None:
+    """Runs the pending deletions one after the other, polls them every interval seconds, runs until cancelled
+
+    Workers of every node run deletions, a deletion is held by a single worker at a time.
+
+    Args:
+        url: asyncpg url of the global database
+        ledger_urls: asyncpg urls of the databases of the ledger, the user of a deletion picks its database
+    """
+    while True:
+        try:
+            connection = await asyncpg.connect(url)
+            try:
+                while (deletion := await connection.fetchrow(CLAIM_DELETION, lease)) is not None:
+                    ledger_url = ledger_urls[jump_hash(deletion['user_id'], len(ledger_urls))]
+                    status = await run_deletion(connection, ledger_url, deletion, batch_size, pause, lease)
+                    logger.info("Deletion %s of the %s %s is %s", deletion['id'], deletion['kind'],
+                                deletion['target_id'], status)
+            finally:
+                await connection.close()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as exception:
+            logger.warning("Could not run the deletions: %r", exception)
+        await asyncio.sleep(interval)
@@ -1,6 +1,13 @@
-from sqlalchemy import Column, Integer, String, Numeric, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Computed, Index, func
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB, UUID
 from sqlalchemy.orm import declarative_base, relationship
 from apps.auth.models import User
+from core.helpers.money import MoneyType
+
+# text search configuration of the products search, the title weighs more than the description
+SEARCH_CONFIG = 'english'
+SEARCH_VECTOR = f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || " \
+                f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')"
 
 Base = declarative_base()
 
@@ -15,24 +22,35 @@ class ProductModel(BaseModel):
     Consists of:
     title: String(50)
     description: String
-    price: Numeric
+    price: MoneyType, in minor units, column price_minor
+    search_vector: TSVECTOR, generated from title and description
     """
     __tablename__ = 'product'
+    __table_args__ = (
+        Index('ix_product_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_product_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
 
     title = Column(String(50), nullable=False)
     description = Column(String, default='')
-    price = Column(Numeric, default=0.0, nullable=False)
+    price = Column('price_minor', MoneyType, key='price', default=0, nullable=False, index=True)
+    search_vector = Column(TSVECTOR, Computed(SEARCH_VECTOR, persisted=True))
 
 
 class CustomerBillModel(BaseModel):
     """
     Consists of:
     user_id: ForeignKey to User
-    balance: Numeric
+    balance: MoneyType, in minor units, column balance_minor
+    changed_at: DateTime, set by the trigger customer_bill_changed on every update
+    deleted_at: DateTime, the bill is hidden from then and deleted in the background, see apps.dimatech.deletions
     """
     __tablename__ = 'customer_bill'
-    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
-    balance = Column(Numeric, default=0.0, nullable=False)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
+    balance = Column('balance_minor', MoneyType, key='balance', default=0, nullable=False)
+    # not indexed so the updates of the balance stay HOT, the reconciliation scans it
+    changed_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    deleted_at = Column(DateTime(timezone=True))
 
     user = relationship(User, backref='customer_bill')
 
@@ -42,13 +60,18 @@ class TransactionModel(BaseModel):
     Consists of:
     user_id: ForeignKey to User
     bill_id: ForeignKey to CustomerBillModel
-    amount: Numeric
+    amount: MoneyType, in minor units, column amount_minor
+    created_at: DateTime, the table is partitioned by its month, see apps.dimatech.partitions
     """
     __tablename__ = 'transaction'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
 
-    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
-    bill_id = Column(Integer, ForeignKey('customer_bill.id', ondelete='CASCADE'), nullable=False)
-    amount = Column(Numeric, default=0.0, nullable=False)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
+    bill_id = Column(Integer, ForeignKey('customer_bill.id', ondelete='CASCADE'), nullable=False, index=True)
+    amount = Column('amount_minor', MoneyType, key='amount', default=0, nullable=False, index=True)
+    # part of the primary key as the primary key of a partitioned table must include the partition key
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), primary_key=True, index=True)
 
     user = relationship(User, backref='transaction')
     bill = relationship(CustomerBillModel, backref='transaction')
@@ -60,13 +83,126 @@ class PurchaseModel(BaseModel):
     product_id: ForeignKey to ProductModel
     user_id: ForeignKey to User
     bill_id: ForeignKey to CustomerBillModel
+    price: MoneyType, price of the product charged to the bill in minor units, column price_minor
+    created_at: DateTime, the table is partitioned by its month, see apps.dimatech.partitions
     """
     __tablename__ = 'purchase'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
 
-    product_id = Column(Integer, ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
-    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
-    bill_id = Column(Integer, ForeignKey('customer_bill.id', ondelete='CASCADE'), nullable=False)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(Integer, ForeignKey('product.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
+    bill_id = Column(Integer, ForeignKey('customer_bill.id', ondelete='CASCADE'), nullable=False, index=True)
+    price = Column('price_minor', MoneyType, key='price')
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), primary_key=True, index=True)
 
     product = relationship(ProductModel, backref='purchase')
     user = relationship(User, backref='purchase')
     bill = relationship(CustomerBillModel, backref='purchase')
+
+
+class UserDataVersionModel(Base):
+    """
+    Consists of:
+    user_id: ForeignKey to User
+    version: BigInteger, bumped on every write to the user's bills, transactions or purchases
+    """
+    __tablename__ = 'user_data_version'
+
+    user_id = Column(Integer, ForeignKey(User.id, ondelete='CASCADE'), primary_key=True)
+    version = Column(BigInteger, default=0, nullable=False)
+
+
+class CatalogVersionModel(BaseModel):
+    """
+    Consists of:
+    version: BigInteger, bumped on every write to products
+    The table holds a single row with id 1
+    """
+    __tablename__ = 'catalog_version'
+
+    version = Column(BigInteger, default=0, nullable=False)
+
+
+class ArchivedTotalModel(Base):
+    """
+    Consists of:
+    bill_id: ForeignKey to CustomerBillModel
+    transactions: MoneyType, sum of the amounts of the archived transactions of the bill, column transactions_minor
+    purchases: MoneyType, sum of the prices of the archived purchases of the bill, column purchases_minor
+    """
+    __tablename__ = 'archived_total'
+
+    bill_id = Column(Integer, ForeignKey('customer_bill.id', ondelete='CASCADE'), primary_key=True)
+    transactions = Column('transactions_minor', MoneyType, key='transactions', default=0, server_default='0',
+                          nullable=False)
+    purchases = Column('purchases_minor', MoneyType, key='purchases', default=0, server_default='0', nullable=False)
+
+
+class ReconciliationModel(BaseModel):
+    """
+    Consists of:
+    checked_at: DateTime, start of the last complete reconciliation
+    started_at: DateTime, start of the reconciliation in progress
+    since: DateTime, the reconciliation in progress checks the bills changed from then, all bills if empty
+    position: Integer, the reconciliation in progress has checked the bills up to this id
+    The table holds a single row with id 1
+    """
+    __tablename__ = 'reconciliation'
+
+    checked_at = Column(DateTime(timezone=True))
+    started_at = Column(DateTime(timezone=True))
+    since = Column(DateTime(timezone=True))
+    position = Column(Integer, default=0, server_default='0', nullable=False)
+
+
+class OutboxModel(Base):
+    """
+    Consists of:
+    event_id: UUID, id of the event given to the sink, the same on every delivery attempt
+    topic: String(50), e.g. transaction.created
+    payload: JSONB
+    created_at: DateTime
+    available_at: DateTime, the event is dispatched from then, later after every failed delivery
+    attempts: Integer, failed deliveries
+    last_error: String, error of the last failed delivery
+    Events are written in the transaction of the ledger change and deleted once delivered,
+    see apps.dimatech.outbox
+    """
+    __tablename__ = 'outbox'
+
+    id = Column(BigInteger, primary_key=True)
+    event_id = Column(UUID(as_uuid=True), nullable=False)
+    topic = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+    attempts = Column(Integer, default=0, server_default='0', nullable=False)
+    last_error = Column(String)
+
+
+class DeletionModel(BaseModel):
+    """
+    Consists of:
+    kind: String(10), user or bill
+    target_id: Integer, id of the deleted user or bill
+    user_id: Integer, the user or the owner of the bill, whose shard holds the rows to delete
+    status: String(10), pending, done or cancelled
+    total: BigInteger, rows of the ledger to delete, counted when the deletion starts
+    deleted: BigInteger, rows of the ledger deleted so far
+    created_at: DateTime
+    finished_at: DateTime
+    locked_until: DateTime, lease of the worker running the deletion
+    The table is in the global database, see apps.dimatech.deletions
+    """
+    __tablename__ = 'deletion'
+
+    kind = Column(String(10), nullable=False)
+    target_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    status = Column(String(10), default='pending', server_default='pending', nullable=False, index=True)
+    total = Column(BigInteger)
+    deleted = Column(BigInteger, default=0, server_default='0', nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    finished_at = Column(DateTime(timezone=True))
+    locked_until = Column(DateTime(timezone=True))
@@ -0,0 +1,131 @@
+import asyncio
+import json
+from operator import itemgetter
+
+import asyncpg
+from sanic.log import logger
+
+from core.helpers import http
+from core.helpers.metrics import counters
+
+# the oldest available events, leased to the dispatcher for $2 seconds by moving their available_at:
+# rows claimed by the dispatcher of another worker or node are skipped, the events of a dispatcher
+# stopped while sending them are available again once the lease ends
+CLAIM_EVENTS = """
+UPDATE outbox SET available_at = now() + make_interval(secs => $2)
+WHERE id IN (SELECT id FROM outbox WHERE available_at <= now() ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED)
+RETURNING id, event_id, topic, payload, created_at, attempts
+"""
+# the next attempt is delayed exponentially up to max_backoff seconds, with jitter so failed batches spread out
+RETRY_EVENTS = """
+UPDATE outbox SET attempts = attempts + 1, last_error = $2,
+    available_at = now() + least($4, $3 * 2 ^ attempts) * (0.5 + random() / 2) * interval '1 second'
+WHERE id = ANY($1::bigint[])
+"""
+
+
+class SinkError(Exception):
+    """The sink did not accept the events"""
+
+
+class HttpSink(object):
+    """POSTs the events as {"events": [...]} to the url, any 2xx status accepts them"""
+
+    def __init__(self, url, timeout=5.0):
+        self.url = url
+        self.timeout = timeout
+
+    async def send(self, events):
+        body = json.dumps({'events': events}).encode()
+        try:
+            status, headers, _ = await http.fetch(self.url, 'POST', {'Content-Type': 'application/json'}, body,
+                                                  self.timeout)
+        except (ValueError, IndexError) as exception:
+            raise SinkError(f'Invalid response: {exception!r}')
+        if not 200 <= status < 300:
+            raise SinkError(f'Sink answered {status}')
+
+
+class MemorySink(object):
+    """Keeps the events in memory, for tests"""
+
+    def __init__(self):
+        self.events = []
+
+    async def send(self, events):
+        self.events.extend(events)
+
+    def clear(self):
+        self.events.clear()
+
+
+async def dispatch_batch(connection, sink, batch_size: int, backoff: float, max_backoff: float,
+                         lease: float = 30.0) -> int:
+    """Claims a batch of available events, sends it to the sink and deletes it once accepted
+
+    Claiming, deleting and rescheduling the batch are short transactions of their own, no transaction
+    is open while the batch is sent. The batch is delayed with backoff if the sink fails.
+    Events are delivered at least once, the sink deduplicates them by id.
+
+    Args:
+        connection: asyncpg connection to a database of the ledger
+        sink: HttpSink or MemorySink
+        batch_size: Number of events sent at once
+        backoff: Seconds before the first retry, doubled by attempt
+        max_backoff: Longest delay in seconds between two attempts
+        lease: Seconds the batch is held by the dispatcher, longer than a delivery may take
+
+    Returns:
+        The number of delivered events
+    """
+    rows = sorted(await connection.fetch(CLAIM_EVENTS, batch_size, lease), key=itemgetter('id'))
+    if not rows:
+        return 0
+    ids = [row['id'] for row in rows]
+    events = [{'id': str(row['event_id']), 'topic': row['topic'], 'created_at': row['created_at'].isoformat(),
+               'attempts': row['attempts'], 'data': json.loads(row['payload'])} for row in rows]
+    try:
+        await sink.send(events)
+    except (OSError, asyncio.TimeoutError, SinkError) as exception:
+        counters.increment('outbox_failed', value=len(rows))
+        logger.warning("Could not deliver %s outbox events: %r", len(rows), exception)
+        await connection.execute(RETRY_EVENTS, ids, repr(exception), backoff, max_backoff)
+        return 0
+    await connection.execute('DELETE FROM outbox WHERE id = ANY($1::bigint[])', ids)
+    counters.increment('outbox_delivered', value=len(rows))
+    return len(rows)
+
+
+async def dispatch_outbox(urls: list, sink, batch_size: int = 100, interval: float = 1.0, backoff: float = 1.0,
+                          max_backoff: float = 300.0, lease: float = 30.0) -> None:
+    """Delivers the outbox events of the databases of the ledger to the sink, runs until cancelled
+
+    Workers of every node dispatch, the rows claimed by one are skipped by the others. Batches are
+    dispatched back to back while events are available, the outboxes are polled every interval seconds
+    once they are drained. A connection is kept open per database.
+    """
+    connections = {}
+    try:
+        while True:
+            delivered = 0
+            for url in urls:
+                try:
+                    if url not in connections:
+                        connections[url] = await asyncpg.connect(url)
+                    delivered += await dispatch_batch(connections[url], sink, batch_size, backoff, max_backoff,
+                                                       lease)
+                    continue
+                except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exception:
+                    logger.warning("Could not dispatch the outbox: %r", exception)
+                except Exception:
+                    # a bug must not stop the dispatcher of the worker for good, cancelling it still does
+                    logger.exception("Unexpected error while dispatching the outbox")
+                    await asyncio.sleep(backoff)
+                connection = connections.pop(url, None)
+                if connection is not None:
+                    connection.terminate()
+            if not delivered:
+                await asyncio.sleep(interval)
+    finally:
+        for connection in connections.values():
+            connection.terminate()
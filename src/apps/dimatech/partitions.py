@@ -0,0 +1,260 @@
+import asyncio
+import gzip
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os.path import join, exists
+
+import asyncpg
+from sanic.log import logger
+from sqlalchemy import text
+
+from core.helpers.money import SCALE
+
+# ledger tables partitioned by month of created_at, a partition of a month is named <table>_y<year>m<month>
+PARTITIONED_TABLES = ('transaction', 'purchase')
+PARTITION_NAME = re.compile(r'^(?P<table>\w+)_y(?P<year>\d{4})m(?P<month>\d{2})$')
+# column of archived_total keeping the sum of the archived rows of a bill and the summed amount column by table,
+# the reconciliation adds them to the rows in the database
+ARCHIVED_TOTALS = {'transaction': ('transactions_minor', 'amount_minor'),
+                   'purchase': ('purchases_minor', 'price_minor')}
+# numeric column of the amounts in major units by table, the only amount column of the archives written before
+# the amounts were stored in minor units, see the migrations a9c4e2f7b316 and b5f2e8a1c7d4
+MAJOR_COLUMNS = {'transaction': 'amount', 'purchase': 'price'}
+FOREIGN_KEY = re.compile(r'FOREIGN KEY \((?P<column>\w+)\) REFERENCES (?P<table>[\w."]+)\((?P<key>\w+)\)')
+# attached partitions of a table once a month was archived, archived_total has rows from the first archival on
+ATTACHED_PARTITIONS = text(
+    "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+    "WHERE i.inhparent = CAST(:table AS regclass) AND NOT i.inhdetachpending AND EXISTS (SELECT FROM archived_total)")
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f'{table}_y{month.year}m{month.month:02}'
+
+
+def partition_month(name: str):
+    """Returns the month of a partition, None if the name does not follow the naming of the partitions"""
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return datetime(int(match['year']), int(match['month']), 1, tzinfo=timezone.utc)
+
+
+async def list_partitions(connection, table: str) -> list:
+    """Returns the name, the bound (FOR VALUES ...) and whether a concurrent detach is pending of the partitions"""
+    rows = await connection.fetch(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), i.inhdetachpending FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = $1::regclass ORDER BY c.relname", f'"{table}"')
+    return [tuple(row) for row in rows]
+
+
+async def archived_before(session, table: str):
+    """Returns the month of the oldest partition attached to the table, the rows created before it are archived
+
+    Args:
+        session: SQLAlchemy session of a database of the ledger, the views have no asyncpg connection
+        table: Partitioned table
+
+    Returns:
+        The month, None if no month was archived or the oldest partition holds the rows of every earlier month
+    """
+    partitions = (await session.execute(ATTACHED_PARTITIONS, {'table': f'"{table}"'})).all()
+    if not partitions or any('MINVALUE' in bound for name, bound in partitions):
+        return None
+    return min((month for month in (partition_month(name) for name, bound in partitions) if month), default=None)
+
+
+async def ensure_partitions(connection, months: int) -> list:
+    """Creates the missing partitions of the current month and of the next months
+
+    Workers of every node call it, the first one holding the lock does the work.
+
+    Args:
+        connection: asyncpg connection to a database of the ledger
+        months: Number of months after the current one
+
+    Returns:
+        The names of the created partitions
+    """
+    current = month_start(datetime.now(timezone.utc))
+    created = []
+    async with connection.transaction():
+        if not await connection.fetchval("SELECT pg_try_advisory_xact_lock(hashtext('ledger_partitions'))"):
+            return created
+        for table in PARTITIONED_TABLES:
+            names = {name for name, bound, pending in await list_partitions(connection, table)}
+            for month in (add_months(current, index) for index in range(months + 1)):
+                name = partition_name(table, month)
+                if name in names:
+                    continue
+                await connection.execute(
+                    f'CREATE TABLE {name} PARTITION OF "{table}" '
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')")
+                created.append(name)
+    return created
+
+
+async def maintain_partitions(urls: list, months: int, interval: float) -> None:
+    """Keeps the partitions of the next months created in every database of the ledger, runs until cancelled"""
+    while True:
+        for url in urls:
+            try:
+                connection = await asyncpg.connect(url)
+                try:
+                    created = await ensure_partitions(connection, months)
+                finally:
+                    await connection.close()
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as exception:
+                logger.warning("Could not create the ledger partitions: %r", exception)
+                continue
+            if created:
+                logger.info("Created the ledger partitions %s", ', '.join(created))
+        await asyncio.sleep(interval)
+
+
+@contextmanager
+def atomic_file(path: str):
+    """Opens a temporary file moved to path once written, so a partially written file is never seen at path"""
+    with open(f'{path}.tmp', 'wb') as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+async def archive_partition(connection, directory: str, table: str, name: str, bound: str) -> dict:
+    """Detaches the partition, writes its rows to <name>.csv.gz and its manifest to <name>.json, then drops it
+
+    The partition is detached concurrently so the ledger stays writable, it is attached again if the
+    archive can not be written. The sums of the rows by bill are added to archived_total as it is dropped.
+    The manifest records the scale of the minor unit columns, the archives written before the amounts were
+    stored in minor units have none.
+
+    Returns:
+        The manifest of the archive
+    """
+    await connection.execute(f'ALTER TABLE "{table}" DETACH PARTITION {name} CONCURRENTLY')
+    try:
+        columns = [row[0] for row in await connection.fetch(
+            "SELECT attname FROM pg_attribute WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped "
+            "ORDER BY attnum", name)]
+        with atomic_file(join(directory, f'{name}.csv.gz')) as file:
+            with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+                status = await connection.copy_from_table(name, columns=columns, output=archive, format='csv',
+                                                          header=True)
+
+        manifest = {'table': table, 'partition': name, 'bound': bound, 'columns': columns, 'scale': SCALE,
+                    'rows': int(status.split()[-1]), 'archived_at': datetime.now(timezone.utc).isoformat()}
+        with atomic_file(join(directory, f'{name}.json')) as file:
+            file.write(json.dumps(manifest).encode())
+    except BaseException:
+        await connection.execute(f'ALTER TABLE "{table}" ATTACH PARTITION {name} {bound}')
+        raise
+
+    total, column = ARCHIVED_TOTALS[table]
+    async with connection.transaction():
+        await connection.execute(
+            f"INSERT INTO archived_total (bill_id, {total}) "
+            f"SELECT bill_id, coalesce(sum({column}), 0) FROM {name} GROUP BY bill_id "
+            f"ON CONFLICT (bill_id) DO UPDATE SET {total} = archived_total.{total} + excluded.{total}")
+        await connection.execute(f'DROP TABLE {name}')
+    return manifest
+
+
+async def archive_partitions(connection, directory: str, before: datetime) -> list:
+    """Archives the partitions of the months ending before the given time
+
+    Args:
+        connection: asyncpg connection to a database of the ledger
+        directory: Directory of the archives of the database
+        before: Partitions holding rows from this time are kept
+
+    Returns:
+        The manifests of the archives
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifests = []
+    for table in PARTITIONED_TABLES:
+        for name, bound, pending in await list_partitions(connection, table):
+            month = partition_month(name)
+            if month is None or add_months(month, 1) > before:
+                continue
+            if pending:
+                # a previous run was interrupted while detaching the partition
+                await connection.execute(f'ALTER TABLE "{table}" DETACH PARTITION {name} FINALIZE')
+                await connection.execute(f'ALTER TABLE "{table}" ATTACH PARTITION {name} {bound}')
+            manifests.append(await archive_partition(connection, directory, table, name, bound))
+            logger.info("Archived %s rows of %s", manifests[-1]['rows'], name)
+    return manifests
+
+
+async def restore_partition(connection, directory: str, table: str, month: datetime):
+    """Loads an archived month back and attaches it to the table, the archive is kept
+
+    Rows referring to bills, users or products deleted since the archival are dropped
+    as the cascade of the deletion would have. The sums of the rows are taken back from archived_total.
+    Archives written before the amounts were stored in minor units have them in major units only,
+    they are converted.
+
+    Returns:
+        The number of restored rows, None if the month of the table is not archived in the directory
+    """
+    name = partition_name(table, month)
+    if not exists(join(directory, f'{name}.json')):
+        return None
+    with open(join(directory, f'{name}.json')) as file:
+        manifest = json.load(file)
+
+    total, column = ARCHIVED_TOTALS[table]
+    major = MAJOR_COLUMNS[table]
+    columns = manifest['columns']
+    async with connection.transaction():
+        await connection.execute(f'CREATE TABLE {name} (LIKE "{table}" INCLUDING DEFAULTS)')
+        # triggers of the table do not fire on a table being restored, the amounts are converted here
+        converted = column not in columns and major in columns
+        required = await connection.fetchval(
+            "SELECT attnotnull FROM pg_attribute WHERE attrelid = $1::regclass AND attname = $2", name, column)
+        # the numeric column is no longer in the table once the move to minor units is complete
+        added = major in columns and not await connection.fetchval(
+            "SELECT count(*) FROM pg_attribute WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped",
+            name, major)
+        if added:
+            await connection.execute(f'ALTER TABLE {name} ADD COLUMN {major} numeric')
+        if converted:
+            await connection.execute(f'ALTER TABLE {name} ALTER COLUMN {column} DROP NOT NULL')
+        with gzip.open(join(directory, f'{name}.csv.gz'), 'rb') as archive:
+            await connection.copy_to_table(name, source=archive, columns=columns, format='csv', header=True)
+        if converted:
+            await connection.execute(f'UPDATE {name} SET {column} = round({major} * {10 ** SCALE})')
+            if required:
+                await connection.execute(f'ALTER TABLE {name} ALTER COLUMN {column} SET NOT NULL')
+        if added:
+            await connection.execute(f'ALTER TABLE {name} DROP COLUMN {major}')
+
+        definitions = await connection.fetch(
+            "SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = $1::regclass AND contype = 'f'",
+            f'"{table}"')
+        for definition, in definitions:
+            reference = FOREIGN_KEY.search(definition)
+            await connection.execute(
+                f"DELETE FROM {name} WHERE NOT EXISTS (SELECT FROM {reference['table']} "
+                f"WHERE {reference['table']}.{reference['key']} = {name}.{reference['column']})")
+
+        await connection.execute(
+            f"UPDATE archived_total SET {total} = archived_total.{total} - restored.total "
+            f"FROM (SELECT bill_id, coalesce(sum({column}), 0) AS total FROM {name} GROUP BY bill_id) AS restored "
+            f"WHERE archived_total.bill_id = restored.bill_id")
+
+        await connection.execute(f'ALTER TABLE "{table}" ATTACH PARTITION {name} {manifest["bound"]}')
+        return await connection.fetchval(f'SELECT count(*) FROM {name}')
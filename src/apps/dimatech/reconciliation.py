@@ -0,0 +1,141 @@
+import asyncio
+import json
+from datetime import timedelta
+
+import asyncpg
+from sanic.log import logger
+
+from core.helpers.money import to_major
+
+# balance of the bills and the balance expected from their transactions and purchases, in the database
+# and archived, read by a single statement so concurrent writes never show as mismatches
+CHECK_BILLS = """
+SELECT b.id, b.user_id, b.balance_minor,
+       coalesce(t.total, 0) + coalesce(a.transactions_minor, 0) - coalesce(p.total, 0) - coalesce(a.purchases_minor, 0)
+FROM customer_bill b
+LEFT JOIN (SELECT bill_id, sum(amount_minor) AS total FROM "transaction" WHERE bill_id = ANY($1::int[])
+           GROUP BY bill_id) t ON t.bill_id = b.id
+LEFT JOIN (SELECT bill_id, sum(price_minor) AS total FROM purchase WHERE bill_id = ANY($1::int[])
+           GROUP BY bill_id) p ON p.bill_id = b.id
+LEFT JOIN archived_total a ON a.bill_id = b.id
+WHERE b.id = ANY($1::int[]) AND b.deleted_at IS NULL
+"""
+
+
+async def changed_bills(pool, since, position: int, chunk_size: int):
+    """Yields the ids of the bills to check after position by chunks of chunk_size, ordered by id
+
+    A complete reconciliation pages through the bills by id. The bills changed since a time are selected at once,
+    changed_at is not indexed and is read by a single scan of the bills.
+    """
+    if since is None:
+        while True:
+            rows = await pool.fetch('SELECT id FROM customer_bill WHERE id > $1 ORDER BY id LIMIT $2',
+                                    position, chunk_size)
+            if not rows:
+                return
+            position = rows[-1][0]
+            yield [row[0] for row in rows]
+
+    rows = await pool.fetch('SELECT id FROM customer_bill WHERE changed_at >= $1 AND id > $2 ORDER BY id',
+                            since, position)
+    for start in range(0, len(rows), chunk_size):
+        yield [row[0] for row in rows[start:start + chunk_size]]
+
+
+async def reconcile(url: str, connections: int = 4, chunk_size: int = 1000, margin: float = 60, full: bool = False):
+    """Checks that the balance of the bills of a database equals their transactions minus their purchases
+
+    Chunks of bills are checked by several connections in parallel. The bills checked without a gap are
+    checkpointed in the reconciliation table, an interrupted reconciliation resumes from there.
+    A reconciliation checks only the bills changed since the start of the last complete one, less margin seconds
+    for the transactions in progress then, or every bill the first time or when full.
+    A single reconciliation runs at a time on a database.
+
+    Args:
+        url: asyncpg url of a database of the ledger
+        connections: Number of connections checking chunks
+        chunk_size: Number of bills of a chunk
+        margin: Seconds a transaction may have been in progress at the start of the last reconciliation
+        full: Whether every bill is checked
+
+    Returns:
+        The report of the reconciliation with the mismatches in major units, None if another reconciliation runs
+    """
+    pool = await asyncpg.create_pool(url, min_size=1, max_size=connections + 2)
+    try:
+        # the lock is released with its connection when the pool is closed
+        async with pool.acquire() as lock:
+            if not await lock.fetchval("SELECT pg_try_advisory_lock(hashtext('reconciliation'))"):
+                return None
+
+            state = await pool.fetchrow('SELECT checked_at, started_at, since, position FROM reconciliation '
+                                        'WHERE id = 1')
+            resumed = state['started_at'] is not None and not full
+            if not resumed:
+                since = None if full or state['checked_at'] is None else \
+                    state['checked_at'] - timedelta(seconds=margin)
+                state = await pool.fetchrow('UPDATE reconciliation SET started_at = now(), since = $1, position = 0 '
+                                            'WHERE id = 1 RETURNING checked_at, started_at, since, position', since)
+
+            report = {'since': state['since'] and state['since'].isoformat(), 'resumed': resumed,
+                      'position': state['position'], 'checked': 0, 'mismatches': []}
+            chunks = asyncio.Queue(connections * 2)
+            done, checkpoint = {}, {'next': 0, 'position': state['position']}
+
+            async def produce():
+                number = 0
+                async for bill_ids in changed_bills(pool, state['since'], state['position'], chunk_size):
+                    await chunks.put((number, bill_ids))
+                    number += 1
+                for _ in range(connections):
+                    await chunks.put(None)
+
+            async def check():
+                while (chunk := await chunks.get()) is not None:
+                    number, bill_ids = chunk
+                    for bill_id, user_id, balance, expected in await pool.fetch(CHECK_BILLS, bill_ids):
+                        if balance != expected:
+                            report['mismatches'].append({'bill_id': bill_id, 'user_id': user_id,
+                                                         'balance': str(to_major(balance)),
+                                                         'expected': str(to_major(expected))})
+                    report['checked'] += len(bill_ids)
+
+                    # the position moves past the chunks checked without a gap before them
+                    done[number] = bill_ids[-1]
+                    if checkpoint['next'] in done:
+                        while checkpoint['next'] in done:
+                            checkpoint['position'] = done.pop(checkpoint['next'])
+                            checkpoint['next'] += 1
+                        await pool.execute('UPDATE reconciliation SET position = greatest(position, $1) WHERE id = 1',
+                                           checkpoint['position'])
+
+            tasks = [asyncio.ensure_future(produce()), *(asyncio.ensure_future(check()) for _ in range(connections))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            await pool.execute('UPDATE reconciliation SET checked_at = started_at, started_at = NULL, since = NULL, '
+                               'position = 0 WHERE id = 1')
+            return report
+    finally:
+        await pool.close()
+
+
+async def reconcile_periodically(urls: list, interval: float, **options) -> None:
+    """Reconciles the databases of the ledger every interval seconds and logs the mismatches as JSON,
+    runs until cancelled. Workers of every node call it, a single one reconciles a database at a time."""
+    while True:
+        await asyncio.sleep(interval)
+        for url in urls:
+            try:
+                report = await reconcile(url, **options)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as exception:
+                logger.warning("Could not reconcile the balances: %r", exception)
+                continue
+            if report is None:
+                continue
+            for mismatch in report['mismatches']:
+                logger.error("Balance mismatch: %s", json.dumps(mismatch))
+            logger.info("Reconciled %s bills, %s mismatches", report['checked'], len(report['mismatches']))
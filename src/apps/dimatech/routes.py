@@ -1,16 +1,124 @@
+import asyncio
+
 from sanic import Blueprint
 import apps.dimatech.views as views
+from apps.dimatech.deletions import delete_periodically
+from apps.dimatech.outbox import HttpSink, MemorySink, dispatch_outbox
+from apps.dimatech.partitions import maintain_partitions
+from apps.dimatech.reconciliation import reconcile_periodically
+from apps.dimatech.services import BALANCE_CHANNEL
+from core.helpers.events import EventHub
 
 blueprint = Blueprint('dimatech_app', url_prefix='/api', version=1)
 
-blueprint.add_route(views.ProductAPI.as_view(), '/products')
-blueprint.add_route(views.ProductDetailAPI.as_view(), '/products/<pk:int>')
+# ctx_admission, ctx_admission_write (for unsafe methods) and ctx_admission_admin (for the lists
+# an administrator reads from every shard) are admission classes, see core.extentions.middlewares,
+# ctx_deadline is the time in seconds a request may take
+
+blueprint.add_route(views.ProductAPI.as_view(), '/products', ctx_admission='catalog', ctx_admission_write='admin',
+                    ctx_deadline=2)
+blueprint.add_route(views.ProductSearchAPI.as_view(), '/products/search', ctx_admission='catalog', ctx_deadline=2)
+blueprint.add_route(views.ProductDetailAPI.as_view(), '/products/<pk:int>', ctx_admission='catalog',
+                    ctx_admission_write='admin', ctx_deadline=2)
+
+blueprint.add_route(views.CustomerBillAPI.as_view(), '/bills', ctx_admission_admin='admin', ctx_deadline=5)
+blueprint.add_route(views.BillEventsAPI.as_view(), '/bills/events')
+blueprint.add_route(views.CustomerBillDetailAPI.as_view(), '/bills/<pk:int>', ctx_admission_write='admin')
+
+blueprint.add_route(views.TransactionAPI.as_view(), '/transactions', ctx_admission_admin='admin', ctx_deadline=5)
+blueprint.add_route(views.TransactionDetailAPI.as_view(), '/transactions/<pk:int>', ctx_admission_write='admin')
+
+blueprint.add_route(views.PurchaseAPI.as_view(), '/purchases', ctx_admission_admin='admin',
+                    ctx_admission_write='purchases', ctx_deadline=5)
+blueprint.add_route(views.PurchaseDetailAPI.as_view(), '/purchases/<pk:int>', ctx_admission_write='admin')
+
+blueprint.add_route(views.DeletionDetailAPI.as_view(), '/deletions/<pk:int>', ctx_admission='admin')
+
+
+def ledger_urls(app) -> list:
+    # urls of the databases of the ledger for asyncpg connections outside of the pools
+    return [engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+            for engine in app.ctx.shard_engines or [app.ctx.engine]]
+
+
+@blueprint.listener('before_server_start')
+async def setup_events(app, loop):
+    # balances are notified by the databases of the ledger, each listened to by a connection of its own
+    app.ctx.events = EventHub(ledger_urls(app), BALANCE_CHANNEL, app.config.EVENTS_BUFFER_SIZE,
+                              app.config.EVENTS_QUEUE_SIZE)
+    app.ctx.events.start()
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_events(app, loop):
+    await app.ctx.events.stop()
+
+
+@blueprint.listener('before_server_start')
+async def setup_partitions(app, loop):
+    # inserts fail once the month of created_at has no partition, they are created months ahead
+    app.ctx.partitions = asyncio.ensure_future(maintain_partitions(
+        ledger_urls(app), app.config.PARTITIONS_AHEAD, app.config.PARTITIONS_INTERVAL))
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_partitions(app, loop):
+    app.ctx.partitions.cancel()
+    await asyncio.gather(app.ctx.partitions, return_exceptions=True)
+
+
+@blueprint.listener('before_server_start')
+async def setup_reconciliation(app, loop):
+    app.ctx.reconciliation = None
+    if app.config.RECONCILE_INTERVAL:
+        app.ctx.reconciliation = asyncio.ensure_future(reconcile_periodically(
+            ledger_urls(app), app.config.RECONCILE_INTERVAL, connections=app.config.RECONCILE_CONNECTIONS,
+            chunk_size=app.config.RECONCILE_CHUNK_SIZE, margin=app.config.RECONCILE_MARGIN))
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_reconciliation(app, loop):
+    # an interrupted reconciliation resumes from its checkpoint
+    if app.ctx.reconciliation is not None:
+        app.ctx.reconciliation.cancel()
+        await asyncio.gather(app.ctx.reconciliation, return_exceptions=True)
+
+
+@blueprint.listener('before_server_start')
+async def setup_outbox(app, loop):
+    # events of the ledger changes wait in the outbox until a sink is configured
+    config = app.config
+    app.ctx.outbox_sink = app.ctx.outbox = None
+    if config.OUTBOX_SINK == 'memory':
+        app.ctx.outbox_sink = MemorySink()
+    elif config.OUTBOX_SINK == 'http' and config.OUTBOX_SINK_URL:
+        app.ctx.outbox_sink = HttpSink(config.OUTBOX_SINK_URL, config.OUTBOX_TIMEOUT)
+    if app.ctx.outbox_sink is not None:
+        app.ctx.outbox = asyncio.ensure_future(dispatch_outbox(
+            ledger_urls(app), app.ctx.outbox_sink, config.OUTBOX_BATCH_SIZE, config.OUTBOX_INTERVAL,
+            config.OUTBOX_BACKOFF, config.OUTBOX_MAX_BACKOFF, config.OUTBOX_LEASE))
+
+
+@blueprint.listener('after_server_stop')
+async def teardown_outbox(app, loop):
+    # a batch interrupted while sent is delivered again once its lease ends
+    if app.ctx.outbox is not None:
+        app.ctx.outbox.cancel()
+        await asyncio.gather(app.ctx.outbox, return_exceptions=True)
+
 
-blueprint.add_route(views.CustomerBillAPI.as_view(), '/bills')
-blueprint.add_route(views.CustomerBillDetailAPI.as_view(), '/bills/<pk:int>')
+@blueprint.listener('before_server_start')
+async def setup_deletions(app, loop):
+    # the deletions are in the global database, their rows in the databases of the ledger
+    config = app.config
+    url = app.ctx.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+    app.ctx.deletions = asyncio.ensure_future(delete_periodically(
+        url, ledger_urls(app), config.DELETE_BATCH_SIZE, config.DELETE_PAUSE, config.DELETE_INTERVAL,
+        config.DELETE_LEASE))
 
-blueprint.add_route(views.TransactionAPI.as_view(), '/transactions')
-blueprint.add_route(views.TransactionDetailAPI.as_view(), '/transactions/<pk:int>')
 
-blueprint.add_route(views.PurchaseAPI.as_view(), '/purchases')
-blueprint.add_route(views.PurchaseDetailAPI.as_view(), '/purchases/<pk:int>')
+@blueprint.listener('after_server_stop')
+async def teardown_deletions(app, loop):
+    # an interrupted deletion is resumed by another worker once its lease ends
+    app.ctx.deletions.cancel()
+    await asyncio.gather(app.ctx.deletions, return_exceptions=True)
@@ -0,0 +1,174 @@
+import json
+from uuid import uuid4
+
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert
+
+from apps.dimatech.models import CustomerBillModel, TransactionModel, PurchaseModel, UserDataVersionModel, \
+    CatalogVersionModel, OutboxModel, DeletionModel
+from apps.dimatech.validators import TransactionValidator, PurchaseValidator
+from core.helpers.money import to_major
+
+
+# The ledger (bills, transactions, purchases and data versions) of a user is in the database of his shard,
+# the functions below take the session of that database. Users and products are in the global database.
+
+# channel of the balance changes, listened to by the events hub of every worker
+BALANCE_CHANNEL = 'bill_balance'
+
+
+class ServiceError(Exception):
+    """The operation can not be done, status is the HTTP status to answer with"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def bump_data_version(session, *user_ids) -> None:
+    """
+    Bumps the data version of the users, must be called in the transaction of the write
+    """
+    user_ids = sorted({user_id for user_id in user_ids if user_id is not None})
+    if not user_ids:
+        return
+    statement = insert(UserDataVersionModel).values([{'user_id': user_id, 'version': 1} for user_id in user_ids])
+    statement = statement.on_conflict_do_update(index_elements=[UserDataVersionModel.user_id],
+                                                set_={'version': UserDataVersionModel.version + 1})
+    await session.execute(statement)
+
+
+async def bump_catalog_version(session) -> None:
+    """
+    Bumps the version of the products catalog, must be called in the transaction of the write
+    """
+    await session.execute(update(CatalogVersionModel).values(
+        {'version': CatalogVersionModel.version + 1}).where(CatalogVersionModel.id == 1))
+
+
+async def mark_bills_changed(session, *bill_ids) -> None:
+    """
+    Marks the bills whose transactions or purchases are changed so the reconciliation checks them again,
+    updates of the balance mark them by trigger
+    """
+    bill_ids = sorted({bill_id for bill_id in bill_ids if bill_id is not None})
+    if bill_ids:
+        await session.execute(update(CustomerBillModel).values(changed_at=func.now()).
+                              where(CustomerBillModel.id.in_(bill_ids)))
+
+
+async def notify_balance(session, bill_id: int, user_id: int, balance) -> None:
+    """
+    Notifies the new balance of a bill in minor units on BALANCE_CHANNEL, the notification is delivered
+    when the transaction of the caller commits and dropped if it rolls back. The event gives it in major units.
+    """
+    event = {'id': uuid4().hex, 'user_id': user_id, 'bill_id': bill_id, 'balance': float(to_major(balance))}
+    await session.execute(select(func.pg_notify(BALANCE_CHANNEL, json.dumps(event))))
+
+
+def enqueue_event(session, topic: str, data: dict) -> None:
+    """
+    Adds an event for the downstream systems to the outbox, written with the transaction of the caller
+    and delivered by the outbox dispatcher once committed. Amounts are given in major units as strings.
+    """
+    session.add(OutboxModel(event_id=uuid4(), topic=topic, payload=data))
+
+
+async def create_transaction(session, data: TransactionValidator) -> TransactionModel:
+    """
+    Creates a transaction, changes the bill balance by its amount and adds a transaction.created event
+    to the outbox, runs in the transaction of the caller
+
+    Args:
+        session: AsyncSession in a transaction
+        data: validated transaction
+
+    Returns: the created transaction
+    """
+    bill = await session.execute(select(CustomerBillModel.user_id).
+                                 where(CustomerBillModel.id == data.bill_id, CustomerBillModel.deleted_at.is_(None)))
+    bill = bill.first()
+    if bill is None:
+        raise ServiceError(400, 'Bill does not exist')
+
+    balance = await session.execute(update(CustomerBillModel).values(
+        balance=CustomerBillModel.balance + data.amount).where(
+        CustomerBillModel.id == data.bill_id).returning(CustomerBillModel.balance))
+    balance = balance.scalar_one()
+    transaction = TransactionModel(user_id=data.user_id, bill_id=data.bill_id, amount=data.amount)
+    session.add(transaction)
+    await session.flush()
+    enqueue_event(session, 'transaction.created', {
+        'id': transaction.id, 'user_id': data.user_id, 'bill_id': data.bill_id,
+        'amount': str(to_major(data.amount)), 'balance': str(to_major(balance))})
+    await bump_data_version(session, bill.user_id, data.user_id)
+    await notify_balance(session, data.bill_id, bill.user_id, balance)
+    return transaction
+
+
+async def create_purchase(session, data: PurchaseValidator, price) -> PurchaseModel:
+    """
+    Creates a purchase, charges the bill with the price of the product and adds a purchase.created event
+    to the outbox, runs in the transaction of the caller
+
+    Args:
+        session: AsyncSession in a transaction
+        data: validated purchase, user_id must be set
+        price: price of the product in minor units read from the global database, None if it does not exist
+
+    Returns: the created purchase
+    """
+    bill = await session.execute(select(CustomerBillModel.user_id, CustomerBillModel.balance).
+                                 where(CustomerBillModel.id == data.bill_id, CustomerBillModel.deleted_at.is_(None)).
+                                 with_for_update())
+    bill = bill.first()
+    if bill is None or price is None:
+        raise ServiceError(400, 'Record does not exist')
+    if bill.balance < price:
+        raise ServiceError(400, 'Not enough money to purchase')
+
+    await session.execute(update(CustomerBillModel).values(balance=bill.balance - price).
+                          where(CustomerBillModel.id == data.bill_id))
+    purchase = PurchaseModel(product_id=data.product_id, user_id=data.user_id, bill_id=data.bill_id, price=price)
+    session.add(purchase)
+    await session.flush()
+    enqueue_event(session, 'purchase.created', {
+        'id': purchase.id, 'product_id': data.product_id, 'user_id': data.user_id, 'bill_id': data.bill_id,
+        'price': str(to_major(price)), 'balance': str(to_major(bill.balance - price))})
+    await bump_data_version(session, bill.user_id, data.user_id)
+    await notify_balance(session, data.bill_id, bill.user_id, bill.balance - price)
+    return purchase
+
+
+async def hide_ledger(session, user_id: int) -> None:
+    """
+    Marks the bills of a deleted user deleted so they are hidden at once, their rows are deleted
+    in the background, see apps.dimatech.deletions
+    """
+    await session.execute(update(CustomerBillModel).values(deleted_at=func.now()).
+                          where(CustomerBillModel.user_id == user_id, CustomerBillModel.deleted_at.is_(None)))
+    await bump_data_version(session, user_id)
+
+
+async def schedule_deletion(session, kind: str, target_id: int, user_id: int) -> DeletionModel:
+    """
+    Adds a deletion of the user or bill marked deleted and of its dependent rows, run in the background
+    by apps.dimatech.deletions. Runs in the transaction of the caller on the global database.
+
+    Returns: the pending deletion
+    """
+    deletion = DeletionModel(kind=kind, target_id=target_id, user_id=user_id)
+    session.add(deletion)
+    await session.flush()
+    return deletion
+
+
+async def scheduled_deletion(session, kind: str, target_id: int):
+    """
+    Returns the last deletion of the user or bill that was not cancelled, None if there is none.
+    Runs in the transaction of the caller on the global database.
+    """
+    deletion = await session.execute(select(DeletionModel).where(
+        DeletionModel.kind == kind, DeletionModel.target_id == target_id, DeletionModel.status != 'cancelled').
+        order_by(DeletionModel.id.desc()).limit(1))
+    return deletion.scalar_one_or_none()
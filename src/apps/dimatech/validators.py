@@ -2,27 +2,50 @@ from typing import Optional
 
 from pydantic import BaseModel, Field
 
+from core.helpers.money import Money
+
 
 class ProductValidator(BaseModel):
     title: str = Field(max_length=50)
     description: Optional[str]
-    price: float = Field(ge=0.0)
+    price: Money
+
+
+class ProductPatchValidator(BaseModel):
+    title: Optional[str] = Field(max_length=50)
+    description: Optional[str]
+    price: Optional[Money]
 
 
 class CustomerBillValidator(BaseModel):
     user_id: Optional[int]
-    balance: Optional[float] = Field(ge=0.0)
+    balance: Optional[Money]
 
 
 class TransactionValidator(BaseModel):
-    signature: Optional[str]
-    transaction_id: Optional[int]
     user_id: int
     bill_id: int
-    amount: float = Field(ge=0.0)
+    amount: Money
+
+
+class TransactionPatchValidator(BaseModel):
+    user_id: Optional[int]
+    bill_id: Optional[int]
+    amount: Optional[Money]
+
+
+class TransactionWebhookValidator(TransactionValidator):
+    signature: str
+    transaction_id: int
 
 
 class PurchaseValidator(BaseModel):
     product_id: int
     user_id: Optional[int]
     bill_id: int
+
+
+class PurchasePatchValidator(BaseModel):
+    product_id: Optional[int]
+    user_id: Optional[int]
+    bill_id: Optional[int]
@@ -1,14 +1,280 @@
-from decimal import Decimal
+from datetime import datetime, timezone
+from decimal import InvalidOperation
+from functools import wraps
+from hashlib import sha1
+from operator import itemgetter
+from urllib.parse import urlencode
 
 from apps.auth.models import User
-from apps.dimatech.models import BaseModel, ProductModel, CustomerBillModel, TransactionModel, PurchaseModel
-from apps.dimatech.validators import ProductValidator, CustomerBillValidator, TransactionValidator, PurchaseValidator
-from sanic import Request, response
-from sanic.response import json, empty
+from apps.dimatech.models import BaseModel, ProductModel, CustomerBillModel, TransactionModel, PurchaseModel, \
+    UserDataVersionModel, CatalogVersionModel, DeletionModel, SEARCH_CONFIG
+from apps.dimatech.partitions import PARTITIONED_TABLES, archived_before, month_start
+from apps.dimatech.services import ServiceError, bump_data_version, bump_catalog_version, mark_bills_changed, \
+    create_transaction, create_purchase, schedule_deletion, scheduled_deletion
+from apps.dimatech.validators import ProductValidator, ProductPatchValidator, CustomerBillValidator, \
+    TransactionValidator, TransactionPatchValidator, PurchaseValidator, PurchasePatchValidator
+from core.extentions.exceptions import InvalidParameter, ArchivedRange
+from core.helpers import http, jsonapi, compression, events
+from core.helpers.cache import ResponseCache, CachedValue
+from core.helpers.coalescing import coalesce
+from core.helpers.money import Money, MoneyType, to_major, format_amounts
+from sanic import Request, Sanic, response
+from sanic.exceptions import Unauthorized
+from sanic.response import json, empty, HTTPResponse
 from sanic.views import HTTPMethodView
 from sanic_ext import validate
 from sanic_jwt_extended import jwt_required
-from sqlalchemy import select, update, delete
+from sqlalchemy import select, update, delete, func, case, cast, exists, or_, and_
+from sqlalchemy.dialects.postgresql import REAL
+
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'in': lambda column, value: column.in_(value),
+    'gte': lambda column, value: column >= value,
+    'lte': lambda column, value: column <= value,
+}
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parses an ISO 8601 date or time, in UTC unless it has an offset
+    """
+    value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+# parsers of the filter values by python type of the column, the type itself by default
+FILTER_PARSERS = {datetime: parse_datetime, Money: Money.validate}
+
+response_cache = ResponseCache()
+catalog_version = CachedValue()
+
+
+async def current_user_id(request: Request, token) -> int:
+    """
+    Returns the id of the user of the token, looked up once per request
+    """
+    if getattr(request.ctx, 'user_id', None) is None:
+        session = request.ctx.session
+        async with session.begin():
+            user_id = await session.execute(select(User.id).where(User.username == token.identity,
+                                                                  User.deleted_at.is_(None)))
+        user_id = user_id.scalar_one_or_none()
+        if user_id is None:
+            raise Unauthorized('User does not exist')
+        request.ctx.user_id = user_id
+    return request.ctx.user_id
+
+
+async def get_data_version(request: Request, username: str) -> tuple:
+    """
+    Returns the user id and the current version of his bills, transactions and purchases.
+    The version is kept with the ledger, in the database of the shard of the user.
+    """
+    session, shards = request.ctx.session, request.ctx.shards
+    if not shards.sharded:
+        async with session.begin():
+            result = await session.execute(
+                select(User.id, UserDataVersionModel.version).
+                outerjoin(UserDataVersionModel, UserDataVersionModel.user_id == User.id).
+                where(User.username == username, User.deleted_at.is_(None)))
+        return result.first() or (None, None)
+
+    async with session.begin():
+        user_id = await session.execute(select(User.id).where(User.username == username, User.deleted_at.is_(None)))
+    user_id = user_id.scalar_one_or_none()
+    if user_id is None:
+        return None, None
+    ledger = shards.for_user(user_id)
+    async with ledger.begin():
+        version = await ledger.execute(
+            select(UserDataVersionModel.version).where(UserDataVersionModel.user_id == user_id))
+    return user_id, version.scalar_one_or_none()
+
+
+def cached_per_user(handler):
+    """
+    Caches the responses of a default user by (user, endpoint, data version).
+    A repeated request with no change costs one version lookup. Administrators bypass the cache.
+    Must be placed below @jwt_required.
+    """
+
+    @wraps(handler)
+    async def wrapper(self, request: Request, *args, **kwargs) -> response:
+        token = kwargs['token']
+        if token.role == 'Admin':
+            return await handler(self, request, *args, **kwargs)
+
+        user_id, version = await get_data_version(request, token.identity)
+        if user_id is None:
+            return await handler(self, request, *args, **kwargs)
+        request.ctx.user_id = user_id
+
+        key = (user_id, request.route.name, request.path, request.query_string)
+        cached = response_cache.get(key, version)
+        if cached is not None:
+            body, content_type = cached
+            return HTTPResponse(body=body, content_type=content_type)
+
+        result = await handler(self, request, *args, **kwargs)
+        if result.status == 200:
+            response_cache.set(key, version, (result.body, result.content_type))
+        return result
+
+    return wrapper
+
+
+async def get_catalog_version(session) -> int:
+    """
+    Returns the current version of the products catalog
+    """
+    version = await session.execute(select(CatalogVersionModel.version).where(CatalogVersionModel.id == 1))
+    return version.scalar_one_or_none() or 0
+
+
+def purge_catalog(request: Request, pk: int = None) -> None:
+    """
+    Forgets the catalog version known to this worker and asks nginx to refresh its micro-cache
+    """
+    catalog_version.clear()
+    url = request.app.config.CATALOG_PURGE_URL
+    if url:
+        urls = [url] if pk is None else [url, f'{url}/{pk}']
+        request.app.add_task(http.purge(*urls))
+
+
+def conditional_catalog(handler):
+    """
+    Adds a strong ETag computed from the catalog version and Cache-Control to the catalog reads.
+    A conditional request with a matching If-None-Match is answered with 304, the DB is not touched
+    while the catalog version known to the worker is fresh.
+    Must be placed above @coalesce.
+    """
+
+    @wraps(handler)
+    async def wrapper(self, request: Request, *args, **kwargs) -> response:
+        version = catalog_version.get()
+        if version is None:
+            session = request.ctx.session
+            async with session.begin():
+                version = await get_catalog_version(session)
+            catalog_version.set(version, request.app.config.CATALOG_VERSION_TTL)
+
+        digest = sha1(f'{request.path}?{request.query_string}'.encode()).hexdigest()[:16]
+        headers = {'ETag': f'"{version}-{digest}"',
+                   'Cache-Control': f'public, max-age={request.app.config.CATALOG_MAX_AGE}'}
+
+        if_none_match = request.headers.get('if-none-match', '')
+        tags = [compression.strip_etag_coding(tag.strip()) for tag in if_none_match.split(',')]
+        if headers['ETag'] in tags or if_none_match.strip() == '*':
+            return empty(status=304, headers=headers)
+
+        result = await handler(self, request, *args, **kwargs)
+        if result.status == 200:
+            result.headers.update(headers)
+        return result
+
+    return wrapper
+
+
+def requested_fields(request: Request, resource: str, fields: dict) -> tuple:
+    """
+    Returns the names and columns of the fields requested by ?fields[resource]=a,b, all fields by default
+    """
+    names, errors = jsonapi.parse_fieldset(request.args, resource, list(fields))
+    if errors:
+        raise InvalidParameter(*errors)
+    return names, [fields[name] for name in names]
+
+
+def select_fields(model, references: dict, fields: list, joined: bool, *columns):
+    """
+    Returns a select of the fields of the ledger model and the columns, labelled by their names.
+    references maps the global models (User, ProductModel) to the columns of the model referring to them.
+    Fields of the global models are joined when the ledger is in the global database, otherwise the referring
+    columns are selected as _<column> and the fields are filled in by resolve_references.
+    """
+    query = select(*(column.label(name) for name, column in fields if joined or column.class_ is model),
+                   *columns).select_from(model)
+    if joined:
+        for reference, column in references.items():
+            query = query.join(reference, reference.id == column)
+    else:
+        query = query.add_columns(*(column.label(f'_{column.key}') for column in references.values()))
+    return query
+
+
+def hide_deleted(model, query, users: bool = False):
+    """
+    Hides the records of the models marked deleted and the transactions and purchases of the bills
+    marked deleted, their rows are deleted in the background. The bills of a deleted user are marked
+    deleted before him, so his ledger is hidden on the shards as well, users also hides the records
+    of deleted users where the users are in the database of the records.
+    """
+    if hasattr(model, 'deleted_at'):
+        query = query.where(model.deleted_at.is_(None))
+    if hasattr(model, 'bill_id'):
+        query = query.where(exists().where(CustomerBillModel.id == model.bill_id,
+                                           CustomerBillModel.deleted_at.is_(None)).correlate(model))
+    if users and hasattr(model, 'user_id'):
+        query = query.where(exists().where(User.id == model.user_id, User.deleted_at.is_(None)).correlate(model))
+    return query
+
+
+def money_names(columns) -> set:
+    """
+    Returns the names of the columns holding amounts in minor units
+    """
+    return {column.key for column in columns if isinstance(column.type, MoneyType)}
+
+
+def format_data(model, data: dict) -> dict:
+    """
+    Returns the data written to a record of the model with the amounts in major units
+    """
+    return format_amounts(data, money_names(model.__table__.columns))
+
+
+async def fetch_records(session, query) -> list:
+    """
+    Executes the query in a transaction of its own and returns the rows as dictionaries,
+    amounts in major units and times as ISO 8601 strings
+    """
+    async with session.begin():
+        result = await session.execute(query)
+    money = money_names(query.selected_columns)
+    return [{key: to_major(value) if key in money else value.isoformat() if isinstance(value, datetime) else value
+             for key, value in row._mapping.items()} for row in result]
+
+
+async def resolve_references(session, model, references: dict, fields: list, records: list) -> None:
+    """
+    Fills in the fields of the global models of the records selected from the shards, a query per global model
+    """
+    remote = [(name, column) for name, column in fields if column.class_ is not model]
+    for reference in {column.class_ for name, column in remote}:
+        key = f'_{references[reference].key}'
+        columns = [(name, column) for name, column in remote if column.class_ is reference]
+        values = {}
+        ids = {record[key] for record in records}
+        if ids:
+            async with session.begin():
+                rows = await session.execute(select(reference.id, *(column for name, column in columns)).
+                                             where(reference.id.in_(ids)))
+            values = {row[0]: row[1:] for row in rows}
+        for record in records:
+            for (name, column), value in zip(columns, values.get(record[key], (None,) * len(columns))):
+                record[name] = value
+
+
+def is_indexed(attribute) -> bool:
+    """
+    Checks that a filter or a sorting on the model attribute can be served by an index
+    """
+    column = attribute.property.columns[0]
+    if column.primary_key or column.index or column.unique:
+        return True
+    return any(list(index.columns)[0] is column for index in column.table.indexes)
 
 
 class BaseAPI(HTTPMethodView):
@@ -19,34 +285,146 @@ class BaseAPI(HTTPMethodView):
     def __init__(self):
         self.model = BaseModel
         self.query = None
+        self.resource = None
+        self.fields = {}
+        self.filters = {}
+        self.sorting = {}
+        # ledger models are stored on the shard of their user and refer to global models
+        self.sharded = False
+        self.references = {}
+
+    def fieldset(self, request: Request) -> tuple:
+        """
+        Returns the names and columns of the fields requested for the resource
+        """
+        return requested_fields(request, self.resource, self.fields)
+
+    def filter_query(self, request: Request, query):
+        """
+        Applies the filters and the sorting requested with ?filter[field][operator]=value and ?sort=-field.
+        self.filters maps a field to its column and allowed operators (eq, in, gte, lte),
+        self.sorting maps a field to its column. Fields missing there or not backed by an index are rejected.
+        """
+        filters, errors = jsonapi.parse_filters(
+            request.args, {name: operators for name, (column, operators) in self.filters.items()})
+        sorting, sort_errors = jsonapi.parse_sort(request.args, self.sorting)
+        errors.extend(sort_errors)
+
+        for name, operator, value in filters:
+            column = self.filters[name][0]
+            if not is_indexed(column):
+                errors.append(jsonapi.format_error(status=400, title='Invalid filter',
+                                                   detail=f"filter[{name}]: would need an unindexed scan"))
+                continue
+            try:
+                parse = FILTER_PARSERS.get(column.type.python_type, column.type.python_type)
+                value = [parse(item) for item in value] if operator == 'in' else parse(value)
+            except (ValueError, InvalidOperation):
+                errors.append(jsonapi.format_error(status=400, title='Invalid filter',
+                                                   detail=f"filter[{name}]: '{value}' is not a valid value"))
+                continue
+            query = query.where(FILTER_OPERATORS[operator](column, value))
+
+        for name, descending in sorting:
+            column = self.sorting[name]
+            if not is_indexed(column):
+                errors.append(jsonapi.format_error(status=400, title='Invalid sort',
+                                                   detail=f"sort: '{name}' would need an unindexed scan"))
+                continue
+            query = query.order_by(column.desc() if descending else column.asc())
+
+        if errors:
+            raise InvalidParameter(*errors)
+        return query
+
+    async def check_archived(self, request: Request) -> None:
+        """
+        Refuses a range of ?filter[created_at] of a partitioned model reaching months archived out of the ledger.
+        A range from a month archived by any database is refused, a list without a lower bound is not.
+        """
+        table = self.model.__tablename__
+        bounds = [request.args.get(f'filter[created_at][{operator}]') for operator in ('gte', 'lte')]
+        if table not in PARTITIONED_TABLES or not any(bounds):
+            return
+        try:
+            lower = parse_datetime(bounds[0] or bounds[1])
+        except ValueError:
+            # refused by filter_query
+            return
+        since = max((month for month in await request.ctx.shards.gather(
+            lambda shard: archived_before(shard, table)) if month), default=None)
+        if since is not None and lower < since:
+            raise ArchivedRange(table, month_start(lower.astimezone(timezone.utc)), since)
+
+    async def bump_versions(self, session, obj) -> None:
+        """
+        Bumps the versions of the data changed by creating the record, called in the transaction of the write
+        """
+        await bump_data_version(session, getattr(obj, 'user_id', None))
 
     async def get(self, request: Request, *args, **kwargs) -> response:
         """
-        Returns the list of records of the specified model.
+        Returns the list of records of the specified ledger model with the requested fields.
         For an administrator it returns all records, for a default user it returns records related to him.
+        The records of an administrator are read from every shard concurrently and merged in the order
+        of ?sort, by id by default. A filter on user_id reads only the shard of the user.
         Args:
             request: None
             *args: None
             **kwargs: token: JWT access token
         """
-        session = request.ctx.session
-        async with session.begin():
-            if kwargs['token'].role == 'Admin':
-                return await session.execute(self.query)
-            else:
-                return await session.execute(self.query.where(User.username == kwargs['token'].identity))
+        token = kwargs['token']
+        names, columns = self.fieldset(request)
+        fields = list(zip(names, columns))
+        session, shards = request.ctx.session, request.ctx.shards
+        await self.check_archived(request)
+        # the token of a deleted user is refused even before it expires
+        current_id = await current_user_id(request, token) if token.role != 'Admin' else None
+
+        if not shards.sharded:
+            query = self.filter_query(request, hide_deleted(
+                self.model, select_fields(self.model, self.references, fields, True), True))
+            if token.role != 'Admin':
+                query = query.where(self.model.user_id == current_id)
+            return await fetch_records(session, query)
+
+        sorting, errors = jsonapi.parse_sort(request.args, self.sorting)
+        query = self.filter_query(request, hide_deleted(self.model, select_fields(
+            self.model, self.references, fields, False, self.model.id.label('_id'),
+            *(self.sorting[name].label(f'_sort_{name}') for name, descending in sorting))))
+
+        user_id = request.args.get('filter[user_id]') or request.args.get('filter[user_id][eq]')
+        if token.role != 'Admin':
+            records = await fetch_records(shards.for_user(current_id), query.where(self.model.user_id == current_id))
+        elif user_id is not None:
+            records = await fetch_records(shards.for_user(int(user_id)), query)
+        else:
+            records = [record for result in await shards.gather(lambda shard: fetch_records(shard, query))
+                       for record in result]
+            for key, descending in [('_id', False)] + [(f'_sort_{name}', descending)
+                                                      for name, descending in reversed(sorting)]:
+                records.sort(key=itemgetter(key), reverse=descending)
+
+        await resolve_references(session, self.model, self.references, fields, records)
+        return [{name: record[name] for name in names} for record in records]
 
     async def post(self, request: Request, *args, **kwargs) -> response:
         """
         Creates a new record for the specified model
+        Args:
+            request: None
+            *args: None
+            **kwargs: body: the request body validated by @validate
 
         Returns: HTTP 201 Created and request body
         """
-        session = request.ctx.session
+        data = kwargs['body'].dict(exclude_unset=True)
+        session = request.ctx.shards.for_user(data['user_id']) if self.sharded else request.ctx.session
         async with session.begin():
-            obj = self.model(**request.json)
+            obj = self.model(**data)
             session.add(obj)
-        return json(request.json, status=201)
+            await self.bump_versions(session, obj)
+        return json(format_data(self.model, data), status=201)
 
 
 class BaseDetailAPI(HTTPMethodView):
@@ -57,6 +435,94 @@ class BaseDetailAPI(HTTPMethodView):
     def __init__(self):
         self.model = BaseModel
         self.query = None
+        self.resource = None
+        self.fields = {}
+        # ledger models are stored on the shard of their user and refer to global models
+        self.sharded = False
+        self.references = {}
+
+    def fieldset(self, request: Request) -> tuple:
+        """
+        Returns the names and columns of the fields requested for the resource
+        """
+        return requested_fields(request, self.resource, self.fields)
+
+    async def get_record(self, request: Request, pk: int) -> tuple:
+        """
+        Returns the names of the requested fields and the record of the ledger model with them
+        and the username of its owner, None if it does not exist.
+        The record is looked up on every shard concurrently.
+        """
+        names, columns = self.fieldset(request)
+        fields = list(zip(names, columns)) + [('owner', User.username)]
+        session, shards = request.ctx.session, request.ctx.shards
+        query = hide_deleted(self.model, select_fields(self.model, self.references, fields, not shards.sharded).
+                             where(self.model.id == pk), not shards.sharded)
+
+        if not shards.sharded:
+            records = await fetch_records(session, query)
+        else:
+            records = [record for result in await shards.gather(lambda shard: fetch_records(shard, query))
+                       for record in result]
+            await resolve_references(session, self.model, self.references, fields, records)
+        return names, records[0] if records else None
+
+    async def record_session(self, request: Request, pk: int, data: dict = None):
+        """
+        Returns the session of the database holding the record, the shard of data['user_id'] for a new record
+        """
+        shards = request.ctx.shards
+        if not self.sharded or not shards.sharded:
+            return request.ctx.session
+
+        async def exists(session):
+            async with session.begin():
+                record = await session.execute(select(self.model.id).where(self.model.id == pk))
+            return record.first() is not None
+
+        found = await shards.gather(exists)
+        if True in found:
+            session = shards.get(found.index(True))
+            if data and data.get('user_id') and shards.for_user(data['user_id']) is not session:
+                raise InvalidParameter(jsonapi.format_error(
+                    status=400, title='Invalid data', detail="user_id: records can not be moved between shards"))
+            return session
+        if data and data.get('user_id'):
+            return shards.for_user(data['user_id'])
+        # nothing to change, any shard answers as the global database would
+        return shards.get(0)
+
+    async def affected_users(self, session, pk: int, data: dict = None) -> list:
+        """
+        Returns ids of the users whose data is changed by writing the record
+        """
+        if not hasattr(self.model, 'user_id'):
+            return []
+        user_ids = await session.execute(select(self.model.user_id).where(self.model.id == pk))
+        user_ids = user_ids.scalars().all()
+        if data and data.get('user_id'):
+            user_ids.append(data.get('user_id'))
+        return user_ids
+
+    async def affected_bills(self, session, pk: int, data: dict = None) -> list:
+        """
+        Returns ids of the bills whose transactions or purchases are changed by writing the record
+        """
+        if not hasattr(self.model, 'bill_id'):
+            return []
+        bill_ids = await session.execute(select(self.model.bill_id).where(self.model.id == pk))
+        bill_ids = bill_ids.scalars().all()
+        if data and data.get('bill_id'):
+            bill_ids.append(data.get('bill_id'))
+        return bill_ids
+
+    async def bump_versions(self, session, pk: int, data: dict = None) -> None:
+        """
+        Bumps the versions of the data changed by writing the record and marks the changed bills
+        for the reconciliation, called in the transaction of the write
+        """
+        await bump_data_version(session, *await self.affected_users(session, pk, data))
+        await mark_bills_changed(session, *await self.affected_bills(session, pk, data))
 
     async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
@@ -64,41 +530,42 @@ class BaseDetailAPI(HTTPMethodView):
         """
         return empty()
 
-    @jwt_required(allow=['Admin'])
     async def put(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
-        Implements the PUT method for the REST API
+        Implements the PUT method for the REST API, the body is validated by the @validate of the subclass
         """
-        session = request.ctx.session
+        data = kwargs['body'].dict(exclude_unset=True)
+        session = await self.record_session(request, pk, data)
 
         async with session.begin():
-            data = await session.execute(select(self.model).where(self.model.id == pk))
-            if data.scalar_one_or_none():
-                await session.execute(update(self.model).values(**request.json).where(self.model.id == pk))
-                return json(request.json, status=200)
+            await self.bump_versions(session, pk, data)
+            record = await session.execute(select(self.model.id).where(self.model.id == pk))
+            if record.scalar_one_or_none():
+                await session.execute(update(self.model).values(**data).where(self.model.id == pk))
+                return json(format_data(self.model, data), status=200)
             else:
-                data = self.model(**request.json)
-                session.add(data)
-                return json(request.json, status=201)
+                session.add(self.model(**data))
+                return json(format_data(self.model, data), status=201)
 
-    @jwt_required(allow=['Admin'])
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
-        Implements the PATCH method for the REST API
+        Implements the PATCH method for the REST API, the body is validated by the @validate of the subclass
         """
-        session = request.ctx.session
+        data = kwargs['body'].dict(exclude_unset=True)
+        session = await self.record_session(request, pk, data)
 
         async with session.begin():
-            await session.execute(update(self.model).values(**request.json).where(self.model.id == pk))
-        return json(request.json, status=200)
+            await self.bump_versions(session, pk, data)
+            await session.execute(update(self.model).values(**data).where(self.model.id == pk))
+        return json(format_data(self.model, data), status=200)
 
-    @jwt_required(allow=['Admin'])
     async def delete(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements the DELETE method for the REST API
         """
-        session = request.ctx.session
+        session = await self.record_session(request, pk)
         async with session.begin():
+            await self.bump_versions(session, pk)
             await session.execute(delete(self.model).where(self.model.id == pk))
         return empty(status=200)
 
@@ -111,7 +578,17 @@ class ProductAPI(BaseAPI):
     def __init__(self):
         super().__init__()
         self.model = ProductModel
+        self.resource = 'products'
+        self.fields = {'id': ProductModel.id, 'title': ProductModel.title,
+                       'description': ProductModel.description, 'price': ProductModel.price}
+        self.filters = {'id': (ProductModel.id, ('eq', 'in')), 'price': (ProductModel.price, ('gte', 'lte'))}
+        self.sorting = {'id': ProductModel.id, 'price': ProductModel.price}
+
+    async def bump_versions(self, session, obj) -> None:
+        await bump_catalog_version(session)
 
+    @conditional_catalog
+    @coalesce
     async def get(self, request: Request, *args, **kwargs) -> response:
         """
         Returns the list of records of products.
@@ -120,16 +597,13 @@ class ProductAPI(BaseAPI):
         - title;
         - description;
         - price.
+        The fields can be restricted with ?fields[products]=id,title,price
+        The records can be filtered and sorted, e.g. ?filter[id][in]=1,2&sort=-id
         """
-        session = request.ctx.session
-        async with session.begin():
-            products = await session.execute(select(ProductModel).order_by(ProductModel.id))
-        products = products.scalars().all()
-        products = {
-            'products': [{'id': product.id, 'title': product.title,
-                          'description': product.description, 'price': product.price} for
-                         product in products]}
-        return json(products)
+        names, columns = self.fieldset(request)
+        query = select(*(column.label(name) for name, column in zip(names, columns)))
+        products = await fetch_records(request.ctx.session, self.filter_query(request, query).order_by(ProductModel.id))
+        return json({'products': products})
 
     @jwt_required(allow=['Admin'])
     @validate(json=ProductValidator)
@@ -142,14 +616,16 @@ class ProductAPI(BaseAPI):
             request: {
                 title: str = Field(max_length=50)
                 description: Optional[str]
-                price: float = Field(ge=0.0)
+                price: Money
                 }
             *args: None
             **kwargs: None
 
         Returns: HTTP 201 Created and request body
         """
-        return await super(ProductAPI, self).post(request, *args, **kwargs)
+        result = await super(ProductAPI, self).post(request, *args, **kwargs)
+        purge_catalog(request)
+        return result
 
 
 class ProductDetailAPI(BaseDetailAPI):
@@ -160,7 +636,51 @@ class ProductDetailAPI(BaseDetailAPI):
     def __init__(self):
         super().__init__()
         self.model = ProductModel
+        self.resource = 'products'
+        self.fields = {'id': ProductModel.id, 'title': ProductModel.title,
+                       'description': ProductModel.description, 'price': ProductModel.price}
+
+    async def affected_users(self, session, pk: int, data: dict = None) -> list:
+        """
+        Returns ids of the users who purchased the product, their purchases show its title
+        """
+        user_ids = await session.execute(select(PurchaseModel.user_id).where(PurchaseModel.product_id == pk).distinct())
+        return user_ids.scalars().all()
+
+    async def affected_bills(self, session, pk: int, data: dict = None) -> list:
+        """
+        Returns ids of the bills charged for the product when it is deleted, its purchases are deleted with it
+        """
+        if data is not None:
+            return []
+        bill_ids = await session.execute(select(PurchaseModel.bill_id).where(PurchaseModel.product_id == pk).distinct())
+        return bill_ids.scalars().all()
+
+    async def bump_versions(self, session, pk: int, data: dict = None) -> None:
+        # sharded purchases are in other databases, see sync_purchases
+        if not Sanic.get_app().ctx.shards.sharded:
+            await super(ProductDetailAPI, self).bump_versions(session, pk, data)
+        await bump_catalog_version(session)
+
+    async def sync_purchases(self, request: Request, pk: int, deleted: bool = False) -> None:
+        """
+        Bumps the data versions of the users who purchased the product on every shard after the product is written,
+        and deletes their purchases with the product as the foreign key of the global database would
+        """
+        if not request.ctx.shards.sharded:
+            return
 
+        async def sync(session):
+            async with session.begin():
+                await bump_data_version(session, *await self.affected_users(session, pk))
+                if deleted:
+                    await mark_bills_changed(session, *await self.affected_bills(session, pk))
+                    await session.execute(delete(PurchaseModel).where(PurchaseModel.product_id == pk))
+
+        await request.ctx.shards.gather(sync)
+
+    @conditional_catalog
+    @coalesce
     async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Returns detailed information about the product, namely:
@@ -168,15 +688,14 @@ class ProductDetailAPI(BaseDetailAPI):
         - title;
         - description;
         - price.
+        The fields can be restricted with ?fields[products]=id,title,price
         """
-        session = request.ctx.session
-        async with session.begin():
-            product = await session.execute(select(ProductModel).where(ProductModel.id == pk))
-        product = product.scalars().first()
-        if not product:
+        names, columns = self.fieldset(request)
+        query = select(*(column.label(name) for name, column in zip(names, columns))).where(ProductModel.id == pk)
+        products = await fetch_records(request.ctx.session, query)
+        if not products:
             return json({'status': 400, 'msg': 'Record does not exist'}, status=400)
-        product = {'id': product.id, 'title': product.title, 'description': product.description, 'price': product.price}
-        return json(product)
+        return json(products[0])
 
     @jwt_required(allow=['Admin'])
     @validate(json=ProductValidator)
@@ -190,14 +709,18 @@ class ProductDetailAPI(BaseDetailAPI):
             request: {
                 title: str = Field(max_length=50)
                 description: Optional[str]
-                price: float = Field(ge=0.0)
+                price: Money
                 }
 
         Returns: HTTP 200 OK | HTTP 201 Created
         """
-        return await super(ProductDetailAPI, self).put(request, pk, *args, **kwargs)
+        result = await super(ProductDetailAPI, self).put(request, pk, *args, **kwargs)
+        await self.sync_purchases(request, pk)
+        purge_catalog(request, pk)
+        return result
 
     @jwt_required(allow=['Admin'])
+    @validate(json=ProductPatchValidator)
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements PATCH method of REST API
@@ -208,12 +731,15 @@ class ProductDetailAPI(BaseDetailAPI):
             request: {
                 title: Optional[str] = Field(max_length=50)
                 description: Optional[str]
-                price: Optional[float] = Field(ge=0.0)
+                price: Optional[Money]
                 }
 
         Returns: HTTP 200 OK
         """
-        return await super(ProductDetailAPI, self).patch(request, pk, *args, **kwargs)
+        result = await super(ProductDetailAPI, self).patch(request, pk, *args, **kwargs)
+        await self.sync_purchases(request, pk)
+        purge_catalog(request, pk)
+        return result
 
     @jwt_required(allow=['Admin'])
     async def delete(self, request: Request, pk: int, *args, **kwargs) -> response:
@@ -221,7 +747,80 @@ class ProductDetailAPI(BaseDetailAPI):
         Implements DELETE method of REST API
         Requires JWT access token and administrator rights
         """
-        return await super(ProductDetailAPI, self).delete(request, pk, *args, **kwargs)
+        result = await super(ProductDetailAPI, self).delete(request, pk, *args, **kwargs)
+        await self.sync_purchases(request, pk, deleted=True)
+        purge_catalog(request, pk)
+        return result
+
+
+class ProductSearchAPI(HTTPMethodView):
+    """
+    REST API for the full-text search of products
+    """
+
+    def __init__(self):
+        self.resource = 'products'
+        self.fields = {'id': ProductModel.id, 'title': ProductModel.title,
+                       'description': ProductModel.description, 'price': ProductModel.price}
+
+    @staticmethod
+    def rank(q: str):
+        """
+        Returns the rank of a product and the condition of a match for the query.
+        Products match on the title and description words, titles starting with a query of
+        3 characters or more also match through the trigram index and rank above the others.
+        """
+        query = func.websearch_to_tsquery(SEARCH_CONFIG, q)
+        rank = func.ts_rank_cd(ProductModel.search_vector, query)
+        match = ProductModel.search_vector.op('@@')(query)
+        if len(q) >= 3:
+            prefix = q.replace('/', '//').replace('%', '/%').replace('_', '/_') + '%'
+            starts = ProductModel.title.ilike(prefix, escape='/')
+            rank = rank + case((starts, 1), else_=0)
+            match = or_(match, starts)
+        return cast(rank, REAL), match
+
+    @conditional_catalog
+    @coalesce
+    async def get(self, request: Request, *args, **kwargs) -> response:
+        """
+        Returns the products matching ?q=, the best ranked first, e.g. ?q=red chair&page[size]=20
+        The query supports the web search syntax: "quoted phrases", or, -excluded words.
+        Each record consists of the requested fields, see ProductAPI.
+        The next page is requested with the page[after] cursor given in links.next.
+        """
+        q = request.args.get('q', '').strip()
+        size, after, errors = jsonapi.parse_page(request.args)
+        if not q:
+            errors.append(jsonapi.format_error(status=400, title='Invalid parameter', detail="q: is required"))
+        if after is not None and not (isinstance(after, list) and len(after) == 2 and
+                                      isinstance(after[0], (int, float)) and isinstance(after[1], int)):
+            errors.append(jsonapi.format_error(status=400, title='Invalid page', detail="page[after]: invalid cursor"))
+        names, columns = requested_fields(request, self.resource, self.fields)
+        if errors:
+            raise InvalidParameter(*errors)
+
+        rank, match = self.rank(q)
+        query = select(*(column.label(name) for name, column in zip(names, columns)),
+                       ProductModel.id.label('cursor_id'), rank.label('cursor_rank')).where(match)
+        if after is not None:
+            # keyset paging on (rank, id), a page costs the same however deep it is
+            after_rank, after_id = cast(after[0], REAL), after[1]
+            query = query.where(or_(rank < after_rank, and_(rank == after_rank, ProductModel.id > after_id)))
+        query = query.order_by(rank.desc(), ProductModel.id).limit(size + 1)
+
+        products = await fetch_records(request.ctx.session, query)
+
+        links = {'next': None}
+        if len(products) > size:
+            products = products[:size]
+            last = products[-1]
+            parameters = [(name, value) for name, values in request.args.items() if name != 'page[after]'
+                          for value in values]
+            parameters.append(('page[after]', jsonapi.encode_cursor(last['cursor_rank'], last['cursor_id'])))
+            links['next'] = f'{request.path}?{urlencode(parameters)}'
+        products = [{name: product[name] for name in names} for product in products]
+        return json({'products': products, 'links': links})
 
 
 class CustomerBillAPI(BaseAPI):
@@ -232,8 +831,18 @@ class CustomerBillAPI(BaseAPI):
     def __init__(self):
         super().__init__()
         self.model = CustomerBillModel
+        self.resource = 'bills'
+        self.fields = {'id': CustomerBillModel.id, 'user_id': CustomerBillModel.user_id, 'username': User.username,
+                       'balance': CustomerBillModel.balance}
+        self.filters = {'id': (CustomerBillModel.id, ('eq', 'in')),
+                        'user_id': (CustomerBillModel.user_id, ('eq', 'in'))}
+        self.sorting = {'id': CustomerBillModel.id}
+        self.sharded = True
+        self.references = {User: CustomerBillModel.user_id}
 
     @jwt_required
+    @coalesce
+    @cached_per_user
     async def get(self, request: Request, *args, **kwargs) -> response:
         """
         Returns the list of records of the customer bills.
@@ -243,13 +852,11 @@ class CustomerBillAPI(BaseAPI):
         - username, which is taken from the associated User table;
         - balance.
         For an administrator it returns all records, for a default user it returns records related to him.
+        The fields can be restricted with ?fields[bills]=id,balance
+        The records can be filtered and sorted, e.g. ?filter[id][in]=1,2&sort=-id
         """
-        self.query = select(CustomerBillModel, User.username).join(User, User.id == CustomerBillModel.user_id)
         bills = await super(CustomerBillAPI, self).get(request, *args, **kwargs)
-        bills = bills.all()
-        bills = {'bills': [{'id': bill.id, 'user_id': bill.user_id, "username": username, 'balance': bill.balance} for
-                           bill, username in bills]}
-        return json(bills)
+        return json({'bills': bills})
 
     @jwt_required
     @validate(json=CustomerBillValidator)
@@ -261,23 +868,65 @@ class CustomerBillAPI(BaseAPI):
         Args:
             request: {
                 user_id: int
-                balance: float = Field(ge=0.0)
+                balance: Money
                 }
             *args:
             **kwargs:
 
         Returns: HTTP 201 Created and request body
         """
-        if (not kwargs['token'].role == 'Admin') or (not request.json.get('user_id')):
-            session = request.ctx.session
-            async with session.begin():
-                user = await session.execute(select(User).where(User.username == kwargs['token'].identity))
-            user = user.scalars().first()
-            request.json.update({'user_id': user.id})
-            request.json.update({'balance': 0.0})
+        body = kwargs['body']
+        if (not kwargs['token'].role == 'Admin') or (not body.user_id):
+            body.user_id = await current_user_id(request, kwargs['token'])
+            body.balance = 0
         return await super(CustomerBillAPI, self).post(request, *args, **kwargs)
 
 
+class BillEventsAPI(HTTPMethodView):
+    """
+    Server-Sent Events stream of the balance changes of customer bills
+    """
+
+    @jwt_required
+    async def get(self, request: Request, *args, **kwargs) -> response:
+        """
+        Streams a balance event when a transaction or a purchase changing a bill of the user commits,
+        the bills of all users for an administrator.
+        Each event consists of:
+        - event id;
+        - user_id;
+        - bill_id;
+        - balance.
+        A reconnecting client resumes after its Last-Event-ID header, a reset event asks it to reload
+        its bills when the events since are no longer known.
+        A heartbeat comment is sent every EVENTS_HEARTBEAT seconds without events.
+        """
+        key = None
+        if kwargs['token'].role != 'Admin':
+            key = await current_user_id(request, kwargs['token'])
+
+        hub = request.app.ctx.events
+        subscription, backlog = hub.subscribe(key, request.headers.get('last-event-id'))
+        try:
+            # the session, the admission slot and the trace are released once the headers are sent
+            stream = await request.respond(content_type='text/event-stream',
+                                           headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            await stream.send(events.format_event(retry=1000, comment='connected'))
+            if backlog is None:
+                await stream.send(events.format_event({}, event='reset'))
+            for event in backlog or ():
+                await stream.send(events.format_event(event, event='balance', event_id=event['id']))
+
+            async for event in subscription.events(request.app.config.EVENTS_HEARTBEAT):
+                if event is None:
+                    await stream.send(events.format_event(comment='heartbeat'))
+                else:
+                    await stream.send(events.format_event(event, event='balance', event_id=event['id']))
+            await stream.eof()
+        finally:
+            hub.close(subscription)
+
+
 class CustomerBillDetailAPI(BaseDetailAPI):
     """
     REST API for getting detailed information on a customer bill and editing it
@@ -286,8 +935,14 @@ class CustomerBillDetailAPI(BaseDetailAPI):
     def __init__(self):
         super().__init__()
         self.model = CustomerBillModel
+        self.resource = 'bills'
+        self.fields = {'id': CustomerBillModel.id, 'user_id': CustomerBillModel.user_id, 'username': User.username,
+                       'balance': CustomerBillModel.balance}
+        self.sharded = True
+        self.references = {User: CustomerBillModel.user_id}
 
     @jwt_required
+    @coalesce
     async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Returns detailed information about the customer bill, namely:
@@ -297,18 +952,13 @@ class CustomerBillDetailAPI(BaseDetailAPI):
         - balance.
         If the user is not the administrator and the record is not associated with the user, it returns an access error.
         If the record does not exist returns a missing data error.
+        The fields can be restricted with ?fields[bills]=id,balance
         """
-        session = request.ctx.session
-        async with session.begin():
-            bill = await session.execute(
-                select(CustomerBillModel, User.username).join(User, User.id == CustomerBillModel.user_id).where(
-                    CustomerBillModel.id == pk))
+        names, bill = await self.get_record(request, pk)
         if not bill:
             return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
-        bill, username = bill.first()
-        if (kwargs['token'].role == 'Admin') or (username == kwargs['token'].identity):
-            bill = {'id': bill.id, 'user_id': bill.user_id, "username": username, 'balance': bill.balance}
-            return json(bill)
+        if (kwargs['token'].role == 'Admin') or (bill['owner'] == kwargs['token'].identity):
+            return json({name: bill[name] for name in names})
         else:
             return empty(status=403)
 
@@ -323,7 +973,7 @@ class CustomerBillDetailAPI(BaseDetailAPI):
             pk: int
             request: {
                 user_id: int
-                balance: float = Field(ge=0.0)
+                balance: Money
                 }
 
         Returns: HTTP 200 OK | HTTP 201 Created
@@ -331,6 +981,7 @@ class CustomerBillDetailAPI(BaseDetailAPI):
         return await super(CustomerBillDetailAPI, self).put(request, pk, *args, **kwargs)
 
     @jwt_required(allow=['Admin'])
+    @validate(json=CustomerBillValidator)
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements PATCH method of REST API
@@ -340,20 +991,40 @@ class CustomerBillDetailAPI(BaseDetailAPI):
             pk: int
             request: {
                 user_id: Optional[int]
-                balance: Optional[float] = Field(ge=0.0)
+                balance: Optional[Money]
                 }
 
         Returns: HTTP 200 OK
         """
-        return await super(CustomerBillDetailAPI, self).patch(request, pk, pk, *args, **kwargs)
+        return await super(CustomerBillDetailAPI, self).patch(request, pk, *args, **kwargs)
 
     @jwt_required(allow=['Admin'])
     async def delete(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements DELETE method of REST API
         Requires JWT access token and administrator rights
+        The bill is hidden at once, it is deleted with its transactions and purchases by batches in the background,
+        the progress is given by GET /v1/api/deletions/<id>. Deleting it again gives the same deletion.
+
+        Returns: HTTP 202 Accepted and the id of the deletion
         """
-        return await super(CustomerBillDetailAPI, self).delete(request, pk, *args, **kwargs)
+        session, global_session = await self.record_session(request, pk), request.ctx.session
+        async with session.begin():
+            bill = await session.execute(update(CustomerBillModel).values(deleted_at=func.now()).
+                                         where(CustomerBillModel.id == pk, CustomerBillModel.deleted_at.is_(None)).
+                                         returning(CustomerBillModel.user_id))
+            user_id = bill.scalar_one_or_none()
+            if user_id is not None:
+                await self.bump_versions(session, pk)
+
+        # the deletion is scheduled once the bill is marked, a deletion of a bill not marked is cancelled,
+        # a bill marked deleted before is not scheduled again
+        async with global_session.begin():
+            deletion = await (schedule_deletion(global_session, 'bill', pk, user_id) if user_id is not None else
+                              scheduled_deletion(global_session, 'bill', pk))
+        if deletion is None:
+            return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
+        return json({'deletion': deletion.id}, status=202, headers={'Location': f'/v1/api/deletions/{deletion.id}'})
 
 
 class TransactionAPI(BaseAPI):
@@ -364,8 +1035,23 @@ class TransactionAPI(BaseAPI):
     def __init__(self):
         super().__init__()
         self.model = TransactionModel
+        self.resource = 'transactions'
+        self.fields = {'transaction': TransactionModel.id, 'user_id': TransactionModel.user_id,
+                       'username': User.username, 'bill_id': TransactionModel.bill_id,
+                       'amount': TransactionModel.amount, 'created_at': TransactionModel.created_at}
+        self.filters = {'transaction': (TransactionModel.id, ('eq', 'in')),
+                        'user_id': (TransactionModel.user_id, ('eq', 'in')),
+                        'bill_id': (TransactionModel.bill_id, ('eq', 'in')),
+                        'amount': (TransactionModel.amount, ('gte', 'lte')),
+                        'created_at': (TransactionModel.created_at, ('gte', 'lte'))}
+        self.sorting = {'transaction': TransactionModel.id, 'amount': TransactionModel.amount,
+                        'created_at': TransactionModel.created_at}
+        self.sharded = True
+        self.references = {User: TransactionModel.user_id}
 
     @jwt_required
+    @coalesce
+    @cached_per_user
     async def get(self, request: Request, *args, **kwargs) -> response:
         """
         Returns the list of records of the transactions.
@@ -374,16 +1060,16 @@ class TransactionAPI(BaseAPI):
         - user_id;
         - username, which is taken from the associated User table;
         - bill_id,
-        - amount.
+        - amount,
+        - created_at.
         For an administrator it returns all records, for a default user it returns records related to him.
+        The fields can be restricted with ?fields[transactions]=transaction,amount
+        The records can be filtered and sorted, e.g. ?filter[bill_id][in]=1,2&sort=-amount
+        A filter on created_at reads only the partitions of the months it covers,
+        a range reaching archived months is answered with 409 Conflict
         """
-        self.query = select(TransactionModel, User.username).join(User, User.id == TransactionModel.user_id)
         transactions = await super(TransactionAPI, self).get(request, *args, **kwargs)
-        transactions = transactions.all()
-        transactions = {'transactions': [
-            {'transaction': transaction.id, 'user_id': transaction.user_id, "username": username,
-             'bill_id': transaction.bill_id, 'amount': transaction.amount} for transaction, username in transactions]}
-        return json(transactions)
+        return json({'transactions': transactions})
 
     @jwt_required(allow=['Admin'])
     @validate(json=TransactionValidator)
@@ -397,22 +1083,21 @@ class TransactionAPI(BaseAPI):
             request: {
                 user_id: int
                 bill_id: int
-                amount: float = Field(ge=0.0)
+                amount: Money
                 }
             *args:
             **kwargs:
 
         Returns: HTTP 201 Created and request body
         """
-        session = request.ctx.session
-        async with session.begin():
-            bill = await session.execute(
-                select(CustomerBillModel).where(CustomerBillModel.id == request.json.get('bill_id')))
-            bill = bill.scalars().first()
-            await session.execute(update(CustomerBillModel).values(
-                {'balance': Decimal(bill.balance) + Decimal(request.json.get('amount'))}).where(
-                CustomerBillModel.id == request.json.get('bill_id')))
-        return await super(TransactionAPI, self).post(request, *args, **kwargs)
+        body = kwargs['body']
+        ledger = request.ctx.shards.for_user(body.user_id)
+        try:
+            async with ledger.begin():
+                await create_transaction(ledger, body)
+        except ServiceError as error:
+            return json({'status': error.status, 'msg': str(error)}, status=error.status)
+        return json(format_data(TransactionModel, body.dict()), status=201)
 
 
 class TransactionDetailAPI(BaseDetailAPI):
@@ -423,8 +1108,15 @@ class TransactionDetailAPI(BaseDetailAPI):
     def __init__(self):
         super().__init__()
         self.model = TransactionModel
+        self.resource = 'transactions'
+        self.fields = {'transaction': TransactionModel.id, 'user_id': TransactionModel.user_id,
+                       'username': User.username, 'bill_id': TransactionModel.bill_id,
+                       'amount': TransactionModel.amount, 'created_at': TransactionModel.created_at}
+        self.sharded = True
+        self.references = {User: TransactionModel.user_id}
 
     @jwt_required
+    @coalesce
     async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Returns detailed information about the transaction, namely:
@@ -432,22 +1124,17 @@ class TransactionDetailAPI(BaseDetailAPI):
         - user_id;
         - username, which is taken from the associated User table;
         - bill_id,
-        - amount.
+        - amount,
+        - created_at.
         If the user is not the administrator and the record is not associated with the user, it returns an access error.
         If the record does not exist returns a missing data error.
+        The fields can be restricted with ?fields[transactions]=transaction,amount
         """
-        session = request.ctx.session
-        async with session.begin():
-            transaction = await session.execute(
-                select(TransactionModel, User.username).join(User, User.id == TransactionModel.user_id).where(
-                    TransactionModel.id == pk))
+        names, transaction = await self.get_record(request, pk)
         if not transaction:
             return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
-        transaction, username = transaction.first()
-        if (kwargs['token'].role == 'Admin') or (username == kwargs['token'].identity):
-            transaction = {'transaction': transaction.id, 'user_id': transaction.user_id, "username": username,
-                           'bill_id': transaction.bill_id, 'amount': transaction.amount}
-            return json(transaction)
+        if (kwargs['token'].role == 'Admin') or (transaction['owner'] == kwargs['token'].identity):
+            return json({name: transaction[name] for name in names})
         else:
             return empty(status=403)
 
@@ -463,7 +1150,7 @@ class TransactionDetailAPI(BaseDetailAPI):
             request: {
                 user_id: int
                 bill_id: int
-                amount: float = Field(ge=0.0)
+                amount: Money
                 }
 
         Returns: HTTP 200 OK | HTTP 201 Created
@@ -471,6 +1158,7 @@ class TransactionDetailAPI(BaseDetailAPI):
         return await super(TransactionDetailAPI, self).put(request, pk, *args, **kwargs)
 
     @jwt_required(allow=['Admin'])
+    @validate(json=TransactionPatchValidator)
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements PATCH method of REST API
@@ -481,7 +1169,7 @@ class TransactionDetailAPI(BaseDetailAPI):
             request: {
                 user_id: Optional[int]
                 bill_id: Optional[int]
-                amount: Optional[float] = Field(ge=0.0)
+                amount: Optional[Money]
                 }
 
         Returns: HTTP 200 OK
@@ -505,8 +1193,22 @@ class PurchaseAPI(BaseAPI):
     def __init__(self):
         super().__init__()
         self.model = PurchaseModel
+        self.resource = 'purchases'
+        self.fields = {'id': PurchaseModel.id, 'product_id': PurchaseModel.product_id, 'title': ProductModel.title,
+                       'user_id': PurchaseModel.user_id, 'username': User.username,
+                       'bill_id': PurchaseModel.bill_id, 'created_at': PurchaseModel.created_at}
+        self.filters = {'id': (PurchaseModel.id, ('eq', 'in')),
+                        'user_id': (PurchaseModel.user_id, ('eq', 'in')),
+                        'bill_id': (PurchaseModel.bill_id, ('eq', 'in')),
+                        'product_id': (PurchaseModel.product_id, ('eq', 'in')),
+                        'created_at': (PurchaseModel.created_at, ('gte', 'lte'))}
+        self.sorting = {'id': PurchaseModel.id, 'created_at': PurchaseModel.created_at}
+        self.sharded = True
+        self.references = {ProductModel: PurchaseModel.product_id, User: PurchaseModel.user_id}
 
     @jwt_required
+    @coalesce
+    @cached_per_user
     async def get(self, request: Request, *args, **kwargs) -> response:
         """
         Returns the list of records of the purchases.
@@ -516,18 +1218,16 @@ class PurchaseAPI(BaseAPI):
         - title, which is taken from the associated Product table;
         - user_id;
         - username, which is taken from the associated User table;
-        - bill_id.
+        - bill_id;
+        - created_at.
         For an administrator it returns all records, for a default user it returns records related to him.
+        The fields can be restricted with ?fields[purchases]=id,title
+        The records can be filtered and sorted, e.g. ?filter[id][in]=1,2&sort=-id
+        A filter on created_at reads only the partitions of the months it covers,
+        a range reaching archived months is answered with 409 Conflict
         """
-        self.query = select(PurchaseModel, ProductModel.title, User.username). \
-            join(ProductModel, ProductModel.id == PurchaseModel.product_id). \
-            join(User, User.id == PurchaseModel.user_id)
         purchases = await super(PurchaseAPI, self).get(request, *args, **kwargs)
-        purchases = purchases.all()
-        purchases = {'purchases': [
-            {'id': purchase.id, 'product_id': purchase.product_id, 'title': title, 'user_id': purchase.user_id,
-             "username": username, 'bill_id': purchase.bill_id} for purchase, title, username in purchases]}
-        return json(purchases)
+        return json({'purchases': purchases})
 
     @jwt_required
     @validate(json=PurchaseValidator)
@@ -549,28 +1249,22 @@ class PurchaseAPI(BaseAPI):
 
         Returns: HTTP 201 Created and request body
         """
-        session = request.ctx.session
+        body = kwargs['body']
+        if (not kwargs['token'].role == 'Admin') or (not body.user_id):
+            body.user_id = await current_user_id(request, kwargs['token'])
 
+        session = request.ctx.session
         async with session.begin():
-            if (not kwargs['token'].role == 'Admin') or (not request.json.get('user_id')):
-                user = await session.execute(select(User).where(User.username == kwargs['token'].identity))
-                user = user.scalars().first()
-                request.json.update({'user_id': user.id})
+            price = await session.execute(select(ProductModel.price).where(ProductModel.id == body.product_id))
+        price = price.scalar_one_or_none()
 
-            bill = await session.execute(
-                select(CustomerBillModel).where(CustomerBillModel.id == request.json.get('bill_id')))
-            bill = bill.scalars().first()
-
-            product = await session.execute(
-                select(ProductModel).where(ProductModel.id == request.json.get('product_id')))
-            product = product.scalars().first()
-
-            if bill.balance < product.price:
-                return json({'status': 400, 'msg': 'Not enough money to purchase'}, status=400)
-
-            await session.execute(update(CustomerBillModel).values({'balance': bill.balance - product.price}).where(
-                CustomerBillModel.id == request.json.get('bill_id')))
-        return await super(PurchaseAPI, self).post(request, *args, **kwargs)
+        ledger = request.ctx.shards.for_user(body.user_id)
+        try:
+            async with ledger.begin():
+                await create_purchase(ledger, body, price)
+        except ServiceError as error:
+            return json({'status': error.status, 'msg': str(error)}, status=error.status)
+        return json(body.dict(), status=201)
 
 
 class PurchaseDetailAPI(BaseDetailAPI):
@@ -581,8 +1275,15 @@ class PurchaseDetailAPI(BaseDetailAPI):
     def __init__(self):
         super().__init__()
         self.model = PurchaseModel
+        self.resource = 'purchases'
+        self.fields = {'id': PurchaseModel.id, 'product_id': PurchaseModel.product_id, 'title': ProductModel.title,
+                       'user_id': PurchaseModel.user_id, 'username': User.username,
+                       'bill_id': PurchaseModel.bill_id, 'created_at': PurchaseModel.created_at}
+        self.sharded = True
+        self.references = {ProductModel: PurchaseModel.product_id, User: PurchaseModel.user_id}
 
     @jwt_required
+    @coalesce
     async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Returns detailed information about the purchase, namely:
@@ -591,31 +1292,17 @@ class PurchaseDetailAPI(BaseDetailAPI):
         - title, which is taken from the associated Product table;
         - user_id;
         - username, which is taken from the associated User table;
-        - bill_id.
+        - bill_id;
+        - created_at.
         If the user is not the administrator and the record is not associated with the user, it returns an access error.
         If the record does not exist returns a missing data error.
+        The fields can be restricted with ?fields[purchases]=id,title
         """
-        session = request.ctx.session
-        async with session.begin():
-            if kwargs['token'].role == 'Admin':
-                purchase = await session.execute(
-                    select(PurchaseModel, ProductModel.title, User.username). \
-                        join(ProductModel, ProductModel.id == PurchaseModel.product_id). \
-                        join(User, User.id == PurchaseModel.user_id). \
-                        where(PurchaseModel.id == pk))
-            else:
-                purchase = await session.execute(
-                    select(PurchaseModel, ProductModel.title, User.username). \
-                        join(ProductModel, ProductModel.id == PurchaseModel.product_id). \
-                        join(User, User.id == PurchaseModel.user_id). \
-                        where(PurchaseModel.id == pk, User.username == kwargs['token'].identity))
+        names, purchase = await self.get_record(request, pk)
         if not purchase:
             return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
-        purchase, title, username = purchase.first()
-        if (kwargs['token'].role == 'Admin') or (username == kwargs['token'].identity):
-            purchase = {'id': purchase.id, 'user_id': purchase.user_id, "username": username,
-                        'product_id': purchase.product_id, 'title': title, 'bill_id': purchase.bill_id}
-            return json(purchase)
+        if (kwargs['token'].role == 'Admin') or (purchase['owner'] == kwargs['token'].identity):
+            return json({name: purchase[name] for name in names})
         else:
             return empty(status=403)
 
@@ -638,6 +1325,7 @@ class PurchaseDetailAPI(BaseDetailAPI):
         return await super(PurchaseDetailAPI, self).put(request, pk, *args, **kwargs)
 
     @jwt_required(allow=['Admin'])
+    @validate(json=PurchasePatchValidator)
     async def patch(self, request: Request, pk: int, *args, **kwargs) -> response:
         """
         Implements PATCH method of REST API
@@ -661,3 +1349,28 @@ class PurchaseDetailAPI(BaseDetailAPI):
         Requires JWT access token and administrator rights
         """
         return await super(PurchaseDetailAPI, self).delete(request, pk, *args, **kwargs)
+
+
+class DeletionDetailAPI(HTTPMethodView):
+    """
+    REST API for following the background deletion of a user or a bill
+    """
+
+    @jwt_required(allow=['Admin'])
+    async def get(self, request: Request, pk: int, *args, **kwargs) -> response:
+        """
+        Returns the deletion, namely:
+        - deletion id;
+        - kind, user or bill, and target_id, the id of the user or bill;
+        - status: pending, done or cancelled;
+        - total: rows of the ledger to delete, empty until the deletion starts;
+        - deleted: rows of the ledger deleted so far;
+        - created_at and finished_at.
+        Requires JWT access token and administrator rights
+        """
+        columns = [DeletionModel.id, DeletionModel.kind, DeletionModel.target_id, DeletionModel.status,
+                   DeletionModel.total, DeletionModel.deleted, DeletionModel.created_at, DeletionModel.finished_at]
+        records = await fetch_records(request.ctx.session, select(*columns).where(DeletionModel.id == pk))
+        if not records:
+            return json({'status': 404, 'msg': 'Record does not exist'}, status=404)
+        return json(records[0])
@@ -0,0 +1,9 @@
+from sanic import Blueprint
+
+import apps.health.views as views
+
+blueprint = Blueprint('health_app', url_prefix='/health')
+
+# probes of the orchestrator are never queued by the admission control
+blueprint.add_route(views.live, '/live', methods=['GET'], ctx_admission=False)
+blueprint.add_route(views.ready, '/ready', methods=['GET'], ctx_admission=False)
@@ -0,0 +1,100 @@
+import asyncio
+from http import HTTPStatus
+from os import getpid
+from time import time
+
+from sanic import Request, response
+from sanic.response import json
+from sqlalchemy.exc import SQLAlchemyError
+
+from apps.dimatech.views import response_cache, catalog_version
+from core.helpers.breaker import CircuitOpen
+from core.helpers.cache import CachedValue
+from core.helpers.coalescing import coalescer
+
+NO_STORE = {'Cache-Control': 'no-store'}
+
+database_probe = CachedValue()
+
+
+async def check_database(engine, timeout):
+    """Runs SELECT 1 on a connection of the pool
+
+    Returns:
+        A dictionary of whether it succeeded, the error and when it was checked
+    """
+    async def probe():
+        async with engine.connect() as connection:
+            await connection.exec_driver_sql('SELECT 1')
+
+    try:
+        await asyncio.wait_for(probe(), timeout)
+    except (OSError, asyncio.TimeoutError, SQLAlchemyError, CircuitOpen) as exception:
+        return {'ok': False, 'error': repr(exception), 'checked_at': time()}
+    return {'ok': True, 'error': None, 'checked_at': time()}
+
+
+async def check_databases(app):
+    """Probes the global database and the shards of the ledger concurrently, ok when all of them answer"""
+    timeout = app.config.HEALTH_PROBE_TIMEOUT
+    result, *shards = await asyncio.gather(
+        *(check_database(engine, timeout) for engine in [app.ctx.engine, *app.ctx.shard_engines]))
+    if shards:
+        result['ok'] = result['ok'] and all(shard['ok'] for shard in shards)
+        result['shards'] = shards
+    return result
+
+
+async def probe_database(app):
+    """Result of the database probe, run at most once per HEALTH_PROBE_TTL by a worker"""
+    result = database_probe.get()
+    if result is None:
+        result = await coalescer.run(('health', 'database'), lambda: check_databases(app))
+        database_probe.set(result, app.config.HEALTH_PROBE_TTL)
+    return result
+
+
+async def live(request: Request, *args, **kwargs) -> response:
+    """
+    Liveness of the worker, answered without touching the database.
+
+    Returns: {status, pid}
+    """
+    return json({'status': 'ok', 'pid': getpid()}, headers=NO_STORE)
+
+
+async def ready(request: Request, *args, **kwargs) -> response:
+    """
+    Readiness of the worker: 200 when the databases answer the cached probe, 503 otherwise.
+
+    Returns: {status, pid, database, pool, warmup, caches, admission}
+    """
+    app = request.app
+    database = await probe_database(app)
+    pool = app.ctx.engine.sync_engine.pool
+    admission = app.ctx.admission
+    status = HTTPStatus.OK if database['ok'] else HTTPStatus.SERVICE_UNAVAILABLE
+    return json({
+        'status': 'ready' if database['ok'] else 'unavailable',
+        'pid': getpid(),
+        'database': database,
+        'pool': {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(0, pool.overflow()),
+            'max_overflow': app.config.DB_MAX_OVERFLOW,
+        },
+        'warmup': {
+            'warm': app.ctx.warm,
+            'first_request': app.ctx.first_request,
+        },
+        'caches': {
+            'responses': len(response_cache),
+            'responses_max': response_cache.maxsize,
+            'catalog_version': catalog_version.get() is not None,
+        },
+        'admission': {
+            'inflight': admission.inflight,
+            'queued': admission.queued,
+        },
+    }, status=status, headers=NO_STORE)
@@ -4,4 +4,5 @@ import apps.payment.views as views
 
 blueprint = Blueprint('payment_app', url_prefix='/payment', version=1)
 
-blueprint.add_route(views.transaction_webhook, '/webhook', methods=['POST'])
+blueprint.add_route(views.transaction_webhook, '/webhook', methods=['POST'], ctx_admission='webhooks',
+                    ctx_deadline=15)
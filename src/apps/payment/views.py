@@ -1,19 +1,22 @@
 from Crypto.Hash import SHA1
 from sanic import Sanic
-from sanic.response import json, empty
+from sanic.response import json
 from sanic_ext import validate
 from sqlalchemy import select
 
 from apps.dimatech.models import CustomerBillModel
-from apps.dimatech.validators import TransactionValidator
-from apps.dimatech.views import TransactionAPI
+from apps.dimatech.services import ServiceError, bump_data_version, create_transaction
+from apps.dimatech.validators import TransactionWebhookValidator
+from core.helpers.tracing import tracer
 
 
-@validate(json=TransactionValidator)
+@validate(json=TransactionWebhookValidator)
 async def transaction_webhook(request, *args, **kwargs):
     """
     Webhook processes transactions from an external service.
     Checks the integrity of the data by signature, creates a new customer bill if it does not exist.
+    A new bill gets an id of the sequence of the shard, not the posted bill_id, and is credited instead.
+    The bill and the transaction are created in one database transaction.
 
     Args:
         request: {
@@ -21,31 +24,40 @@ async def transaction_webhook(request, *args, **kwargs):
             transaction_id: int
             user_id: int
             bill_id: int
-            amount: float = Field(ge=0.0)
+            amount: Money, in major units
         }
         *args: None
-        **kwargs: None
+        **kwargs: body: the request body validated by @validate
 
-    Returns: the transaction status.
+    Returns: HTTP 201 Created and the id of the credited bill.
     """
+    body = kwargs['body']
+
+    # signed as sent by the service, the validated amount may be formatted differently
     sign_data = f"{Sanic.get_app().config.SIGNING_KEY}:{request.json.get('transaction_id')}:" \
                 f"{request.json.get('user_id')}:{request.json.get('bill_id')}:{request.json.get('amount')}"
     signature = SHA1.new()
     signature.update(sign_data.encode())
     signature = signature.hexdigest()
 
-    if signature != request.json.pop('signature'):
+    if signature != body.signature:
         return json({'status': 400, 'message': 'Wrong data'}, status=400)
 
-    session = request.ctx.session
-    async with session.begin():
-        bill = await session.execute(
-            select(CustomerBillModel).where(CustomerBillModel.id == int(request.json.get('bill_id'))))
-        if not bill.first():
-            obj = CustomerBillModel(user_id=request.json.get('user_id'))
-            session.add(obj)
-
-    request.json.pop('transaction_id')
-
-    await TransactionAPI().post(request)
-    return empty(status=201)
+    ledger = request.ctx.shards.for_user(body.user_id)
+    try:
+        async with ledger.begin():
+            bill = await ledger.execute(select(CustomerBillModel.id).where(CustomerBillModel.id == body.bill_id))
+            if bill.first() is None:
+                # a posted id would skip the sequence, a later bill could draw it or it could fall
+                # in the id range of another shard
+                bill = CustomerBillModel(user_id=body.user_id)
+                ledger.add(bill)
+                await ledger.flush()
+                body.bill_id = bill.id
+                await bump_data_version(ledger, body.user_id)
+
+            with tracer.span('create_transaction'):
+                await create_transaction(ledger, body)
+    except ServiceError as error:
+        return json({'status': error.status, 'message': str(error)}, status=error.status)
+    return json({'bill_id': body.bill_id}, status=201)
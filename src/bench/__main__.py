@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import signal
+import subprocess
+import sys
+from itertools import cycle
+from os.path import dirname
+from time import perf_counter
+
+import aiohttp
+import asyncpg
+
+from bench.load import Client, load, login
+
+# seconds the statistics of the database take to include the transactions of the last requests
+STATS_DELAY = 1.5
+WORDS = ['oak', 'walnut', 'chair', 'table', 'lamp', 'sofa', 'red', 'blue', 'steel', 'glass', 'shelf', 'desk',
+         'linen', 'velvet', 'marble', 'copper']
+SEED_PRODUCTS = """
+INSERT INTO product (title, description, price_minor)
+SELECT words[1 + i % n] || ' ' || words[1 + (i / n) % n] || ' ' || i,
+       'bench ' || words[1 + (i / 7) % n] || ' ' || words[1 + (i / 13) % n], 100 + i % 10000
+FROM generate_series(1, $1) AS i, (SELECT $2::text[] AS words, cardinality($2::text[]) AS n) AS vocabulary
+"""
+
+
+async def database_transactions(url: str) -> int:
+    """Transactions committed and rolled back by the database so far"""
+    connection = await asyncpg.connect(url)
+    try:
+        return await connection.fetchval('SELECT xact_commit + xact_rollback FROM pg_stat_database '
+                                         'WHERE datname = current_database()')
+    finally:
+        await connection.close()
+
+
+async def authorization(args) -> dict:
+    token = args.token or (await login(args.base, args.username, args.password) if args.username else None)
+    return {'Authorization': f'Bearer {token}'} if token else {}
+
+
+async def herd(args) -> dict:
+    """Thundering herd on a product: the same url, coalesced by every worker, then a distinct query string
+    per request, which no request shares, as the baseline. The transactions of --database are counted"""
+    url = f'{args.base}/v1/api/products/{args.product}'
+    results = {}
+    for name, urls in (('same_url', url), ('distinct_urls', lambda index: f'{url}?bench={index}')):
+        client = Client(args.concurrency)
+        transactions = await database_transactions(args.database) if args.database else None
+        results[name] = await load(client, urls, args.requests, args.concurrency)
+        await client.close()
+        if transactions is not None:
+            await asyncio.sleep(STATS_DELAY)
+            transactions = await database_transactions(args.database) - transactions
+            results[name]['db_transactions'] = transactions
+            results[name]['db_transactions_per_second'] = round(transactions / results[name]['seconds'], 1)
+    return results
+
+
+async def lists(args) -> dict:
+    """Large administrator lists with every content coding, bytes of the body and latency"""
+    headers = await authorization(args)
+    results = {}
+    for coding in ('identity', 'gzip', 'br'):
+        client = Client(args.concurrency)
+        results[coding] = await load(client, f'{args.base}{args.path}', args.requests, args.concurrency,
+                                     headers={**headers, 'Accept-Encoding': coding})
+        await client.close()
+    return results
+
+
+async def startup(args) -> dict:
+    """Seconds from the start of the server to its first served request and to its readiness"""
+    command = args.command or [sys.executable, 'server.py', '--port', str(args.port), '--workers', str(args.workers)]
+    base = f'http://127.0.0.1:{args.port}'
+    started = perf_counter()
+    # a session of its own, the server signals its process group when it stops
+    server = subprocess.Popen(command, cwd=dirname(dirname(__file__)), stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, start_new_session=True)
+    results = {}
+    client = Client(1, keepalive=False)
+    try:
+        # any response is a served request, e.g. a 404 of a release without /health/live
+        for name, path, served in (('first_request', '/health/live', lambda status: status is not None),
+                                   ('ready', '/health/ready', lambda status: status == 200)):
+            while perf_counter() - started < args.timeout:
+                try:
+                    status, _ = await client.request(f'{base}{path}', timeout=1.0)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status = None
+                if served(status):
+                    results[f'{name}_seconds'] = round(perf_counter() - started, 3)
+                    break
+                await asyncio.sleep(0.01)
+    finally:
+        await client.close()
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+    return results
+
+
+async def connections(args) -> dict:
+    """Connection setup cost: a new connection per request, kept-alive connections and, with --unix,
+    kept-alive connections over the unix domain socket"""
+    url = f'{args.base}{args.path}'
+    transports = {'new_connections': Client(args.concurrency, keepalive=False), 'keepalive': Client(args.concurrency)}
+    if args.unix:
+        transports['unix_keepalive'] = Client(args.concurrency, unix=args.unix)
+    results = {}
+    for name, client in transports.items():
+        results[name] = await load(client, url, args.requests, args.concurrency)
+        await client.close()
+    return results
+
+
+async def search(args) -> dict:
+    """Full-text search of the catalog, seeded first with --seed products in --database"""
+    if args.seed:
+        connection = await asyncpg.connect(args.database)
+        try:
+            await connection.execute(SEED_PRODUCTS, args.seed, WORDS)
+            await connection.execute('ANALYZE product')
+        finally:
+            await connection.close()
+    queries = cycle(['chair', 'oak table', 'blue -glass', '"red lamp"', 'wal', 'marble desk'])
+    client = Client(args.concurrency)
+    try:
+        return await load(client, lambda index: f'{args.base}/v1/api/products/search?q={next(queries)}',
+                          args.requests, args.concurrency)
+    finally:
+        await client.close()
+
+
+async def money(args) -> dict:
+    """Hot paths of the ledger: transactions crediting a bill, then purchases charging it"""
+    headers = {**await authorization(args), 'Content-Type': 'application/json'}
+    bodies = {
+        'transactions': {'user_id': args.user, 'bill_id': args.bill, 'amount': '10.25'},
+        'purchases': {'user_id': args.user, 'bill_id': args.bill, 'product_id': args.product},
+    }
+    results = {}
+    for name, body in bodies.items():
+        client = Client(args.concurrency)
+        results[name] = await load(client, f'{args.base}/v1/api/{name}', args.requests, args.concurrency, 'POST',
+                                   headers, json.dumps(body).encode())
+        await client.close()
+    return results
+
+
+SCENARIOS = {'herd': herd, 'lists': lists, 'startup': startup, 'connections': connections, 'search': search,
+             'money': money}
+
+
+# Load scenarios against a running app, e.g. python -m bench herd --base http://127.0.0.1:8000
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the app, results are printed as JSON')
+    parser.add_argument('--base', help='Url of the app, default to http://127.0.0.1:8000',
+                        default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', help='Requests per measure, default to 2000', type=int, default=2000)
+    parser.add_argument('--concurrency', help='Requests in flight at once, default to 100', type=int, default=100)
+    parser.add_argument('--token', help='JWT access token of the requests needing one')
+    parser.add_argument('--username', help='Login of the requests needing a token, instead of --token')
+    parser.add_argument('--password')
+    parser.add_argument('--database', help='asyncpg url of the database of the app, e.g. '
+                                           'postgresql://postgres@127.0.0.1/dimatech, for its statistics')
+    scenarios = parser.add_subparsers(dest='scenario', required=True)
+    herd_parser = scenarios.add_parser('herd', help='Concurrent GETs of one product, database transactions per '
+                                                    'second with and without coalescing')
+    herd_parser.add_argument('--product', type=int, default=1)
+    lists_parser = scenarios.add_parser('lists', help='Body bytes and latency of a large list per content coding')
+    lists_parser.add_argument('--path', default='/v1/api/transactions')
+    startup_parser = scenarios.add_parser('startup', help='Time to the first served request of a new server')
+    startup_parser.add_argument('--port', type=int, default=8100)
+    startup_parser.add_argument('--workers', type=int, default=1)
+    startup_parser.add_argument('--timeout', help='Seconds to wait for the server', type=float, default=60)
+    startup_parser.add_argument('command', nargs=argparse.REMAINDER,
+                                help='Command starting the server, default to python server.py')
+    connections_parser = scenarios.add_parser('connections', help='Throughput with new, kept-alive and unix '
+                                                                  'socket connections')
+    connections_parser.add_argument('--path', default='/health/live')
+    connections_parser.add_argument('--unix', help='Unix domain socket of the app, see server.py --unix')
+    search_parser = scenarios.add_parser('search', help='Latency of the full-text search of products')
+    search_parser.add_argument('--seed', help='Products added to the catalog first', type=int, default=0)
+    money_parser = scenarios.add_parser('money', help='Throughput of POST transactions and purchases')
+    money_parser.add_argument('--user', type=int, default=1)
+    money_parser.add_argument('--bill', type=int, default=1)
+    money_parser.add_argument('--product', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.scenario == 'search' and args.seed and not args.database:
+        parser.error('--seed needs --database')
+    print(json.dumps(asyncio.run(SCENARIOS[args.scenario](args)), indent=2))
@@ -0,0 +1,98 @@
+import asyncio
+from collections import Counter
+from time import perf_counter
+
+import aiohttp
+
+
+def percentile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0.0
+
+
+class Client(object):
+    """aiohttp session of a load, counts the connections it opens
+
+    Args:
+        concurrency: Connections kept open at most
+        keepalive: Whether the connections are reused, a new connection per request otherwise
+        unix: Unix domain socket of the app instead of TCP
+    """
+
+    def __init__(self, concurrency: int, keepalive: bool = True, unix: str = None):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self.count)
+        options = {'limit': concurrency, 'force_close': not keepalive}
+        connector = aiohttp.UnixConnector(unix, **options) if unix else aiohttp.TCPConnector(**options)
+        # bodies are measured as sent, the content coding is only asked for by a scenario
+        self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace], auto_decompress=False,
+                                             skip_auto_headers=('Accept-Encoding',))
+        self.opened = 0
+
+    async def count(self, session, context, params):
+        self.opened += 1
+
+    async def request(self, url: str, method='GET', headers=None, body=b'', timeout=30.0) -> tuple:
+        async with self.session.request(method, url, headers=headers, data=body or None,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, await response.read()
+
+    async def close(self):
+        await self.session.close()
+
+
+async def load(client: Client, urls, requests: int, concurrency: int, method='GET', headers=None, body=b'',
+               timeout=30.0) -> dict:
+    """Sends requests from concurrency tasks at once, every task sends its next request once answered
+
+    Args:
+        client: Client of the requests, its connections are counted
+        urls: Url of the requests, or a callable returning the url of the i-th request
+        requests: Number of requests
+        concurrency: Requests in flight at once
+
+    Returns:
+        Requests per second, latency percentiles in ms, statuses, errors, mean body bytes and opened connections
+    """
+    url_of = urls if callable(urls) else (lambda index: urls)
+    latencies, statuses, errors, sizes = [], Counter(), Counter(), []
+    queue = iter(range(requests))
+    opened = client.opened
+
+    async def worker():
+        for index in queue:
+            started = perf_counter()
+            try:
+                status, response_body = await client.request(url_of(index), method, headers, body, timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                errors[type(exception).__name__] += 1
+                continue
+            latencies.append((perf_counter() - started) * 1000)
+            statuses[status] += 1
+            sizes.append(len(response_body))
+
+    started = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'rps': round(len(latencies) / seconds, 1),
+        'latency_ms': {'p50': round(percentile(latencies, 0.5), 2), 'p90': round(percentile(latencies, 0.9), 2),
+                       'p99': round(percentile(latencies, 0.99), 2)},
+        'statuses': dict(statuses),
+        'errors': dict(errors),
+        'body_bytes': round(sum(sizes) / len(sizes)) if sizes else 0,
+        'connections': client.opened - opened,
+    }
+
+
+async def login(base: str, username: str, password: str) -> str:
+    """Returns an access token of the user"""
+    credentials = {'username': username, 'password': password}
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f'{base}/v1/auth/login/', json=credentials) as response:
+            if response.status != 201:
+                raise SystemExit(f'Login of {username} failed with {response.status}: {(await response.text())[:200]}')
+            return (await response.json())['access_token']
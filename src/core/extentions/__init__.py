@@ -0,0 +1,50 @@
+class Extension(object):
+    """Application-wide extensions
+
+    Collects listeners, middleware, exception handlers and signal handlers with the
+    decorators of a blueprint. install() registers them on the app with its public
+    API, so the middleware and exception handlers apply to every route of the app,
+    not only to the routes of a blueprint.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.listeners = []
+        self.middlewares = []
+        self.exceptions = []
+        self.signals = []
+
+    def listener(self, event):
+        def decorator(handler):
+            self.listeners.append((handler, event))
+            return handler
+        return decorator
+
+    def middleware(self, attach_to='request'):
+        def decorator(handler):
+            self.middlewares.append((handler, attach_to))
+            return handler
+        return decorator
+
+    def exception(self, *exceptions):
+        def decorator(handler):
+            self.exceptions.append((handler, exceptions))
+            return handler
+        return decorator
+
+    def signal(self, event):
+        def decorator(handler):
+            self.signals.append((handler, event))
+            return handler
+        return decorator
+
+    def install(self, app):
+        for handler, event in self.listeners:
+            app.register_listener(handler, event)
+        for handler, attach_to in self.middlewares:
+            app.register_middleware(handler, attach_to)
+        for handler, exceptions in self.exceptions:
+            for exception in exceptions:
+                app.error_handler.add(exception, handler)
+        for handler, event in self.signals:
+            app.add_signal(handler, event)
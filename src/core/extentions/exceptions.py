@@ -1,15 +1,48 @@
 from http import HTTPStatus
 
-from sanic import Blueprint
-from sanic.exceptions import NotFound
+from sanic.exceptions import NotFound, InvalidUsage, SanicException
 from sanic.response import json
+from sqlalchemy.exc import DBAPIError
 
+from core.extentions import Extension
 from core.helpers import jsonapi
+from core.helpers.breaker import CircuitOpen
+from core.helpers.metrics import counters
 
-blueprint = Blueprint(name="exceptions")
+# SQLSTATE of a statement cancelled by statement_timeout or by a cancel request
+QUERY_CANCELED = '57014'
 
+extension = Extension(name="exceptions")
 
-@blueprint.exception(NotFound)
+
+class InvalidParameter(InvalidUsage):
+    """Invalid query parameter
+
+    Carries the JSON API error objects describing what is wrong
+    with the query parameters of the request.
+    """
+
+    def __init__(self, *errors):
+        super().__init__(errors[0].get('detail') if errors else None)
+        self.errors = errors
+
+
+class ArchivedRange(SanicException):
+    """Range of a filter reaching months archived out of the database
+
+    Carries the table and the oldest archived month the range needs
+    back in the database to be answered completely.
+    """
+
+    status_code = HTTPStatus.CONFLICT
+
+    def __init__(self, table, month, since):
+        super().__init__(f"the months of {table} before {since:%Y-%m} are archived")
+        self.table = table
+        self.month = month
+
+
+@extension.exception(NotFound)
 def handle_404(request, exception):
     """Handle 404 Not Found
 
@@ -18,3 +51,56 @@ def handle_404(request, exception):
     """
     error = jsonapi.format_error(title='Resource not found', detail=str(exception))
     return json(jsonapi.return_an_error(error), status=HTTPStatus.NOT_FOUND)
+
+
+@extension.exception(InvalidParameter)
+def handle_invalid_parameter(request, exception):
+    """Handle 400 Bad Request caused by query parameters
+
+    Returns the JSON API errors collected while parsing the parameters.
+    """
+    return json(jsonapi.return_an_error(*exception.errors), status=HTTPStatus.BAD_REQUEST)
+
+
+@extension.exception(ArchivedRange)
+def handle_archived_range(request, exception):
+    """Handle 409 Conflict caused by a range of archived months
+
+    The error tells how the months are loaded back, an incomplete list
+    would look like the ledger lost the archived rows.
+    """
+    error = jsonapi.format_error(status=HTTPStatus.CONFLICT, title='Archived months',
+                                 detail=f'{exception}, load them back month by month from python manage.py restore '
+                                        f'{exception.table} {exception.month:%Y-%m} on')
+    return json(jsonapi.return_an_error(error), status=HTTPStatus.CONFLICT)
+
+
+@extension.exception(DBAPIError)
+def handle_deadline_exceeded(request, exception):
+    """Handle 503 Service Unavailable caused by the request deadline
+
+    A statement running past the deadline of the request is cancelled by
+    Postgres, the event is counted per route. Other database errors are
+    left to the default handler.
+    """
+    if getattr(exception.orig, 'sqlstate', None) != QUERY_CANCELED:
+        return request.app.error_handler.default(request, exception)
+
+    counters.increment('deadline_exceeded', request.route.name if request.route else None)
+    error = jsonapi.format_error(status=HTTPStatus.SERVICE_UNAVAILABLE, title='Deadline exceeded',
+                                 detail='The request took longer than allowed, retry later')
+    return json(jsonapi.return_an_error(error), status=HTTPStatus.SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
+
+@extension.exception(CircuitOpen)
+def handle_circuit_open(request, exception):
+    """Handle 503 Service Unavailable caused by an open circuit breaker
+
+    Requests needing a database whose connections keep failing are answered
+    at once instead of waiting for a connection, the event is counted per route.
+    """
+    counters.increment('circuit_open', request.route.name if request.route else None)
+    error = jsonapi.format_error(status=HTTPStatus.SERVICE_UNAVAILABLE, title='Database unavailable',
+                                 detail=f'The database {exception.name} can not be reached, retry later')
+    return json(jsonapi.return_an_error(error), status=HTTPStatus.SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(exception.retry_after)})
@@ -1,3 +1,236 @@
-from sanic import Blueprint
+import asyncio
+from http import HTTPStatus
 
-blueprint = Blueprint('middlewares')
+from jwt import PyJWTError
+from sanic.response import json
+from sanic_jwt_extended import JWT
+from sanic_jwt_extended.exceptions import JWTExtendedException
+from sanic_jwt_extended.tokens import Token
+
+from core.extentions import Extension
+from core.helpers import compression, jsonapi, memory, profiler, tracing
+from core.helpers.admission import AdmissionController, Rejected
+from core.helpers.metrics import counters
+
+extension = Extension('middlewares')
+
+
+@extension.listener('before_server_start')
+async def setup_tracing(app, loop):
+    config = app.config
+    exporter = None
+    if config.TRACE_EXPORTER == 'file':
+        exporter = tracing.FileExporter(config.TRACE_FILE)
+        app.add_task(exporter.run())
+    elif config.TRACE_EXPORTER == 'memory':
+        exporter = tracing.MemoryExporter()
+    tracing.tracer.configure(exporter, config.TRACE_SAMPLE_RATE)
+
+
+@extension.listener('after_server_stop')
+async def flush_tracing(app, loop):
+    if tracing.tracer.exporter is not None:
+        tracing.tracer.exporter.flush()
+
+
+@extension.middleware('request')
+async def start_trace(request):
+    """Starts the span of the request, continuing the trace of its traceparent header"""
+    name = request.route.name if request.route else 'not_found'
+    span = tracing.tracer.start_trace(f'{request.method} {name}', request.headers.get('traceparent'),
+                                      **{'http.method': request.method, 'http.target': request.path})
+    request.ctx.trace_span = span
+    tracing.current_span.set(span)
+
+
+@extension.middleware('response')
+async def end_trace(request, response):
+    span = getattr(request.ctx, 'trace_span', None)
+    if span is not None:
+        tracing.tracer.end(span, **{'http.status_code': response.status})
+
+
+# admission classes routes declare with ctx_admission: priority (lower goes first)
+# and the longest time in seconds a request of the class waits for a slot
+ADMISSION_CLASSES = {
+    'webhooks': (0, 10.0),
+    'purchases': (1, 3.0),
+    'catalog': (2, 1.0),
+    'default': (3, 2.0),
+    'admin': (4, 5.0),
+}
+
+
+@extension.listener('before_server_start')
+async def setup_admission(app, loop):
+    app.ctx.admission = AdmissionController(app.config.ADMISSION_MAX_INFLIGHT, ADMISSION_CLASSES)
+
+
+def token_role(request):
+    """Role of the access token of the request, None without a valid one (the handler rejects it)"""
+    parts = request.headers.get(JWT.config.jwt_header_key, '').split()
+    if len(parts) != 2 or parts[0] != JWT.config.jwt_header_prefix:
+        return None
+    try:
+        return Token(parts[1]).role
+    except (JWTExtendedException, PyJWTError):
+        return None
+
+
+def admission_class(request):
+    """Admission class of the request
+
+    Routes declare it with ctx_admission and may declare another one
+    for unsafe methods with ctx_admission_write. Lists an administrator
+    reads from every shard declare the class of those reads with
+    ctx_admission_admin, the reads of other users and the reads filtered
+    on a single user keep the class of the route. Routes not using the
+    database declare ctx_admission=False and are not queued.
+    """
+    ctx = request.route.ctx
+    declared = getattr(ctx, 'admission', None)
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        declared = getattr(ctx, 'admission_write', declared)
+    elif getattr(ctx, 'admission_admin', None) and 'filter[user_id]' not in request.args \
+            and 'filter[user_id][eq]' not in request.args and token_role(request) == 'Admin':
+        declared = ctx.admission_admin
+    return declared or 'default'
+
+
+@extension.middleware('request')
+async def track_route(request):
+    """Remembers the route the current task serves
+
+    Samples of the profiler are attributed to it and, while memory is
+    traced, the peak of traced memory of the request is recorded for it.
+    """
+    if request.route is not None:
+        task = asyncio.current_task()
+        profiler.routes[task] = request.route.name
+        request.ctx.traced_memory = memory.tracer.request_started(task)
+
+
+@extension.middleware('response')
+async def record_memory_peak(request, response):
+    if getattr(request.ctx, 'traced_memory', None) is not None:
+        memory.tracer.request_finished(asyncio.current_task(), request.route.name, request.ctx.traced_memory)
+
+
+@extension.middleware('request')
+async def admit_request(request):
+    """Admission control
+
+    Lets at most ADMISSION_MAX_INFLIGHT requests of a worker reach the database
+    pool at once. The others wait in the queue of their class and are answered
+    503 with Retry-After when they would wait past the deadline of the class.
+    """
+    if request.route is None:
+        return
+    if getattr(request.route.ctx, 'admission', None) is False:
+        return
+    try:
+        ticket = await request.app.ctx.admission.acquire(admission_class(request))
+    except Rejected as exception:
+        counters.increment('admission_rejected', request.route.name)
+        error = jsonapi.format_error(status=HTTPStatus.SERVICE_UNAVAILABLE, title='Service overloaded',
+                                     detail='The request can not be served in time, retry later')
+        return json(jsonapi.return_an_error(error), status=HTTPStatus.SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': str(exception.retry_after)})
+
+    # a cancelled request never reaches the response middleware,
+    # its slot is freed when the task serving the connection ends
+    task = asyncio.current_task()
+    callback = lambda _: ticket.release()  # noqa: E731
+    task.add_done_callback(callback)
+    request.ctx.admission = (ticket, task, callback)
+
+
+@extension.middleware('response')
+async def release_admission(request, response):
+    if getattr(request.ctx, 'admission', None) is None:
+        return
+    ticket, task, callback = request.ctx.admission
+    request.ctx.admission = None
+    task.remove_done_callback(callback)
+    ticket.release()
+
+
+@extension.signal('http.handler.before')
+async def start_handler_span(request, **kwargs):
+    span = tracing.tracer.start_span(f'handler {request.route.name}')
+    if span is not None:
+        request.ctx.handler_span = span
+        tracing.current_span.set(span)
+
+
+@extension.signal('http.handler.after')
+async def mark_handled(request, **kwargs):
+    """Marks that the handler returned, a response sent before that is a streaming one"""
+    request.ctx.handled = True
+    span = getattr(request.ctx, 'handler_span', None)
+    if span is not None:
+        tracing.tracer.end(span)
+        tracing.current_span.set(request.ctx.trace_span)
+
+
+@extension.middleware('response')
+async def compress_response(request, response):
+    """Negotiated response compression
+
+    Compresses responses above COMPRESS_MIN_SIZE with brotli or gzip according to
+    Accept-Encoding. Bodies above COMPRESS_EXECUTOR_SIZE are compressed in the default
+    executor so the event loop is not blocked. Streaming responses are compressed
+    chunk by chunk as they are sent.
+    """
+    config = request.app.config
+    if request.method == 'HEAD' or response.status < 200 or response.status in (204, 206, 304) \
+            or 'content-encoding' in response.headers \
+            or not compression.is_compressible(response.content_type):
+        return
+
+    streaming = not response.body and not getattr(request.ctx, 'handled', False)
+    if not streaming and len(response.body) < config.COMPRESS_MIN_SIZE:
+        return
+
+    coding = compression.negotiate(request.headers.get('accept-encoding', ''))
+    vary = response.headers.get('vary')
+    response.headers['vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+    if coding is None:
+        return
+
+    response.headers['content-encoding'] = coding
+    response.headers.pop('content-length', None)
+    if 'etag' in response.headers:
+        response.headers['etag'] = compression.etag_for(response.headers['etag'], coding)
+
+    if streaming:
+        response.stream = CompressedStream(response.stream, compression.Encoder(coding, config.COMPRESS_LEVEL))
+    elif len(response.body) >= config.COMPRESS_EXECUTOR_SIZE:
+        response.body = await asyncio.get_running_loop().run_in_executor(
+            None, compression.compress, coding, response.body, config.COMPRESS_LEVEL)
+    else:
+        response.body = compression.compress(coding, response.body, config.COMPRESS_LEVEL)
+
+
+class CompressedStream(object):
+    """Proxy of the stream a streaming response writes to, compressing every chunk"""
+
+    def __init__(self, stream, encoder):
+        self.stream = stream
+        self.encoder = encoder
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @property
+    def send(self):
+        if self.stream.send is None:
+            return None
+        return self._send
+
+    async def _send(self, data, end_stream):
+        if self.finished:
+            return await self.stream.send(data, end_stream=end_stream)
+        self.finished = bool(end_stream)
+        await self.stream.send(self.encoder.compress(data, finish=self.finished), end_stream=end_stream)
@@ -0,0 +1,108 @@
+import asyncio
+from heapq import heappush, heappop
+from itertools import count
+from math import ceil
+from time import monotonic
+
+
+class Rejected(Exception):
+    """The request can not be admitted before its deadline"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Retry after {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class Ticket(object):
+    """A slot held by an admitted request, released once"""
+
+    __slots__ = ('controller', 'start', 'released')
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.start = monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(monotonic() - self.start)
+
+
+class AdmissionController(object):
+    """Per-worker admission control with prioritized queues
+
+    At most capacity requests are in flight. Requests over it wait in a
+    queue ordered by the priority of their class (lower first) and give up
+    at the deadline of the class. A request whose expected wait, estimated
+    from the average service time, exceeds its deadline is rejected at once.
+
+    Args:
+        capacity: Maximal number of requests in flight
+        classes: A dictionary of class names and (priority, deadline in seconds)
+    """
+
+    def __init__(self, capacity, classes):
+        self.capacity = capacity
+        self.classes = classes
+        self.inflight = 0
+        # waiting requests, the queue keeps the ones given up until they are popped
+        self.queued = 0
+        self.service_time = 0.05
+        self._waiters = []
+        self._sequence = count()
+
+    def expected_wait(self, priority):
+        """Seconds a request of the priority is expected to wait for a slot"""
+        ahead = sum(1 for waiting, _, future in self._waiters if waiting <= priority and not future.done())
+        return (ahead + 1) * self.service_time / self.capacity
+
+    async def acquire(self, name):
+        """Waits for a slot for a request of the class
+
+        Returns:
+            A Ticket to release when the request is done
+
+        Raises:
+            Rejected: if the slot can not be obtained before the deadline of the class
+        """
+        priority, deadline = self.classes[name]
+        if self.inflight < self.capacity and not self.queued:
+            self.inflight += 1
+            return Ticket(self)
+
+        expected = self.expected_wait(priority)
+        if expected > deadline:
+            raise Rejected(max(1, ceil(expected)))
+
+        future = asyncio.get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._sequence), future))
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            self.give_up(future)
+            raise Rejected(max(1, ceil(self.expected_wait(priority))))
+        except asyncio.CancelledError:
+            self.give_up(future)
+            raise
+        return Ticket(self)
+
+    def give_up(self, future):
+        """Leaves the queue, or frees the slot handed over right before giving up"""
+        if future.done() and not future.cancelled():
+            self.release(0.0)
+        else:
+            future.cancel()
+            self.queued -= 1
+
+    def release(self, elapsed):
+        """Hands the slot over to the first waiting request or frees it"""
+        self.service_time = 0.9 * self.service_time + 0.1 * elapsed
+        while self._waiters:
+            _, _, future = heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                self.queued -= 1
+                return
+        self.inflight -= 1
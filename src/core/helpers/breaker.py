@@ -0,0 +1,124 @@
+from math import ceil
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from core.helpers.tracing import TracedPool
+
+
+class CircuitOpen(Exception):
+    """The guarded resource is considered down, calls fail at once until a probe succeeds"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f'Circuit of {name} is open, retry after {retry_after} seconds')
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Per-worker circuit breaker
+
+    While closed, calls go through and consecutive failures are counted. At threshold
+    failures the breaker opens and calls fail at once with CircuitOpen for reset_timeout
+    seconds. The breaker is then half-open: a single call goes through as a probe,
+    the breaker closes when it succeeds and opens again when it fails. A probe which
+    reports nothing within reset_timeout is replaced by the next call.
+
+    Args:
+        name: Name of the guarded resource, e.g. the database
+        threshold: Number of consecutive failures opening the breaker
+        reset_timeout: Seconds the breaker stays open before a probe
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, threshold=5, reset_timeout=5.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before(self):
+        """Lets a call through
+
+        Raises:
+            CircuitOpen: if the breaker is open or half-open with a probe in flight
+        """
+        if self.opened_at is None:
+            return
+        now = monotonic()
+        if now - self.opened_at >= self.reset_timeout and (
+                self.probe_at is None or now - self.probe_at >= self.reset_timeout):
+            self.probe_at = now
+            return
+        raise CircuitOpen(self.name, max(1, ceil(self.opened_at + self.reset_timeout - now)))
+
+    def success(self):
+        if self.failures or self.opened_at is not None:
+            self.failures = 0
+            self.opened_at = self.probe_at = None
+
+    def failure(self):
+        self.failures += 1
+        if (self.opened_at is None and self.failures >= self.threshold) or self.state == self.HALF_OPEN:
+            # failures of the calls let through before the breaker opened do not keep it open
+            self.opened += 1
+            self.opened_at = monotonic()
+            self.probe_at = None
+
+    def snapshot(self):
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened}
+
+
+class GuardedPool(TracedPool):
+    """Connection pool failing checkouts at once while its breaker is open, failed connections open it"""
+
+    breaker = None
+
+    def connect(self):
+        if self.breaker is None:
+            return super().connect()
+        self.breaker.before()
+        try:
+            return super().connect()
+        except PoolTimeout:
+            # the pool is exhausted, the database is fine
+            raise
+        except Exception:
+            self.breaker.failure()
+            raise
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.breaker = self.breaker
+        return pool
+
+
+def guard(engine, breaker):
+    """Guards the connections of the engine, created with GuardedPool, with the breaker
+
+    Executed statements close the breaker, a connection lost while executing one is a failure.
+    """
+    engine.pool.breaker = breaker
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def statement_succeeded(connection, cursor, statement, parameters, context, executemany):
+        breaker.success()
+
+    @event.listens_for(engine, 'handle_error')
+    def statement_failed(context):
+        # failed connections are reported by the pool
+        if context.is_disconnect and context.connection is not None:
+            breaker.failure()
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from time import monotonic
+
+
+class ResponseCache(object):
+    """Versioned LRU cache of response bodies
+
+    Every entry is stored together with the data version it was built from,
+    a lookup only hits when the caller's current version matches. A bump of
+    the version therefore invalidates all entries built before it.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        """Returns the cached value for key if it was built from version, None otherwise"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, version, value):
+        """Stores value for key, replacing any entry of another version"""
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class CachedValue(object):
+    """A single value kept for a limited time"""
+
+    def __init__(self):
+        self.value = None
+        self.expires = 0.0
+
+    def get(self):
+        """Returns the value while it is fresh, None otherwise"""
+        if monotonic() < self.expires:
+            return self.value
+        return None
+
+    def set(self, value, ttl):
+        self.value = value
+        self.expires = monotonic() + ttl
+
+    def clear(self):
+        self.value = None
+        self.expires = 0.0
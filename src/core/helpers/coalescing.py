@@ -0,0 +1,101 @@
+import asyncio
+from functools import wraps
+
+from sanic.response import HTTPResponse
+
+
+class RequestCoalescer(object):
+    """Single-flight execution of identical concurrent calls
+
+    The first caller for a key runs the call, every caller arriving while it
+    is in flight awaits the same result. Nothing is kept once the call is done.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    async def run(self, key, factory):
+        """Run factory() once per key among concurrent callers
+
+        Args:
+            key: A hashable key identifying identical calls
+            factory: A callable returning the coroutine to run
+
+        Returns:
+            The result of the coroutine started by the first caller
+        """
+        while True:
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the leader was cancelled (e.g. its client went away), not us: take over
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_retrieve_exception)
+        self._inflight[key] = future
+        try:
+            result = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exception:
+            future.set_exception(exception)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+
+def _retrieve_exception(future):
+    # mark the exception as retrieved when no follower was waiting for it
+    if not future.cancelled():
+        future.exception()
+
+
+coalescer = RequestCoalescer()
+
+
+def request_key(request, token=None):
+    """Key of a read request: route, parameters and authorization scope
+
+    Administrators see the same data, so they share one scope, while
+    a default user is scoped by his identity.
+    """
+    if token is None:
+        scope = None
+    elif token.role == 'Admin':
+        scope = ('Admin',)
+    else:
+        scope = (token.role, token.identity)
+    route = request.route.name if request.route else None
+    return route, request.path, request.query_string, scope
+
+
+def coalesce(handler):
+    """Decorator coalescing identical concurrent GET requests of a view method
+
+    Must be placed below @jwt_required so the token is already known.
+    Every caller receives its own copy of the response built by the first one.
+    """
+
+    @wraps(handler)
+    async def wrapper(self, request, *args, **kwargs):
+        if request.method != 'GET':
+            return await handler(self, request, *args, **kwargs)
+
+        key = request_key(request, kwargs.get('token'))
+        shared = await coalescer.run(key, lambda: handler(self, request, *args, **kwargs))
+        return HTTPResponse(body=shared.body, status=shared.status, headers=dict(shared.headers),
+                            content_type=shared.content_type)
+
+    return wrapper
@@ -0,0 +1,100 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml')
+
+
+def available_encodings():
+    """Content codings the server can produce, in order of preference"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding):
+    """Choosing a content coding
+
+    Picks the preferred coding accepted by the client with a non-zero quality
+    ref: https://www.rfc-editor.org/rfc/rfc9110#field.accept-encoding
+
+    Args:
+        accept_encoding: Value of the Accept-Encoding request header
+
+    Returns:
+        The name of the coding or None if the response should not be compressed
+    """
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding] = quality
+
+    candidates = [(accepted.get(coding, accepted.get('*', 0.0)), -index, coding)
+                  for index, coding in enumerate(available_encodings())]
+    quality, _, coding = max(candidates)
+    return coding if quality > 0 else None
+
+
+def is_compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES) \
+        and not content_type.startswith('text/event-stream')
+
+
+class Encoder(object):
+    """Incremental gzip or brotli encoder"""
+
+    def __init__(self, coding, level=6):
+        self.coding = coding
+        if coding == 'br':
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, finish=False):
+        """Compresses a chunk, flushing it so the client can decode it at once
+
+        Args:
+            data: Bytes of the chunk
+            finish: Whether this is the last chunk of the body
+
+        Returns:
+            Compressed bytes
+        """
+        if self.coding == 'br':
+            chunk = self._compressor.process(data)
+            return chunk + (self._compressor.finish() if finish else self._compressor.flush())
+        chunk = self._compressor.compress(data)
+        return chunk + self._compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+
+def compress(coding, data, level=6):
+    """Compresses a whole body"""
+    return Encoder(coding, level).compress(data, finish=True)
+
+
+def etag_for(etag, coding):
+    """Strong ETag of the encoded representation
+
+    A compressed body is a different representation, so it gets its own validator.
+    """
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{coding}"'
+    return etag
+
+
+def strip_etag_coding(etag):
+    """Returns the ETag of the identity representation for a validator made by etag_for"""
+    for coding in ('br', 'gzip'):
+        suffix = f'-{coding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
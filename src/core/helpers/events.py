@@ -0,0 +1,197 @@
+import asyncio
+import json
+from collections import deque
+
+import asyncpg
+from sanic.log import logger
+
+
+def format_event(data=None, event=None, event_id=None, retry=None, comment=None):
+    """Formatting a Server-Sent Event
+
+    ref: https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+
+    Args:
+        data: Object sent as JSON in the data field
+        event: Type of the event
+        event_id: Id the client sends back in Last-Event-ID when it reconnects
+        retry: Milliseconds the client waits before reconnecting
+        comment: Comment line, ignored by the client
+
+    Returns:
+        The event as a string
+    """
+    lines = []
+    if comment is not None:
+        lines.append(f': {comment}')
+    if retry is not None:
+        lines.append(f'retry: {retry}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if data is not None:
+        lines.append(f'data: {json.dumps(data)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription(object):
+    """Queue of the events of a stream, closed by the hub when the stream does not keep up"""
+
+    __slots__ = ('key', 'queue', 'closed')
+
+    def __init__(self, key, size):
+        self.key = key
+        self.queue = asyncio.Queue(size)
+        self.closed = False
+
+    async def events(self, heartbeat):
+        """Yields the events, None every heartbeat seconds without one, until the subscription is closed"""
+        while not (self.closed and self.queue.empty()):
+            try:
+                event = await asyncio.wait_for(self.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is None:
+                return
+            yield event
+
+
+class EventHub(object):
+    """Fan out of the notifications of a Postgres channel to the streams of a worker
+
+    A worker holds a single LISTEN connection to each database, outside of the pools,
+    whatever the number of streams. Notifications are JSON objects with an id and a user_id, a stream
+    subscribes to the events of a user or to all of them with the key None.
+
+    The last buffer_size events are kept so a reconnecting stream resumes right after
+    the last event it received. A stream whose queue of queue_size events is full is
+    closed instead of slowing the others, its client reconnects and resumes from the
+    buffer. Notifications sent while a LISTEN connection is down are lost, the buffer
+    is then cleared so resuming streams are told to reload.
+
+    Args:
+        urls: Postgres urls of the databases to listen to
+        channel: Channel to listen to
+        buffer_size: Number of events kept for resuming streams
+        queue_size: Number of events a stream may lag behind
+        retry: Seconds before reconnecting, doubled up to 30 while the database is down
+        ping: Seconds between checks of an idle LISTEN connection
+    """
+
+    def __init__(self, urls, channel, buffer_size=1000, queue_size=100, retry=1.0, ping=30.0):
+        self.urls = urls
+        self.channel = channel
+        self.queue_size = queue_size
+        self.retry = retry
+        self.ping = ping
+        self.buffer = deque(maxlen=buffer_size)
+        self.subscriptions = {}
+        self.listening = set()
+        self.dropped = 0
+        self.tasks = []
+
+    @property
+    def connected(self):
+        return len(self.listening) == len(self.urls)
+
+    def start(self):
+        self.tasks = [asyncio.ensure_future(self.run(url)) for url in self.urls]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                self.close(subscription)
+
+    async def run(self, url):
+        delay = self.retry
+        while True:
+            try:
+                connection = await asyncpg.connect(url)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as exception:
+                logger.warning("Could not listen to %s, retrying in %ss: %r", self.channel, delay, exception)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+
+            delay = self.retry
+            try:
+                await connection.add_listener(self.channel, self.notify)
+                self.listening.add(url)
+                while not connection.is_closed():
+                    await asyncio.sleep(self.ping)
+                    await connection.execute('SELECT 1', timeout=self.ping)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exception:
+                logger.warning("Lost the connection listening to %s: %r", self.channel, exception)
+            finally:
+                self.listening.discard(url)
+                connection.terminate()
+                self.reset()
+            await asyncio.sleep(delay)
+
+    def notify(self, connection, pid, channel, payload):
+        self.publish(json.loads(payload))
+
+    def publish(self, event):
+        self.buffer.append(event)
+        for key in (event['user_id'], None):
+            for subscription in list(self.subscriptions.get(key, ())):
+                try:
+                    subscription.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    self.dropped += 1
+                    self.close(subscription)
+
+    def reset(self):
+        """Forgets the buffered events, streams can no longer be resumed from them"""
+        self.buffer.clear()
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                self.close(subscription)
+
+    def subscribe(self, key, last_event_id=None):
+        """Subscribes a stream to the events of key
+
+        Args:
+            key: user_id of the events, None for all events
+            last_event_id: Id of the last event the client received
+
+        Returns:
+            A tuple of the subscription and the buffered events of key after last_event_id,
+            None if they are not known anymore
+        """
+        subscription = Subscription(key, self.queue_size)
+        self.subscriptions.setdefault(key, set()).add(subscription)
+        if last_event_id is None:
+            return subscription, []
+
+        backlog = []
+        for event in reversed(self.buffer):
+            if event['id'] == last_event_id:
+                return subscription, backlog[::-1]
+            if key is None or event['user_id'] == key:
+                backlog.append(event)
+        return subscription, None
+
+    def close(self, subscription):
+        """Closes the subscription, its stream ends after the queued events"""
+        if subscription.closed:
+            return
+        subscription.closed = True
+        subscriptions = self.subscriptions.get(subscription.key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.key]
+        try:
+            subscription.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    @property
+    def streams(self):
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
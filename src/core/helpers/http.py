@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+from core.helpers import tracing
+
+logger = logging.getLogger(__name__)
+
+# statuses whose response never has a body, RFC 9112 section 6.3
+BODILESS_STATUSES = {204, 304}
+
+
+async def fetch(url, method='GET', headers=None, body=b'', timeout=5.0):
+    """Minimal HTTP client
+
+    Sends a single request over a new connection closed afterwards, enough for internal
+    calls (cache purges, outbox sinks) without an extra dependency. The request is sent
+    as HTTP/1.0, so the response is never chunked: its body ends at Content-Length or
+    at the end of the connection. The current trace is propagated with a traceparent header.
+
+    Args:
+        url: Absolute http or https url
+        method: HTTP method
+        headers: A dictionary of request headers
+        body: Request body as bytes
+        timeout: Seconds to wait for the whole exchange
+
+    Returns:
+        A tuple of status code, dictionary of response headers (lower case names) and body
+    """
+    headers = dict(headers or {})
+    traceparent = tracing.tracer.traceparent()
+    if traceparent is not None:
+        headers.setdefault('traceparent', traceparent)
+    return await asyncio.wait_for(_fetch(url, method, headers, body), timeout)
+
+
+async def _fetch(url, method, headers, body):
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=secure)
+    try:
+        lines = [f'{method} {path} HTTP/1.0', f'Host: {parts.netloc}', 'Connection: close',
+                 f'Content-Length: {len(body)}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Connection closed by the server')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if method == 'HEAD' or status in BODILESS_STATUSES:
+            response_body = b''
+        elif 'content-length' in response_headers:
+            try:
+                response_body = await reader.readexactly(int(response_headers['content-length']))
+            except asyncio.IncompleteReadError as error:
+                raise ConnectionResetError('Connection closed during the response') from error
+        else:
+            response_body = await reader.read()
+    finally:
+        writer.close()
+    return status, response_headers, response_body
+
+
+async def purge(*urls, header='X-Cache-Purge'):
+    """Asks a caching proxy to refresh its entries for urls
+
+    The proxy is expected to bypass its cache for requests carrying
+    the purge header and store the fresh response. Failures are only logged.
+    """
+    for url in urls:
+        try:
+            await fetch(url, headers={header: '1'})
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError) as exception:
+            logger.warning('Cache purge of %s failed: %r', url, exception)
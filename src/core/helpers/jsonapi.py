@@ -1,3 +1,11 @@
+import json
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+
+FILTER_PARAMETER = re.compile(r'^filter\[(\w+)\](?:\[(\w+)\])?$')
+
+
 def format_error(status=None, title=None, detail=None, code=None):
     """Formatting JSON API Error Object
 
@@ -45,3 +53,138 @@ def return_an_error(*args):
 
     errors = {'errors': list_errors}
     return errors
+
+
+def parse_fieldset(args, resource, fields):
+    """Parsing JSON API Sparse Fieldset
+
+    Reads the fields[resource]=a,b query parameter
+    ref: http://jsonapi.org/format/#fetching-sparse-fieldsets
+
+    Args:
+        args: Query arguments of the request
+        resource: Type of the resource, e.g. products
+        fields: Names of the fields of the resource, the first one is its identifier
+
+    Returns:
+        A tuple of the requested field names, always starting with the identifier
+        (all fields if the parameter is absent), and a list of errors
+    """
+    parameter = f'fields[{resource}]'
+    value = args.get(parameter)
+    if value is None:
+        return list(fields), []
+
+    requested = [fields[0]]
+    errors = []
+    for name in value.split(','):
+        name = name.strip()
+        if not name or name in requested:
+            continue
+        if name in fields:
+            requested.append(name)
+        else:
+            errors.append(format_error(status=400, title='Invalid field',
+                                       detail=f"{parameter}: resource '{resource}' does not have field '{name}'"))
+    return requested, errors
+
+
+def parse_filters(args, filters):
+    """Parsing JSON API Filters
+
+    Reads filter[field]=value and filter[field][operator]=value query parameters,
+    the operator defaults to eq and the in operator takes comma separated values
+    ref: http://jsonapi.org/format/#fetching-filtering
+
+    Args:
+        args: Query arguments of the request
+        filters: A dictionary of the filterable field names and their allowed operators
+
+    Returns:
+        A tuple of a list of (field, operator, value) and a list of errors
+    """
+    requested = []
+    errors = []
+    for parameter in args:
+        match = FILTER_PARAMETER.match(parameter)
+        if not match:
+            continue
+        name, operator = match.group(1), match.group(2) or 'eq'
+        if name not in filters:
+            errors.append(format_error(status=400, title='Invalid filter',
+                                       detail=f"{parameter}: field '{name}' can not be filtered"))
+        elif operator not in filters[name]:
+            errors.append(format_error(status=400, title='Invalid filter',
+                                       detail=f"{parameter}: operator '{operator}' is not allowed for '{name}'"))
+        else:
+            value = args.get(parameter)
+            requested.append((name, operator, value.split(',') if operator == 'in' else value))
+    return requested, errors
+
+
+def parse_sort(args, fields):
+    """Parsing JSON API Sorting
+
+    Reads the sort=field,-field query parameter, a leading minus means descending order
+    ref: http://jsonapi.org/format/#fetching-sorting
+
+    Args:
+        args: Query arguments of the request
+        fields: Names of the sortable fields
+
+    Returns:
+        A tuple of a list of (field, descending) and a list of errors
+    """
+    value = args.get('sort')
+    if not value:
+        return [], []
+
+    requested = []
+    errors = []
+    for name in value.split(','):
+        name = name.strip()
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name in fields:
+            requested.append((name, descending))
+        else:
+            errors.append(format_error(status=400, title='Invalid sort',
+                                       detail=f"sort: field '{name}' can not be sorted"))
+    return requested, errors
+
+
+def encode_cursor(*values):
+    """Encodes the sort key of the last record of a page as an opaque page[after] cursor"""
+    return urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def parse_page(args, default_size=20, max_size=100):
+    """Parsing JSON API Cursor Pagination
+
+    Reads the page[size] and page[after] query parameters, page[after] is a cursor made by encode_cursor
+    ref: https://jsonapi.org/profiles/ethanresnick/cursor-pagination/
+
+    Args:
+        args: Query arguments of the request
+        default_size: Page size when page[size] is not given
+        max_size: Largest page size allowed
+
+    Returns:
+        A tuple of the page size, the decoded cursor values (None for the first page) and a list of errors
+    """
+    errors = []
+    size = args.get('page[size]', str(default_size))
+    if not size.isdigit() or not 0 < int(size) <= max_size:
+        errors.append(format_error(status=400, title='Invalid page',
+                                   detail=f"page[size]: must be an integer from 1 to {max_size}"))
+        size = default_size
+    size = int(size)
+
+    after = args.get('page[after]')
+    if after is not None:
+        try:
+            after = json.loads(urlsafe_b64decode(after + '=' * (-len(after) % 4)))
+        except (DecodeError, ValueError):
+            after = None
+            errors.append(format_error(status=400, title='Invalid page', detail="page[after]: invalid cursor"))
+    return size, after, errors
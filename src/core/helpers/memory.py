@@ -0,0 +1,98 @@
+import tracemalloc
+from collections import OrderedDict
+from weakref import WeakSet
+
+# allocations of the tracer itself and of imports are not interesting
+IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>')
+
+
+def format_site(traceback):
+    return [f'{frame.filename}:{frame.lineno}' for frame in traceback]
+
+
+class MemoryTracer(object):
+    """tracemalloc snapshots and per-route peaks of a worker
+
+    Snapshots are kept by name, the oldest ones are dropped above max_snapshots.
+    While tracing, every request records the peak of traced memory above what was
+    traced when it started. Concurrent requests add up, the peak of a route is
+    therefore an upper bound of what the route allocates.
+    """
+
+    def __init__(self, max_snapshots=10):
+        self.max_snapshots = max_snapshots
+        self.snapshots = OrderedDict()
+        self.peaks = {}
+        self._active = WeakSet()
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        if not self.enabled:
+            tracemalloc.start(frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshots.clear()
+        self.peaks.clear()
+        self._active.clear()
+
+    @staticmethod
+    def capture():
+        """Returns a snapshot of the traced memory, run in an executor by the endpoints.
+        Copying the traces holds the GIL, the filtering lets the event loop run in between."""
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+
+    def take(self, name, snapshot=None):
+        """Keeps the snapshot, a new one by default, under name, replacing a snapshot of the same name"""
+        snapshot = snapshot or self.capture()
+        self.snapshots.pop(name, None)
+        self.snapshots[name] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        return snapshot
+
+    def top(self, name, group='lineno', limit=20):
+        """Returns the allocation sites holding most memory in the snapshot
+
+        Args:
+            name: Name of the snapshot
+            group: lineno, filename or traceback
+            limit: Number of sites
+
+        Returns:
+            A list of dictionaries of site, size and count
+        """
+        statistics = self.snapshots[name].statistics(group)
+        return [{'site': format_site(stat.traceback), 'size': stat.size, 'count': stat.count}
+                for stat in statistics[:limit]]
+
+    def diff(self, name, baseline, group='lineno', limit=20):
+        """Returns the allocation sites that grew most from the baseline snapshot to the snapshot"""
+        statistics = self.snapshots[name].compare_to(self.snapshots[baseline], group)
+        return [{'site': format_site(stat.traceback), 'size': stat.size, 'size_diff': stat.size_diff,
+                 'count': stat.count, 'count_diff': stat.count_diff}
+                for stat in statistics[:limit]]
+
+    def request_started(self, task):
+        """Returns the traced memory when the task starts serving a request, None if not tracing"""
+        if not self.enabled:
+            return None
+        if not self._active:
+            tracemalloc.reset_peak()
+        self._active.add(task)
+        return tracemalloc.get_traced_memory()[0]
+
+    def request_finished(self, task, route, start):
+        self._active.discard(task)
+        if not self.enabled:
+            return
+        peak = tracemalloc.get_traced_memory()[1] - start
+        if peak > self.peaks.get(route, 0):
+            self.peaks[route] = peak
+
+
+tracer = MemoryTracer()
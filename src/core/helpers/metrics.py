@@ -0,0 +1,28 @@
+from collections import defaultdict
+
+
+class Counters(object):
+    """Per-worker event counters
+
+    Every counter is identified by a name and an optional label,
+    e.g. the route the event happened on.
+    """
+
+    def __init__(self):
+        self._values = defaultdict(int)
+
+    def increment(self, name, label=None, value=1):
+        self._values[(name, label)] += value
+
+    def get(self, name, label=None):
+        return self._values.get((name, label), 0)
+
+    def snapshot(self):
+        """Returns the counters as {name: {label: value}}, events without a label are under 'total'"""
+        result = {}
+        for (name, label), value in sorted(self._values.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            result.setdefault(name, {})[label or 'total'] = value
+        return result
+
+
+counters = Counters()
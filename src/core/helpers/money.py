@@ -0,0 +1,67 @@
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+# digits of the minor unit of the currency, amounts are stored and computed as integer numbers of minor units
+# and given in major units to and by the API, e.g. 10.5 is stored as 1050
+SCALE = 2
+# largest amount of a BIGINT column
+MAX_MINOR = 2 ** 63 - 1
+
+
+def to_minor(value) -> int:
+    """Converts an amount in major units, a number or its string, to minor units
+
+    Raises:
+        ValueError: if the value is not a finite amount or is more precise than the minor unit
+    """
+    try:
+        minor = Decimal(str(value)).scaleb(SCALE)
+    except InvalidOperation:
+        raise ValueError(f"'{value}' is not an amount")
+    if not minor.is_finite():
+        raise ValueError(f"'{value}' is not an amount")
+    if minor != minor.to_integral_value():
+        raise ValueError(f"'{value}' is not an amount with at most {SCALE} decimal places")
+    return int(minor)
+
+
+def to_major(value):
+    """Converts an amount in minor units to a Decimal of major units, None stays None"""
+    return None if value is None else Decimal(value).scaleb(-SCALE)
+
+
+def format_amounts(record: dict, names) -> dict:
+    """Returns the record with the amounts of the given keys in major units"""
+    return {key: to_major(value) if key in names else value for key, value in record.items()}
+
+
+class Money(int):
+    """Non-negative amount in minor units, validated by pydantic from an amount in major units"""
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type='number', minimum=0, multipleOf=10 ** -SCALE)
+
+    @classmethod
+    def validate(cls, value):
+        value = cls(to_minor(value))
+        if not 0 <= value <= MAX_MINOR:
+            raise ValueError(f'ensure this value is between 0 and {to_major(MAX_MINOR)}')
+        return value
+
+
+class MoneyType(TypeDecorator):
+    """BIGINT column of an amount in minor units, formatted in major units at the serialization"""
+
+    impl = BigInteger
+    cache_ok = True
+
+    @property
+    def python_type(self):
+        return Money
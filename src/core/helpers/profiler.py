@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+from os.path import join, basename
+from time import monotonic, monotonic_ns, sleep
+from weakref import WeakKeyDictionary
+
+# route names of the tasks serving requests, filled by the request middleware
+routes = WeakKeyDictionary()
+
+
+def frame_name(code):
+    return f'{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Sampler(threading.Thread):
+    """Stack sampler of the event loop thread
+
+    Runs in its own thread, so the event loop is never blocked, and reads the
+    stack of the loop thread every interval. Every sample is attributed to the
+    route of the task the loop is running, '<idle>' when it runs none.
+
+    Args:
+        loop: The event loop to sample
+        duration: Seconds to sample for
+        interval: Seconds between samples
+        output: Path to also write the result to, as JSON
+    """
+
+    def __init__(self, loop, duration, interval, output=None):
+        super().__init__(name='profiler', daemon=True)
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.duration = duration
+        self.interval = interval
+        self.output = output
+        self.stacks = Counter()
+        self.finished = loop.create_future()
+
+    def run(self):
+        end = monotonic() + self.duration
+        while monotonic() < end:
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                task = asyncio.current_task(self.loop)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(routes.get(task, '<unknown>') if task is not None else '<idle>')
+                self.stacks[';'.join(reversed(stack))] += 1
+                del frame
+            sleep(self.interval)
+
+        if self.output is not None:
+            with open(f'{self.output}.tmp', 'w') as file:
+                json.dump(self.stacks, file)
+            os.replace(f'{self.output}.tmp', self.output)
+        self.loop.call_soon_threadsafe(self.finished.set_result, self.stacks)
+
+
+def collapse(stacks):
+    """Formats stacks as collapsed lines 'route;outer;...;inner count' read by flamegraph tools"""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def parent_pid(pid):
+    """Parent pid of a process read from /proc, None where /proc is not available or the process is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            # the command name in parentheses may contain spaces
+            return int(file.read().rsplit(')', 1)[1].split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Profiler(object):
+    """Sampling profiler of the workers of a server
+
+    Every worker registers in a directory of its server, named by the pid of the main
+    process, so the workers of two servers sharing the directory never signal each other.
+    A worker asked to profile all of them writes a request file for each sibling and
+    signals it with SIGUSR2, the siblings sample themselves and write their stacks next to it.
+
+    Args:
+        directory: Directory shared by the servers
+    """
+
+    SIGNAL = signal.SIGUSR2
+
+    def __init__(self, directory):
+        self.directory = join(directory, str(os.getppid()))
+        self.sampler = None
+
+    @property
+    def busy(self):
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def register(self, loop):
+        os.makedirs(self.directory, exist_ok=True)
+        open(join(self.directory, f'{os.getpid()}.worker'), 'w').close()
+        loop.add_signal_handler(self.SIGNAL, self.handle_request, loop)
+
+    def unregister(self, loop):
+        loop.remove_signal_handler(self.SIGNAL)
+        try:
+            os.remove(join(self.directory, f'{os.getpid()}.worker'))
+            # the last worker of the server removes its directory
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+    def is_sibling(self, pid):
+        """Whether pid is alive and a worker of the same server, checked by its parent where /proc is available"""
+        try:
+            os.kill(pid, 0)
+        except (ProcessLookupError, PermissionError):
+            return False
+        return parent_pid(pid) in (os.getppid(), None)
+
+    def siblings(self):
+        """Pids of the other registered workers that are alive, the files of the others are removed"""
+        pids = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.worker') or name == f'{os.getpid()}.worker':
+                continue
+            pid = int(name.split('.')[0])
+            if not self.is_sibling(pid):
+                try:
+                    os.remove(join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                continue
+            pids.append(pid)
+        return pids
+
+    def start(self, duration, interval, output=None):
+        self.sampler = Sampler(asyncio.get_running_loop(), duration, interval, output)
+        self.sampler.start()
+        return self.sampler
+
+    def handle_request(self, loop):
+        """SIGUSR2 handler, starts the sampling a sibling asked for"""
+        path = join(self.directory, f'{os.getpid()}.request')
+        try:
+            with open(path) as file:
+                request = json.load(file)
+            os.remove(path)
+        except (OSError, ValueError):
+            return
+        if not self.busy:
+            self.sampler = Sampler(loop, request['duration'], request['interval'],
+                                   join(self.directory, f"{request['id']}.{os.getpid()}.stacks"))
+            self.sampler.start()
+
+    async def profile(self, duration, interval, all_workers=False):
+        """Samples this worker, and its siblings if all_workers, for duration seconds
+
+        Returns:
+            A tuple of the merged stacks Counter and the pids of the sampled workers
+        """
+        profile_id = f'{os.getpid()}-{monotonic_ns()}'
+        siblings = []
+        for pid in self.siblings() if all_workers else []:
+            path = join(self.directory, f'{pid}.request')
+            with open(path, 'w') as file:
+                json.dump({'id': profile_id, 'duration': duration, 'interval': interval}, file)
+            try:
+                os.kill(pid, self.SIGNAL)
+            except (ProcessLookupError, PermissionError):
+                # stopped since it was listed
+                os.remove(path)
+                continue
+            siblings.append(pid)
+
+        stacks = Counter(await self.start(duration, interval).finished)
+        pids = [os.getpid()]
+
+        # siblings finish at about the same time, a busy one may not answer at all
+        waiting = {pid: join(self.directory, f'{profile_id}.{pid}.stacks') for pid in siblings}
+        end = monotonic() + max(1.0, duration * 0.1)
+        while waiting and monotonic() < end:
+            for pid, path in list(waiting.items()):
+                try:
+                    with open(path) as file:
+                        stacks.update(json.load(file))
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                pids.append(pid)
+                del waiting[pid]
+            if waiting:
+                await asyncio.sleep(0.05)
+        return stacks, pids
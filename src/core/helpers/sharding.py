@@ -0,0 +1,89 @@
+import asyncio
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash
+
+    Maps a key to one of buckets so that adding a bucket moves only 1/buckets of the keys
+    ref: https://arxiv.org/abs/1406.2294
+
+    Args:
+        key: Non-negative integer
+        buckets: Number of buckets
+
+    Returns:
+        The bucket of the key, from 0 to buckets - 1
+    """
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardRouter(object):
+    """Maps a user to the database holding his ledger
+
+    Args:
+        factories: Session factories of the shards, none when the ledger is in the global database
+    """
+
+    def __init__(self, factories=()):
+        self.factories = list(factories)
+
+    @property
+    def sharded(self):
+        return bool(self.factories)
+
+    def shard_of(self, user_id):
+        return jump_hash(user_id, len(self.factories)) if self.factories else 0
+
+
+class ShardSessions(object):
+    """Sessions of a request on the shards, each opened on first use
+
+    Without shards the ledger is in the global database and every shard session is the
+    global session of the request. Sessions of the shards share the info of the global
+    session, e.g. the deadline of the request.
+
+    Args:
+        router: ShardRouter of the worker
+        session: Global session of the request
+    """
+
+    def __init__(self, router, session):
+        self.router = router
+        self.session = session
+        self.sessions = {}
+
+    @property
+    def sharded(self):
+        return self.router.sharded
+
+    def get(self, shard):
+        if not self.router.sharded:
+            return self.session
+        if shard not in self.sessions:
+            session = self.router.factories[shard]()
+            session.info.update(self.session.info)
+            self.sessions[shard] = session
+        return self.sessions[shard]
+
+    def for_user(self, user_id):
+        return self.get(self.router.shard_of(user_id))
+
+    def all(self):
+        return [self.get(shard) for shard in range(len(self.router.factories) or 1)]
+
+    async def gather(self, function):
+        """Runs function(session) on every shard concurrently
+
+        Returns:
+            The list of the results by shard
+        """
+        return await asyncio.gather(*(function(session) for session in self.all()))
+
+    async def close(self):
+        sessions, self.sessions = self.sessions, {}
+        await asyncio.gather(*(session.close() for session in sessions.values()))
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import getrandbits, random
+from time import time_ns
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# span of the code running in the current task, None outside a request
+current_span = ContextVar('current_span', default=None)
+
+
+def parse_traceparent(header):
+    """Parsing a W3C traceparent header
+
+    ref: https://www.w3.org/TR/trace-context/#traceparent-header
+
+    Args:
+        header: Value of the traceparent header
+
+    Returns:
+        A tuple of trace id, parent span id and sampled flag, None if the header is invalid
+    """
+    match = TRACEPARENT.match(header.strip().lower())
+    if not match or set(match.group(1)) == {'0'} or set(match.group(2)) == {'0'}:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class Span(object):
+    """A timed operation of a trace, only sampled spans are exported"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'sampled', 'start', 'end', 'status',
+                 'attributes')
+
+    def __init__(self, trace_id, parent_id, name, kind, sampled, attributes):
+        self.trace_id = trace_id
+        self.span_id = f'{getrandbits(64) or 1:016x}'
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start = time_ns()
+        self.end = None
+        self.status = 'ok'
+        self.attributes = attributes
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def fail(self, exception):
+        self.status = 'error'
+        self.attributes['error'] = repr(exception)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.start,
+            'end': self.end,
+            'duration_ms': (self.end - self.start) / 1e6,
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+class BatchExporter(object):
+    """Collects finished spans and writes them in batches
+
+    A batch is written when it is full or, if run() is scheduled, every interval seconds.
+    """
+
+    def __init__(self, batch_size=512, interval=1.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batch = []
+
+    def export(self, span):
+        self.batch.append(span)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        if batch:
+            self.write(batch)
+
+    def write(self, spans):
+        raise NotImplementedError
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+
+class MemoryExporter(BatchExporter):
+    """Keeps the spans in memory, for tests"""
+
+    def __init__(self):
+        super().__init__(batch_size=1)
+        self.spans = []
+
+    def write(self, spans):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans.clear()
+
+
+class FileExporter(BatchExporter):
+    """Appends the spans to a file as JSON lines, a batch per write"""
+
+    def __init__(self, path, batch_size=512, interval=1.0):
+        super().__init__(batch_size, interval)
+        self.path = path
+
+    def write(self, spans):
+        data = ''.join(json.dumps(span.to_dict()) + '\n' for span in spans).encode()
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self.append, data)
+        except RuntimeError:  # no running loop, e.g. flushing at shutdown
+            self.append(data)
+
+    def append(self, data):
+        with open(self.path, 'ab') as file:
+            file.write(data)
+
+
+class Tracer(object):
+    """Head-sampled tracer
+
+    The sampling decision is taken once per trace: a request carrying a traceparent
+    follows the decision of its caller, other requests are sampled with sample_rate.
+    Children of an unsampled span are not created at all, so unsampled requests
+    cost a single Span object.
+    """
+
+    def __init__(self, exporter=None, sample_rate=0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def configure(self, exporter, sample_rate):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name, traceparent=None, **attributes):
+        """Starts the root span of the process for a trace, continuing the one of traceparent"""
+        parent = parse_traceparent(traceparent) if traceparent else None
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = f'{getrandbits(128) or 1:032x}', None
+            sampled = random() < self.sample_rate
+        return Span(trace_id, parent_id, name, 'server', sampled and self.exporter is not None, attributes)
+
+    def start_span(self, name, kind='internal', **attributes):
+        """Starts a child of the current span, None if the trace is not sampled"""
+        parent = current_span.get()
+        if parent is None or not parent.sampled:
+            return None
+        return Span(parent.trace_id, parent.span_id, name, kind, True, attributes)
+
+    def end(self, span, **attributes):
+        if span is None or not span.sampled or span.end is not None:
+            return
+        span.end = time_ns()
+        span.attributes.update(attributes)
+        self.exporter.export(span)
+
+    @contextmanager
+    def span(self, name, kind='internal', **attributes):
+        """Runs the block in a child span of the current span"""
+        span = self.start_span(name, kind, **attributes)
+        if span is None:
+            yield None
+            return
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as exception:
+            span.fail(exception)
+            raise
+        finally:
+            current_span.reset(token)
+            self.end(span)
+
+    def traceparent(self):
+        """traceparent header to propagate the current trace to outgoing calls, None outside a trace"""
+        span = current_span.get()
+        return span.traceparent if span is not None else None
+
+
+tracer = Tracer()
+
+
+class TracedPool(AsyncAdaptedQueuePool):
+    """Connection pool recording the wait for a connection as a span"""
+
+    def connect(self):
+        span = tracer.start_span('db.pool.checkout', 'client', **{'db.pool.size': self.size()})
+        if span is None:
+            return super().connect()
+        try:
+            return super().connect()
+        except BaseException as exception:
+            span.fail(exception)
+            raise
+        finally:
+            tracer.end(span, **{'db.pool.checked_out': self.checkedout()})
+
+
+def instrument(engine):
+    """Records every statement executed by the engine as a span"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(connection, cursor, statement, parameters, context, executemany):
+        span = tracer.start_span('db.statement', 'client', **{'db.system': 'postgresql', 'db.statement': statement})
+        if span is not None:
+            connection.info.setdefault('trace_spans', []).append(span)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(connection, cursor, statement, parameters, context, executemany):
+        spans = connection.info.get('trace_spans')
+        if spans:
+            tracer.end(spans.pop(), **{'db.rows': cursor.rowcount})
+
+    @event.listens_for(engine, 'handle_error')
+    def fail_statement(context):
+        spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+        if spans:
+            span = spans.pop()
+            span.fail(context.original_exception)
+            tracer.end(span)
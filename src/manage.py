@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from operator import itemgetter
+from os.path import join, splitext
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+from apps.auth.services import IMPORT_FORMATS, parse_users, import_users
+from apps.dimatech.partitions import PARTITIONED_TABLES, month_start, add_months, ensure_partitions, \
+    archive_partitions, restore_partition
+from apps.dimatech.reconciliation import reconcile
+from server import create_app
+
+
+def asyncpg_url(url: str) -> str:
+    return make_url(url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+def ledger_databases(config) -> list:
+    """
+    Returns the name and the asyncpg url of every database of the ledger, the shards or the global database
+    """
+    databases = []
+    for url in config.DB_SHARD_URLS or [config.DB_URL]:
+        url = make_url(url)
+        databases.append((f'{url.host}-{url.port}-{url.database}', asyncpg_url(url)))
+    return databases
+
+
+async def import_file(config, args) -> dict:
+    """
+    Imports the users of a CSV or NDJSON file, the format is guessed from the extension unless given
+
+    Returns: the number of created users and bills and the errors of the rows not created
+    """
+    content_format = args.format or ('csv' if splitext(args.file)[1].lower() == '.csv' else 'ndjson')
+    with open(args.file, 'rb') as file:
+        users, errors = parse_users(file.read(), content_format)
+    with ProcessPoolExecutor(args.processes or config.IMPORT_PROCESSES) as pool:
+        report = await import_users(asyncpg_url(config.DB_URL), [asyncpg_url(url) for url in config.DB_SHARD_URLS],
+                                    users, args.bills, pool, config.IMPORT_CHUNK_SIZE)
+    report['errors'] = sorted(errors + report['errors'], key=itemgetter('row'))
+    return report
+
+
+async def run(config, args) -> dict:
+    """
+    Runs the command on every database of the ledger one after the other, the import of users
+    on the global database
+
+    Returns: the result of the command by database
+    """
+    if args.command == 'import-users':
+        return await import_file(config, args)
+
+    results = {}
+    for name, url in ledger_databases(config):
+        if args.command == 'reconcile':
+            results[name] = await reconcile(url, args.connections or config.RECONCILE_CONNECTIONS,
+                                            args.chunk_size or config.RECONCILE_CHUNK_SIZE,
+                                            config.RECONCILE_MARGIN, args.full)
+            continue
+
+        directory = join(config.ARCHIVE_DIR, name)
+        connection = await asyncpg.connect(url)
+        try:
+            if args.command == 'partitions':
+                results[name] = await ensure_partitions(connection, config.PARTITIONS_AHEAD)
+            elif args.command == 'archive':
+                months = config.ARCHIVE_AFTER_MONTHS if args.months is None else args.months
+                before = add_months(month_start(datetime.now(timezone.utc)), -months)
+                results[name] = await archive_partitions(connection, directory, before)
+            elif args.command == 'restore':
+                results[name] = await restore_partition(connection, directory, args.table, args.month)
+        finally:
+            await connection.close()
+    return results
+
+
+def month(value: str) -> datetime:
+    return datetime.strptime(value, '%Y-%m').replace(tzinfo=timezone.utc)
+
+
+# Maintenance commands of the databases, run where the app is deployed, e.g. by cron:
+# python manage.py archive
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintenance of the databases of the ledger')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('partitions', help='Create the partitions of the current and next months, as the app does')
+    archive = commands.add_parser('archive', help='Detach the partitions of old months and archive them to '
+                                                  'ARCHIVE_DIR as gzipped CSV')
+    archive.add_argument('--months', help='Months kept in the databases, default to ARCHIVE_AFTER_MONTHS', type=int)
+    restore = commands.add_parser('restore', help='Load an archived month back into the databases')
+    restore.add_argument('table', choices=PARTITIONED_TABLES)
+    restore.add_argument('month', help='Month as YYYY-MM', type=month)
+    reconciliation = commands.add_parser('reconcile', help='Check the balances of the bills changed since the last '
+                                                           'reconciliation and report the mismatches, null if one runs')
+    reconciliation.add_argument('--full', help='Check every bill', action='store_true')
+    reconciliation.add_argument('--connections', help='Connections checking bills in parallel, '
+                                                 'default to RECONCILE_CONNECTIONS', type=int)
+    reconciliation.add_argument('--chunk-size', help='Bills checked at once, default to RECONCILE_CHUNK_SIZE', type=int)
+    imports = commands.add_parser('import-users', help='Create the users of a CSV file with a header or of a NDJSON '
+                                                       'file and report the rows not created')
+    imports.add_argument('file')
+    imports.add_argument('--format', help='Format of the file, guessed from its extension by default',
+                         choices=IMPORT_FORMATS)
+    imports.add_argument('--bills', help='Create a bill for every user', action='store_true')
+    imports.add_argument('--processes', help='Processes hashing the passwords, default to IMPORT_PROCESSES', type=int)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(create_app().config, args)), indent=2))
@@ -27,6 +27,15 @@ config.set_section_option(section, "DB_PASS", environ.get("DB_PASSWORD"))
 config.set_section_option(section, "DB_HOST", environ.get("DB_HOST"))
 config.set_section_option(section, "DB_PORT", environ.get("DB_PORT"))
 
+# a shard of the ledger is migrated with -x db=host:port/name -x shard=index/count
+database = context.get_x_argument(as_dictionary=True).get("db")
+if database is not None:
+    address, name = database.rsplit("/", 1)
+    host, port = address.rsplit(":", 1)
+    config.set_section_option(section, "DB_NAME", name)
+    config.set_section_option(section, "DB_HOST", host)
+    config.set_section_option(section, "DB_PORT", port)
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
@@ -0,0 +1,25 @@
+"""user_data_version
+
+Revision ID: 3f9a1c2e5b7d
+Revises: a7516d8bd01f
+Create Date: 2026-10-18 10:12:41.530218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2e5b7d'
+down_revision = 'a7516d8bd01f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('user_data_version',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
@@ -0,0 +1,25 @@
+"""catalog_version
+
+Revision ID: 9b2e4d7a1c35
+Revises: 3f9a1c2e5b7d
+Create Date: 2026-10-18 11:03:17.204951
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2e4d7a1c35'
+down_revision = '3f9a1c2e5b7d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    catalog_version = op.create_table('catalog_version',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.bulk_insert(catalog_version, [{'id': 1, 'version': 0}])
@@ -0,0 +1,104 @@
+"""money_minor_units
+
+Revision ID: a9c4e2f7b316
+Revises: f6a1b3c8d047
+Create Date: 2026-10-19 20:41:17.502318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a9c4e2f7b316'
+down_revision = 'f6a1b3c8d047'
+branch_labels = None
+depends_on = None
+
+# digits of the minor unit, see core.helpers.money
+SCALE = 2
+# rows updated by a transaction of the backfill
+BATCH_SIZE = 10000
+
+# the key paging the backfill, the amount columns and whether they are required by table
+TABLES = {
+    'product': ('id', {'price': True}),
+    'customer_bill': ('id', {'balance': True}),
+    'transaction': ('id', {'amount': True}),
+    'purchase': ('id', {'price': False}),
+    'archived_total': ('bill_id', {'transactions': True, 'purchases': True}),
+}
+# indexed amount columns, the index of a partitioned table is built on each partition then attached
+INDEXES = {'product': 'price', 'transaction': 'amount'}
+
+
+def partitions(table):
+    """Returns the partitions of a partitioned table, the table itself otherwise"""
+    rows = op.get_bind().execute(sa.text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"), {'table': f'"{table}"'})
+    return [row[0] for row in rows] or [table]
+
+
+def sync_statements(columns):
+    """Returns the statements of the trigger keeping the numeric and the minor unit columns of a row in sync
+
+    Workers of the previous release write the numeric columns and workers of this release the minor unit
+    columns until every worker runs this release, the column written by the statement wins.
+    """
+    factor = 10 ** SCALE
+    inserted = ' '.join(f'IF NEW.{column}_minor IS NULL THEN NEW.{column}_minor = round(NEW.{column} * {factor}); '
+                        f'ELSE NEW.{column} = NEW.{column}_minor::numeric / {factor}; END IF;' for column in columns)
+    updated = ' '.join(f'IF NEW.{column}_minor IS DISTINCT FROM OLD.{column}_minor '
+                       f'THEN NEW.{column} = NEW.{column}_minor::numeric / {factor}; '
+                       f'ELSIF NEW.{column} IS DISTINCT FROM OLD.{column} '
+                       f'THEN NEW.{column}_minor = round(NEW.{column} * {factor}); END IF;' for column in columns)
+    return f"IF TG_OP = 'INSERT' THEN {inserted} ELSE {updated} END IF;"
+
+
+def upgrade() -> None:
+    # expand step of the move of the amounts from numeric in major units to bigint in minor units:
+    # <column>_minor columns are added, kept in sync with the numeric columns by triggers and backfilled
+    # by batches without locking the tables for long. The app of this release reads and writes the minor
+    # unit columns, the workers of the previous release keep writing the numeric ones while it is rolled out.
+    # The contract step, b5f2e8a1c7d4_money_contract, drops the numeric columns once no worker writes them.
+    for table, (key, columns) in TABLES.items():
+        for column in columns:
+            op.add_column(table, sa.Column(f'{column}_minor', sa.BigInteger(), nullable=True))
+        op.execute(f'CREATE FUNCTION {table}_minor_units() RETURNS trigger AS $$ '
+                   f'BEGIN {sync_statements(columns)} RETURN NEW; END $$ LANGUAGE plpgsql')
+        op.execute(f'CREATE TRIGGER {table}_minor_units BEFORE INSERT OR UPDATE ON "{table}" '
+                   f'FOR EACH ROW EXECUTE FUNCTION {table}_minor_units()')
+
+    # the bills updated by the batches are checked again by the next reconciliation
+    with op.get_context().autocommit_block():
+        for table, (key, columns) in TABLES.items():
+            last = op.get_bind().execute(sa.text(f'SELECT coalesce(max({key}), 0) FROM "{table}"')).scalar()
+            assignments = ', '.join(f'{column}_minor = round({column} * {10 ** SCALE})' for column in columns)
+            pending = ' OR '.join(f'{column}_minor IS NULL' for column in columns)
+            for start in range(0, last, BATCH_SIZE):
+                op.execute(f'UPDATE "{table}" SET {assignments} WHERE ({pending}) '
+                           f'AND {key} > {start} AND {key} <= {start + BATCH_SIZE}')
+
+            # validated constraints let the columns be set NOT NULL without scanning the tables
+            for partition in partitions(table):
+                for column in (column for column, required in columns.items() if required):
+                    op.execute(f'ALTER TABLE "{partition}" ADD CONSTRAINT {partition}_{column}_minor_check '
+                               f'CHECK ({column}_minor IS NOT NULL) NOT VALID')
+                    op.execute(f'ALTER TABLE "{partition}" VALIDATE CONSTRAINT {partition}_{column}_minor_check')
+
+        for table, column in INDEXES.items():
+            if partitions(table) == [table]:
+                op.execute(f'CREATE INDEX CONCURRENTLY ix_{table}_{column}_minor ON "{table}" ({column}_minor)')
+                continue
+            # partitions created from now on get the index with the table
+            op.execute(f'CREATE INDEX ix_{table}_{column}_minor ON ONLY "{table}" ({column}_minor)')
+            for partition in partitions(table):
+                op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {partition}_{column}_minor_idx '
+                           f'ON {partition} ({column}_minor)')
+                op.execute(f'ALTER INDEX ix_{table}_{column}_minor ATTACH PARTITION {partition}_{column}_minor_idx')
+
+    for table, (key, columns) in TABLES.items():
+        for column in (column for column, required in columns.items() if required):
+            op.alter_column(table, f'{column}_minor', nullable=False)
+            for partition in partitions(table):
+                op.drop_constraint(f'{partition}_{column}_minor_check', partition, type_='check')
@@ -0,0 +1,37 @@
+"""money_contract
+
+Revision ID: b5f2e8a1c7d4
+Revises: e8b1d5c2a693
+Create Date: 2026-10-20 10:12:05.318442
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b5f2e8a1c7d4'
+down_revision = 'e8b1d5c2a693'
+# a rolling update stops at e8b1d5c2a693 until every worker of every node runs the release reading
+# and writing the minor unit columns, see the README
+branch_labels = None
+depends_on = None
+
+# numeric columns in major units by table, replaced by the <column>_minor columns of a9c4e2f7b316
+TABLES = {
+    'product': ('price',),
+    'customer_bill': ('balance',),
+    'transaction': ('amount',),
+    'purchase': ('price',),
+    'archived_total': ('transactions', 'purchases'),
+}
+
+
+def upgrade() -> None:
+    # contract step of the move to minor units, a worker of the previous release would fail to write
+    for table, columns in TABLES.items():
+        op.execute(f'DROP TRIGGER {table}_minor_units ON "{table}"')
+        op.execute(f'DROP FUNCTION {table}_minor_units()')
+        # the indexes of the numeric columns are dropped with them
+        for column in columns:
+            op.drop_column(table, column)
+    for column in TABLES['archived_total']:
+        op.alter_column('archived_total', f'{column}_minor', server_default='0')
@@ -0,0 +1,46 @@
+"""shard_ledger
+
+Revision ID: b8d1f4e6a023
+Revises: e5a8c7b3d912
+Create Date: 2026-10-19 13:08:45.502716
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d1f4e6a023'
+down_revision = 'e5a8c7b3d912'
+branch_labels = None
+depends_on = None
+
+# users and products stay in the global database, no foreign key can reach them from a shard
+GLOBAL_FOREIGN_KEYS = [
+    ('customer_bill', 'customer_bill_user_id_fkey'),
+    ('transaction', 'transaction_user_id_fkey'),
+    ('purchase', 'purchase_user_id_fkey'),
+    ('purchase', 'purchase_product_id_fkey'),
+    ('user_data_version', 'user_data_version_user_id_fkey'),
+]
+
+LEDGER_TABLES = ['customer_bill', 'transaction', 'purchase']
+
+
+def upgrade() -> None:
+    # a shard of the ledger is migrated with -x db=host:port/name -x shard=index/count,
+    # the global database is left as is
+    shard = context.get_x_argument(as_dictionary=True).get('shard')
+    if shard is None:
+        return
+    index, count = (int(value) for value in shard.split('/'))
+
+    for table, constraint in GLOBAL_FOREIGN_KEYS:
+        op.drop_constraint(constraint, table, type_='foreignkey')
+
+    # the shards draw ids from interleaved sequences so a record id is unique across the shards
+    for table in LEDGER_TABLES:
+        op.execute(sa.text(
+            f"ALTER SEQUENCE {table}_id_seq INCREMENT BY {count}; "
+            f"SELECT setval('{table}_id_seq', "
+            f"(coalesce((SELECT max(id) FROM \"{table}\"), 0) / {count} + 1) * {count} + {index + 1}, false)"))
@@ -0,0 +1,35 @@
+"""filter_indexes
+
+Revision ID: c41d8e6f2a90
+Revises: 9b2e4d7a1c35
+Create Date: 2026-10-18 12:26:05.918342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d8e6f2a90'
+down_revision = '9b2e4d7a1c35'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('product', 'price'),
+    ('customer_bill', 'user_id'),
+    ('transaction', 'user_id'),
+    ('transaction', 'bill_id'),
+    ('transaction', 'amount'),
+    ('purchase', 'product_id'),
+    ('purchase', 'user_id'),
+    ('purchase', 'bill_id'),
+]
+
+
+def upgrade() -> None:
+    # built concurrently so the ledger tables stay writable meanwhile
+    with op.get_context().autocommit_block():
+        for table, column in INDEXES:
+            op.create_index(op.f(f'ix_{table}_{column}'), table, [column], unique=False,
+                            postgresql_concurrently=True)
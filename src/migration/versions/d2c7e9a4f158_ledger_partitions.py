@@ -0,0 +1,89 @@
+"""ledger_partitions
+
+Revision ID: d2c7e9a4f158
+Revises: b8d1f4e6a023
+Create Date: 2026-10-19 15:27:03.614480
+
+"""
+from datetime import datetime, timezone
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2c7e9a4f158'
+down_revision = 'b8d1f4e6a023'
+branch_labels = None
+depends_on = None
+
+# the indexed columns and the foreign keys of the tables partitioned by month of created_at
+TABLES = {
+    'transaction': {
+        'indexes': ['user_id', 'bill_id', 'amount'],
+        'foreign_keys': [('user_id', 'user', True), ('bill_id', 'customer_bill', False)],
+    },
+    'purchase': {
+        'indexes': ['product_id', 'user_id', 'bill_id'],
+        'foreign_keys': [('product_id', 'product', True), ('user_id', 'user', True),
+                         ('bill_id', 'customer_bill', False)],
+    },
+}
+
+# months of partitions created ahead, the app keeps creating them, see apps.dimatech.partitions
+PARTITIONS_AHEAD = 3
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def upgrade() -> None:
+    # the existing rows have no known creation time, they are stamped with the time of the migration
+    # and the existing table becomes the partition of the rows until the next month, nothing is copied
+    now = datetime.now(timezone.utc)
+    month = datetime(now.year, now.month, 1, tzinfo=timezone.utc)
+    bound = add_months(month, 1).isoformat()
+    # a shard has no foreign key to the users and products of the global database
+    shard = context.get_x_argument(as_dictionary=True).get('shard') is not None
+
+    # the indexes and the constraint matching the partition are built beforehand without blocking writes,
+    # so attaching the table neither builds indexes nor scans it
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            partition = f'{table}_y{month.year}m{month.month:02}'
+            op.execute(f'ALTER TABLE "{table}" ADD COLUMN created_at TIMESTAMP WITH TIME ZONE '
+                       f'DEFAULT now() NOT NULL')
+            op.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {partition}_id_created_at_key '
+                       f'ON "{table}" (id, created_at)')
+            op.execute(f'CREATE INDEX CONCURRENTLY {partition}_created_at_idx ON "{table}" (created_at)')
+            op.execute(f"ALTER TABLE \"{table}\" ADD CONSTRAINT {partition}_created_at_check "
+                       f"CHECK (created_at < '{bound}') NOT VALID")
+            op.execute(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT {partition}_created_at_check')
+
+    for table, definition in TABLES.items():
+        partition = f'{table}_y{month.year}m{month.month:02}'
+        op.rename_table(table, partition)
+        # the primary key of a partition must include the partition key as the one of the table
+        op.execute(f'ALTER TABLE {partition} DROP CONSTRAINT {table}_pkey, '
+                   f'ADD CONSTRAINT {partition}_pkey PRIMARY KEY USING INDEX {partition}_id_created_at_key')
+        for column in definition['indexes']:
+            op.execute(f'ALTER INDEX ix_{table}_{column} RENAME TO {partition}_{column}_idx')
+
+        op.execute(f'CREATE TABLE "{table}" (LIKE {partition} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)')
+        op.create_primary_key(f'{table}_pkey', table, ['id', 'created_at'])
+        for column in definition['indexes'] + ['created_at']:
+            op.create_index(op.f(f'ix_{table}_{column}'), table, [column], unique=False)
+        for column, referent, is_global in definition['foreign_keys']:
+            if not (shard and is_global):
+                op.create_foreign_key(None, table, referent, [column], ['id'], ondelete='CASCADE')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY "{table}".id')
+
+        op.execute(f"ALTER TABLE \"{table}\" ATTACH PARTITION {partition} FOR VALUES FROM (MINVALUE) TO ('{bound}')")
+        op.drop_constraint(f'{partition}_created_at_check', partition, type_='check')
+
+        for index in range(1, PARTITIONS_AHEAD + 1):
+            start = add_months(month, index)
+            op.execute(f"CREATE TABLE {table}_y{start.year}m{start.month:02} PARTITION OF \"{table}\" "
+                       f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')")
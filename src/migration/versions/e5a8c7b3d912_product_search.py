@@ -0,0 +1,32 @@
+"""product_search
+
+Revision ID: e5a8c7b3d912
+Revises: c41d8e6f2a90
+Create Date: 2026-10-19 09:42:11.381207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a8c7b3d912'
+down_revision = 'c41d8e6f2a90'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = "setweight(to_tsvector('english', coalesce(title, '')), 'A') || " \
+                "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # the stored column is computed for every existing row while the table is locked
+    op.add_column('product', sa.Column('search_vector', postgresql.TSVECTOR(),
+                                       sa.Computed(SEARCH_VECTOR, persisted=True), nullable=True))
+    with op.get_context().autocommit_block():
+        op.create_index('ix_product_search_vector', 'product', ['search_vector'], unique=False,
+                        postgresql_using='gin', postgresql_concurrently=True)
+        op.create_index('ix_product_title_trgm', 'product', ['title'], unique=False, postgresql_using='gin',
+                        postgresql_ops={'title': 'gin_trgm_ops'}, postgresql_concurrently=True)
@@ -0,0 +1,35 @@
+"""background_deletions
+
+Revision ID: e8b1d5c2a693
+Revises: c3e7a2d9f481
+Create Date: 2026-10-19 23:02:48.731560
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e8b1d5c2a693'
+down_revision = 'c3e7a2d9f481'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # nullable columns without a default are added without rewriting the tables
+    op.add_column('user', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('customer_bill', sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_table('deletion',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('target_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), server_default='pending', nullable=False),
+    sa.Column('total', sa.BigInteger(), nullable=True),
+    sa.Column('deleted', sa.BigInteger(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('locked_until', sa.DateTime(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_deletion_status'), 'deletion', ['status'], unique=False)
@@ -0,0 +1,104 @@
+"""reconciliation
+
+Revision ID: f6a1b3c8d047
+Revises: d2c7e9a4f158
+Create Date: 2026-10-19 18:04:52.270913
+
+"""
+from os import environ
+
+from alembic import context, op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f6a1b3c8d047'
+down_revision = 'd2c7e9a4f158'
+branch_labels = None
+depends_on = None
+
+# purchases updated by a transaction of the backfill
+BATCH_SIZE = 10000
+
+
+def catalog_prices():
+    """Returns the prices of the products of the purchases of a shard read from the global database,
+    None when the migrated database is the global one
+
+    Raises:
+        RuntimeError: if purchases of the shard refer to products missing from the global database,
+            before anything is changed
+    """
+    if context.get_x_argument(as_dictionary=True).get('shard') is None:
+        return None
+    product_ids = [row[0] for row in op.get_bind().execute(sa.text('SELECT DISTINCT product_id FROM purchase'))]
+    if not product_ids:
+        return {}
+
+    # env.py points the migration to the shard, the environment still describes the global database
+    engine = sa.create_engine(sa.engine.URL.create(
+        'postgresql', username=environ.get('DB_USER'), password=environ.get('DB_PASSWORD'),
+        host=environ.get('DB_HOST'), port=int(environ.get('DB_PORT', 5432)), database=environ.get('DB_NAME')))
+    try:
+        with engine.connect() as connection:
+            columns = {row[0] for row in connection.execute(sa.text(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = 'product'"))}
+            # the global database may have moved to minor units already, see a9c4e2f7b316
+            price = 'price' if 'price' in columns else 'price_minor::numeric / 100'
+            prices = dict(connection.execute(sa.text(f'SELECT id, {price} FROM product WHERE id = ANY(:ids)'),
+                                             {'ids': product_ids}).all())
+    finally:
+        engine.dispose()
+
+    missing = sorted(set(product_ids) - set(prices))
+    if missing:
+        raise RuntimeError(f'Purchases of the shard refer to products missing from the global database '
+                           f'{missing[:20]}, their price is unknown. Delete them and migrate again.')
+    return prices
+
+
+def upgrade() -> None:
+    prices = catalog_prices()
+
+    op.add_column('purchase', sa.Column('price', sa.Numeric(), nullable=True))
+    op.add_column('customer_bill', sa.Column('changed_at', sa.DateTime(timezone=True),
+                                             server_default=sa.text('now()'), nullable=False))
+    op.execute("CREATE FUNCTION customer_bill_changed() RETURNS trigger AS $$ "
+               "BEGIN NEW.changed_at = now(); RETURN NEW; END $$ LANGUAGE plpgsql")
+    op.execute("CREATE TRIGGER customer_bill_changed BEFORE UPDATE ON customer_bill "
+               "FOR EACH ROW EXECUTE FUNCTION customer_bill_changed()")
+
+    op.create_table('archived_total',
+    sa.Column('bill_id', sa.Integer(), nullable=False),
+    sa.Column('transactions', sa.Numeric(), server_default='0', nullable=False),
+    sa.Column('purchases', sa.Numeric(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['bill_id'], ['customer_bill.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('bill_id')
+    )
+    op.create_table('reconciliation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('checked_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('since', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('position', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('INSERT INTO reconciliation (id) VALUES (1)')
+
+    # the purchases made so far were charged the current price of their product, recorded by batches
+    # so the purchases stay writable. The products of a shard are copied from the global database first.
+    with op.get_context().autocommit_block():
+        source = 'product'
+        if prices is not None:
+            source = 'product_price'
+            op.execute('CREATE TEMPORARY TABLE product_price (id integer PRIMARY KEY, price numeric)')
+            if prices:
+                op.get_bind().execute(sa.text('INSERT INTO product_price (id, price) VALUES (:id, :price)'),
+                                      [{'id': product_id, 'price': price} for product_id, price in prices.items()])
+
+        last = op.get_bind().execute(sa.text('SELECT coalesce(max(id), 0) FROM purchase')).scalar()
+        for start in range(0, last, BATCH_SIZE):
+            op.execute(f'UPDATE purchase SET price = {source}.price FROM {source} '
+                       f'WHERE purchase.product_id = {source}.id AND purchase.price IS NULL '
+                       f'AND purchase.id > {start} AND purchase.id <= {start + BATCH_SIZE}')
+        if prices is not None:
+            op.execute('DROP TABLE product_price')
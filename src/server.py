@@ -1,47 +1,77 @@
 import argparse
+from os import cpu_count
 
 from sanic import Sanic
 
+try:
+    from sanic.worker.loader import AppLoader
+except ImportError:  # sanic < 22.9 forks the workers from the app of the main process
+    AppLoader = None
+
 from apps.auth import blueprint as auth_app
+from apps.diagnostics import blueprint as diagnostics_app
 from apps.dimatech import blueprint as dimatech_app
+from apps.health import blueprint as health_app
 from apps.payment import blueprint as payment_app
-from core.extentions.exceptions import blueprint as ext_exceptions
-from core.extentions.middlewares import blueprint as ext_middlewares
+from core.extentions.exceptions import extension as ext_exceptions
+from core.extentions.middlewares import extension as ext_middlewares
 from settings import Settings
 
 
-# Configure Sanic apps
-app = Sanic(__name__)
+def create_app(name='dimatech'):
+    """Application factory
+
+    Building the app has no side effects: the database engine of every worker
+    is created when the worker starts, see Settings.setup_database.
+    Can be served by the Sanic CLI: sanic server:create_app --factory
+    """
+    # Configure Sanic apps
+    app = Sanic(name)
 
-settings = Settings(app)
-app.update_config(settings)
+    settings = Settings(app)
+    app.update_config(settings)
 
-# Install extentions
-app.blueprint(ext_exceptions)
-app.blueprint(ext_middlewares)
+    # Install extentions, applied to every route
+    ext_exceptions.install(app)
+    ext_middlewares.install(app)
 
-# Install apps
-app.blueprint(auth_app)
-app.blueprint(dimatech_app)
-app.blueprint(payment_app)
+    # Install apps
+    app.blueprint(auth_app)
+    app.blueprint(dimatech_app)
+    app.blueprint(payment_app)
+    app.blueprint(diagnostics_app)
+    app.blueprint(health_app)
+    return app
 
-# Command line parser options & setup default values
-parser = argparse.ArgumentParser()
-parser.add_argument('--host', help='Setup host ip to listen up, default to 0.0.0.0', default='0.0.0.0')
-parser.add_argument('--port', help='Setup port to attach, default to 8080', type=int, default=8000)
-parser.add_argument('--workers', help='Setup workers to run, default to 1', type=int, default=1)
-parser.add_argument('--debug', help='Enable or disable debugging', default=app.config.DEBUG)
-parser.add_argument('--accesslog', help='Enable or disable access log', default=app.config.DEBUG)
-args = parser.parse_args()
 
 # Running sanic, we need to make sure directly run by interpreter
 # ref: http://sanic.readthedocs.io/en/latest/sanic/deploying.html#running-via-command
 if __name__ == '__main__':
-    app.run(
+    app = create_app()
+
+    # Command line parser options & setup default values
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='Setup host ip to listen up, default to 0.0.0.0', default='0.0.0.0')
+    parser.add_argument('--port', help='Setup port to attach, default to 8080', type=int, default=8000)
+    parser.add_argument('--unix', help='Listen on a unix domain socket at this path instead of host and port')
+    parser.add_argument('--workers', help='Setup workers to run, default to the number of CPUs', type=int,
+                        default=cpu_count() or 1)
+    parser.add_argument('--debug', help='Enable or disable debugging', default=app.config.DEBUG)
+    parser.add_argument('--accesslog', help='Enable or disable access log', default=app.config.DEBUG)
+    args = parser.parse_args()
+
+    options = dict(
         host=args.host,
         port=args.port,
+        unix=args.unix,
         workers=args.workers,
         debug=args.debug,
         auto_reload=args.debug,
         access_log=args.accesslog
     )
+    if AppLoader is None:
+        app.run(**options)
+    else:
+        # spawned workers build their own app with the factory
+        app.prepare(**options)
+        Sanic.serve(primary=app, app_loader=AppLoader(factory=create_app))
@@ -1,12 +1,30 @@
+import asyncio
 from contextvars import ContextVar
 from datetime import timedelta
-from os import environ
+from os import environ, getpid, cpu_count
 from os.path import join, dirname
+from tempfile import gettempdir
+from time import monotonic
 
 import dotenv
+from sanic.log import logger
 from sanic_jwt_extended.jwt_manager import JWT
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+
+from core.helpers import tracing
+from core.helpers.breaker import CircuitBreaker, GuardedPool, guard
+from core.helpers.sharding import ShardRouter, ShardSessions
+
+
+@event.listens_for(Session, "after_begin")
+def apply_deadline(session, transaction, connection):
+    # bounds the statements of the transaction by the time left to the request
+    deadline = session.info.get("deadline")
+    if deadline is not None:
+        timeout = max(1, int((deadline - monotonic()) * 1000))
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {timeout}")
 
 
 class Settings(object):
@@ -26,25 +44,198 @@ class Settings(object):
         self.DB_URL = f"postgresql+asyncpg://{self.DB_USER}:"f"{self.DB_HOST}@{self.DB_HOST}:{self.DB_PORT}" \
                       f"/{self.DB_NAME}"
 
+        # databases of the ledger (bills, transactions, purchases) as comma separated host:port/name,
+        # users are mapped to them by id. Without shards the ledger is in the global database
+        self.DB_SHARDS = [shard.strip() for shard in environ.get('DB_SHARDS', '').split(',') if shard.strip()]
+        self.DB_SHARD_URLS = [f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASSWORD}@{shard}"
+                              for shard in self.DB_SHARDS]
+
+        # connection pool of every worker and the number of requests a worker lets in at once,
+        # by default as many as the pool can serve without waiting
+        self.DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', 5))
+        self.DB_MAX_OVERFLOW = int(environ.get('DB_MAX_OVERFLOW', 10))
+        self.ADMISSION_MAX_INFLIGHT = int(environ.get('ADMISSION_MAX_INFLIGHT',
+                                                      self.DB_POOL_SIZE + self.DB_MAX_OVERFLOW))
+
+        # circuit breaker of every database: seconds a connection attempt may take, consecutive connection
+        # errors opening the breaker and seconds requests fail at once before a request probes the database
+        self.DB_CONNECT_TIMEOUT = float(environ.get('DB_CONNECT_TIMEOUT', 5))
+        self.DB_BREAKER_THRESHOLD = int(environ.get('DB_BREAKER_THRESHOLD', 5))
+        self.DB_BREAKER_RESET_TIMEOUT = float(environ.get('DB_BREAKER_RESET_TIMEOUT', 5))
+
+        # seconds a request may take unless its route declares ctx_deadline,
+        # the remaining time bounds every statement of the request
+        self.REQUEST_DEADLINE = float(environ.get('REQUEST_DEADLINE', 10))
+
+        # seconds sanic keeps idle connections open, longer than nginx keeps its upstream keepalive
+        # connections (60s) so nginx never reuses a connection the app is closing
+        self.KEEP_ALIVE_TIMEOUT = int(environ.get('KEEP_ALIVE_TIMEOUT', 75))
+
+        # tracing: exporter of the spans (file, memory or none), the file spans are appended to
+        # and the share of requests without a traceparent that are traced
+        self.TRACE_EXPORTER = environ.get('TRACE_EXPORTER', 'file')
+        self.TRACE_FILE = environ.get('TRACE_FILE', join(gettempdir(), 'dimatech-spans.jsonl'))
+        self.TRACE_SAMPLE_RATE = float(environ.get('TRACE_SAMPLE_RATE', 0.01))
+
+        # balance events: events a worker keeps for resuming streams, events a stream may lag behind
+        # before it is closed and seconds between heartbeats of an idle stream
+        self.EVENTS_BUFFER_SIZE = int(environ.get('EVENTS_BUFFER_SIZE', 1000))
+        self.EVENTS_QUEUE_SIZE = int(environ.get('EVENTS_QUEUE_SIZE', 100))
+        self.EVENTS_HEARTBEAT = float(environ.get('EVENTS_HEARTBEAT', 15))
+
+        # ledger partitions: months of partitions created ahead, seconds between checks of a worker,
+        # months kept in the database before archival and directory of the archives of the partitions
+        self.PARTITIONS_AHEAD = int(environ.get('PARTITIONS_AHEAD', 3))
+        self.PARTITIONS_INTERVAL = float(environ.get('PARTITIONS_INTERVAL', 3600))
+        self.ARCHIVE_AFTER_MONTHS = int(environ.get('ARCHIVE_AFTER_MONTHS', 12))
+        self.ARCHIVE_DIR = environ.get('ARCHIVE_DIR', join(dirname(__file__), 'archive'))
+
+        # balance reconciliation: seconds between reconciliations (0 disables them), connections checking
+        # chunks of bills in parallel, bills of a chunk and seconds a transaction may take
+        self.RECONCILE_INTERVAL = float(environ.get('RECONCILE_INTERVAL', 3600))
+        self.RECONCILE_CONNECTIONS = int(environ.get('RECONCILE_CONNECTIONS', 4))
+        self.RECONCILE_CHUNK_SIZE = int(environ.get('RECONCILE_CHUNK_SIZE', 1000))
+        self.RECONCILE_MARGIN = float(environ.get('RECONCILE_MARGIN', 60))
+
+        # health: seconds the result of the readiness database probe is reused and its timeout
+        self.HEALTH_PROBE_TTL = float(environ.get('HEALTH_PROBE_TTL', 1))
+        self.HEALTH_PROBE_TIMEOUT = float(environ.get('HEALTH_PROBE_TIMEOUT', 1))
+
+        # diagnostics: directory of the servers, every server uses a subdirectory named by the pid of its main
+        # process, and the longest profiling in seconds
+        self.DIAGNOSTICS_DIR = environ.get('DIAGNOSTICS_DIR', join(gettempdir(), 'dimatech-diagnostics'))
+        self.PROFILE_MAX_SECONDS = float(environ.get('PROFILE_MAX_SECONDS', 60))
+
+        # catalog reads: Cache-Control max-age, seconds a worker trusts its known catalog version
+        # and url of the nginx micro-cached catalog to refresh after writes. A write forgets the version
+        # in its worker only, the other workers answer the previous ETag for up to CATALOG_VERSION_TTL,
+        # it is capped at CATALOG_MAX_AGE so they are no staler than the clients may already be
+        self.CATALOG_MAX_AGE = int(environ.get('CATALOG_MAX_AGE', 1))
+        self.CATALOG_VERSION_TTL = min(float(environ.get('CATALOG_VERSION_TTL', 1)), self.CATALOG_MAX_AGE)
+        self.CATALOG_PURGE_URL = environ.get('CATALOG_PURGE_URL', '')
+
+        # response compression: minimal body size, size from which bodies are compressed
+        # in the executor, and the compression level
+        self.COMPRESS_MIN_SIZE = int(environ.get('COMPRESS_MIN_SIZE', 1024))
+        self.COMPRESS_EXECUTOR_SIZE = int(environ.get('COMPRESS_EXECUTOR_SIZE', 262144))
+        self.COMPRESS_LEVEL = int(environ.get('COMPRESS_LEVEL', 6))
+
+        # outbox of the ledger events: sink of the dispatchers (http or memory), url the http sink POSTs
+        # the events to (none keeps them in the outbox), events of a batch, seconds between polls of
+        # the drained outboxes, seconds a delivery may take, first and longest delay between attempts
+        # and seconds a dispatcher holds a batch before another one may send it again
+        self.OUTBOX_SINK = environ.get('OUTBOX_SINK', 'http')
+        self.OUTBOX_SINK_URL = environ.get('OUTBOX_SINK_URL', '')
+        self.OUTBOX_BATCH_SIZE = int(environ.get('OUTBOX_BATCH_SIZE', 100))
+        self.OUTBOX_INTERVAL = float(environ.get('OUTBOX_INTERVAL', 1))
+        self.OUTBOX_TIMEOUT = float(environ.get('OUTBOX_TIMEOUT', 5))
+        self.OUTBOX_BACKOFF = float(environ.get('OUTBOX_BACKOFF', 1))
+        self.OUTBOX_MAX_BACKOFF = float(environ.get('OUTBOX_MAX_BACKOFF', 300))
+        self.OUTBOX_LEASE = float(environ.get('OUTBOX_LEASE', 30))
+
+        # bulk user imports: processes of a worker hashing the passwords of the imports, passwords hashed by a task
+        # and rows of a file imported through the API, bigger files are imported with manage.py
+        self.IMPORT_PROCESSES = int(environ.get('IMPORT_PROCESSES', cpu_count() or 1))
+        self.IMPORT_CHUNK_SIZE = int(environ.get('IMPORT_CHUNK_SIZE', 100))
+        self.IMPORT_MAX_ROWS = int(environ.get('IMPORT_MAX_ROWS', 5000))
+
+        # background deletes of users and bills: rows of the ledger deleted by a batch, seconds between
+        # two batches, seconds between polls of the pending deletions and seconds a worker holds a deletion
+        # before another one may resume it
+        self.DELETE_BATCH_SIZE = int(environ.get('DELETE_BATCH_SIZE', 1000))
+        self.DELETE_PAUSE = float(environ.get('DELETE_PAUSE', 0.1))
+        self.DELETE_INTERVAL = float(environ.get('DELETE_INTERVAL', 5))
+        self.DELETE_LEASE = float(environ.get('DELETE_LEASE', 60))
+
         # call setup func
         self.setup_database(app)
         self.setup_jwt(app)
 
     def setup_database(self, app):
-        bind = create_async_engine(self.DB_URL, echo=bool(self.DEBUG))
-
+        """Every worker creates and warms its own engines when it starts and disposes them when it stops,
+        so no pool is created before the workers are forked"""
         _base_model_session_ctx = ContextVar("session")
 
+        @app.listener("before_server_start")
+        async def setup_engine(app, loop):
+            app.ctx.started = monotonic()
+            app.ctx.first_request = None
+            app.ctx.breakers = {}
+            app.ctx.engine = self.create_engine(self.DB_URL, app.ctx.breakers, 'global')
+            app.ctx.session_factory = sessionmaker(app.ctx.engine, AsyncSession, expire_on_commit=False)
+            app.ctx.shard_engines = [self.create_engine(url, app.ctx.breakers, f'shard-{index}')
+                                     for index, url in enumerate(self.DB_SHARD_URLS)]
+            app.ctx.shards = ShardRouter(sessionmaker(engine, AsyncSession, expire_on_commit=False)
+                                         for engine in app.ctx.shard_engines)
+            warm = await asyncio.gather(*(self.warm_up(engine) for engine in [app.ctx.engine, *app.ctx.shard_engines]))
+            app.ctx.warm = all(warm)
+
+        @app.listener("after_server_stop")
+        async def dispose_engine(app, loop):
+            await asyncio.gather(*(engine.dispose() for engine in [app.ctx.engine, *app.ctx.shard_engines]))
+
         @app.middleware("request")
         async def inject_session(request):
-            request.ctx.session = sessionmaker(bind, AsyncSession, expire_on_commit=False)()
+            deadline = getattr(request.route.ctx, "deadline", None) if request.route else None
+            request.ctx.deadline = monotonic() + (deadline or self.REQUEST_DEADLINE)
+            request.ctx.session = request.app.ctx.session_factory()
+            request.ctx.session.info["deadline"] = request.ctx.deadline
             request.ctx.session_ctx_token = _base_model_session_ctx.set(request.ctx.session)
+            request.ctx.shards = ShardSessions(request.app.ctx.shards, request.ctx.session)
+
+            # a request cancelled by a disconnected client never reaches the response middleware,
+            # asyncpg cancels its running query and the sessions are closed when the task ends
+            session, shards = request.ctx.session, request.ctx.shards
+            request.ctx.session_callback = lambda _: asyncio.ensure_future(asyncio.gather(session.close(),
+                                                                                          shards.close()))
+            asyncio.current_task().add_done_callback(request.ctx.session_callback)
 
         @app.middleware("response")
         async def close_session(request, response):
             if hasattr(request.ctx, "session_ctx_token"):
+                asyncio.current_task().remove_done_callback(request.ctx.session_callback)
                 _base_model_session_ctx.reset(request.ctx.session_ctx_token)
-                await request.ctx.session.close()
+                await asyncio.gather(request.ctx.session.close(), request.ctx.shards.close())
+
+            if request.app.ctx.first_request is None:
+                request.app.ctx.first_request = monotonic() - request.app.ctx.started
+                logger.info("Worker %s served its first request %.3fs after start", getpid(),
+                            request.app.ctx.first_request)
+
+    def create_engine(self, url, breakers, name):
+        """Creates the engine of a database guarded by a circuit breaker, registered in breakers by name"""
+        engine = create_async_engine(url, echo=bool(self.DEBUG), pool_size=self.DB_POOL_SIZE,
+                                     max_overflow=self.DB_MAX_OVERFLOW, poolclass=GuardedPool,
+                                     connect_args={'timeout': self.DB_CONNECT_TIMEOUT})
+        tracing.instrument(engine.sync_engine)
+        breakers[name] = CircuitBreaker(name, self.DB_BREAKER_THRESHOLD, self.DB_BREAKER_RESET_TIMEOUT)
+        guard(engine.sync_engine, breakers[name])
+        return engine
+
+    async def warm_up(self, engine):
+        """Opens the connections of the pool so the first requests do not wait for them
+
+        Returns:
+            Whether the database could be reached
+        """
+        async def connect():
+            connection = await engine.connect()
+            await connection.exec_driver_sql("SELECT 1")
+            return connection
+
+        started = monotonic()
+        connections = await asyncio.gather(*(connect() for _ in range(self.DB_POOL_SIZE)), return_exceptions=True)
+        for connection in connections:
+            if not isinstance(connection, BaseException):
+                await connection.close()
+
+        errors = [connection for connection in connections if isinstance(connection, BaseException)]
+        if errors:
+            logger.warning("Worker %s could not warm up the database pool: %r", getpid(), errors[0])
+            return False
+        logger.info("Worker %s warmed up %s database connections in %.3fs", getpid(), self.DB_POOL_SIZE,
+                    monotonic() - started)
+        return True
 
     def setup_jwt(self, app):
         with JWT.initialize(app) as manager:
@@ -0,0 +1,35 @@
+import asyncio
+from os import environ
+from os.path import dirname, exists, join
+
+import pytest
+
+from server import create_app
+from tests.databases import reachable
+
+
+@pytest.fixture(scope='session')
+def app():
+    """The app the handlers under test find with Sanic.get_app(), configured as the server by src/.env"""
+    if not exists(join(dirname(dirname(__file__)), '.env')) and 'DB_HOST' not in environ:
+        pytest.skip('the app is not configured, see src/env.default')
+    return create_app('dimatech_tests')
+
+
+@pytest.fixture(scope='session')
+def database_url(app):
+    """URL of the global database, the tests are skipped when it does not answer"""
+    if not asyncio.run(reachable(app.config.DB_URL)):
+        pytest.skip('the database of DB_HOST is not reachable')
+    return app.config.DB_URL
+
+
+@pytest.fixture(scope='session')
+def shard_urls(app, database_url):
+    """URLs of the shards of DB_SHARDS, the tests are skipped without two reachable shards"""
+    urls = app.config.DB_SHARD_URLS
+    if len(urls) < 2:
+        pytest.skip('DB_SHARDS lists less than two databases')
+    if not all(asyncio.run(reachable(url)) for url in urls):
+        pytest.skip('a database of DB_SHARDS is not reachable')
+    return urls
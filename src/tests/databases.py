@@ -0,0 +1,92 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import asyncpg
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from apps.auth.models import Base as AuthBase
+from apps.dimatech.models import Base
+from apps.dimatech.partitions import ensure_partitions
+from core.helpers.sharding import ShardRouter, ShardSessions
+
+# the tests create their tables in this schema of the configured databases, the tables of the app are not touched,
+# public stays in the search path for the extensions (pg_trgm)
+SCHEMA = 'test_dimatech'
+SEARCH_PATH = {'search_path': f'{SCHEMA}, public'}
+# the ledger tables of a shard refer to users and products of the global database, see migration b8d1f4e6a023
+GLOBAL_FOREIGN_KEYS = """
+SELECT conrelid::regclass::text, conname FROM pg_constraint
+WHERE contype = 'f' AND confrelid IN ('"user"'::regclass, 'product'::regclass)
+"""
+INTERLEAVED_SEQUENCES = ('customer_bill_id_seq', 'transaction_id_seq', 'purchase_id_seq')
+
+
+def asyncpg_url(url: str) -> str:
+    return url.replace('postgresql+asyncpg://', 'postgresql://', 1)
+
+
+async def connect(url: str):
+    """Returns an asyncpg connection to the tables of the tests"""
+    return await asyncpg.connect(asyncpg_url(url), server_settings=SEARCH_PATH, timeout=2)
+
+
+async def reachable(url: str) -> bool:
+    try:
+        connection = await asyncpg.connect(asyncpg_url(url), timeout=2)
+    except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+        return False
+    await connection.close()
+    return True
+
+
+async def create_schema(url: str, shard: int = None, shards: int = 0) -> None:
+    """Creates the tables of the app in SCHEMA again, empty
+
+    A shard keeps no foreign keys to the global tables and draws the ids of the ledger
+    interleaved with the other shards, as migrated with -x shard=i/N.
+    """
+    connection = await asyncpg.connect(asyncpg_url(url), timeout=2)
+    try:
+        await connection.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await connection.execute(f'CREATE SCHEMA {SCHEMA}')
+        await connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    finally:
+        await connection.close()
+
+    engine = create_async_engine(url, connect_args={'server_settings': SEARCH_PATH})
+    try:
+        async with engine.begin() as connection:
+            await connection.run_sync(AuthBase.metadata.create_all)
+            await connection.run_sync(Base.metadata.create_all)
+    finally:
+        await engine.dispose()
+
+    connection = await connect(url)
+    try:
+        if shard is not None:
+            for table, constraint in await connection.fetch(GLOBAL_FOREIGN_KEYS):
+                await connection.execute(f'ALTER TABLE {table} DROP CONSTRAINT {constraint}')
+            for sequence in INTERLEAVED_SEQUENCES:
+                await connection.execute(f'ALTER SEQUENCE {sequence} INCREMENT BY {shards} RESTART WITH {shard + 1}')
+        await ensure_partitions(connection, 0)
+    finally:
+        await connection.close()
+
+
+@asynccontextmanager
+async def sharded_ledger(url: str, shard_urls: list):
+    """Yields the global session and the ShardSessions of a request on empty tables of the databases"""
+    await asyncio.gather(create_schema(url), *(create_schema(shard_url, index, len(shard_urls))
+                                               for index, shard_url in enumerate(shard_urls)))
+    engines = [create_async_engine(database_url, connect_args={'server_settings': SEARCH_PATH})
+               for database_url in [url, *shard_urls]]
+    factories = [sessionmaker(engine, AsyncSession, expire_on_commit=False) for engine in engines]
+    session = factories[0]()
+    shards = ShardSessions(ShardRouter(factories[1:]), session)
+    try:
+        yield session, shards
+    finally:
+        await shards.close()
+        await session.close()
+        await asyncio.gather(*(engine.dispose() for engine in engines))
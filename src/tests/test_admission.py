@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sanic_jwt_extended import JWT
+
+from core.extentions.middlewares import admission_class
+from core.helpers.admission import AdmissionController, Rejected
+
+LISTS = SimpleNamespace(admission_admin='admin', admission_write='purchases')
+
+
+def request(ctx, role=None, method='GET', **args):
+    headers = {'Authorization': f"Bearer {JWT.create_access_token(identity='user', role=role)}"} if role else {}
+    return SimpleNamespace(route=SimpleNamespace(ctx=ctx), method=method, args=args, headers=headers)
+
+
+@pytest.mark.parametrize('role, method, args, expected', [
+    ('Admin', 'GET', {}, 'admin'),
+    ('Admin', 'GET', {'filter[user_id]': '1'}, 'default'),
+    ('Admin', 'GET', {'filter[user_id][in]': '1,2'}, 'admin'),
+    ('User', 'GET', {}, 'default'),
+    (None, 'GET', {}, 'default'),
+    ('Admin', 'POST', {}, 'purchases'),
+    ('User', 'POST', {}, 'purchases'),
+])
+def test_admin_class_only_for_fan_out_reads(app, role, method, args, expected):
+    assert admission_class(request(LISTS, role, method, **args)) == expected
+
+
+def test_invalid_token_keeps_the_route_class(app):
+    forged = SimpleNamespace(route=SimpleNamespace(ctx=LISTS), method='GET', args={},
+                             headers={'Authorization': 'Bearer not.a.token'})
+    assert admission_class(forged) == 'default'
+
+
+def test_declared_classes(app):
+    catalog = SimpleNamespace(admission='catalog', admission_write='admin')
+    assert admission_class(request(catalog, 'Admin')) == 'catalog'
+    assert admission_class(request(catalog, 'Admin', 'PATCH')) == 'admin'
+
+
+def test_queued_counts_the_waiting_requests():
+    async def scenario():
+        controller = AdmissionController(1, {'default': (0, 0.05), 'admin': (1, 5)})
+        ticket = await controller.acquire('default')
+        waiters = [asyncio.create_task(controller.acquire(name)) for name in ('default', 'admin', 'admin')]
+        await asyncio.sleep(0)
+        assert controller.queued == 3
+
+        with pytest.raises(Rejected):
+            await waiters[0]
+        assert controller.queued == 2
+        waiters[1].cancel()
+        await asyncio.gather(waiters[1], return_exceptions=True)
+        assert controller.queued == 1
+
+        ticket.release()
+        (await waiters[2]).release()
+        assert (controller.queued, controller.inflight) == (0, 0)
+
+    asyncio.run(scenario())
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from core.helpers import http
+
+LENGTH = b'HTTP/1.1 201 Created\r\nContent-Length: 2\r\n\r\nok and more'
+CLOSED = b'HTTP/1.0 200 OK\r\n\r\nuntil the end'
+EMPTY = b'HTTP/1.1 204 No Content\r\n\r\n'
+TRUNCATED = b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort'
+
+
+async def serve(response):
+    """Starts a server answering every connection with response, then closing it
+
+    Returns:
+        The server, its url and the list of requests it received
+    """
+    requests = []
+
+    async def handle(reader, writer):
+        request = await reader.readuntil(b'\r\n\r\n')
+        length = int(next((line.split(b':')[1] for line in request.split(b'\r\n')
+                           if line.lower().startswith(b'content-length')), 0))
+        requests.append(request + await reader.readexactly(length))
+        writer.write(response)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}/path?q=1', requests
+
+
+def fetch(response, *args):
+    async def scenario():
+        server, url, requests = await serve(response)
+        try:
+            return await http.fetch(url, *args), requests
+        finally:
+            server.close()
+
+    return asyncio.run(scenario())
+
+
+def test_one_request_per_connection():
+    (status, headers, body), requests = fetch(LENGTH, 'POST', {'X-Test': '1'}, b'{}')
+    assert (status, headers, body) == (201, {'content-length': '2'}, b'ok')
+    assert requests[0].startswith(b'POST /path?q=1 HTTP/1.0\r\n') and requests[0].endswith(b'\r\n\r\n{}')
+    assert b'Connection: close\r\n' in requests[0] and b'X-Test: 1\r\n' in requests[0]
+
+
+def test_body_without_length_ends_with_the_connection():
+    assert fetch(CLOSED)[0] == (200, {}, b'until the end')
+
+
+def test_bodiless_responses():
+    assert fetch(EMPTY)[0] == (204, {}, b'')
+    assert fetch(LENGTH, 'HEAD')[0] == (201, {'content-length': '2'}, b'')
+
+
+def test_truncated_body_is_a_connection_error():
+    with pytest.raises(ConnectionResetError):
+        fetch(TRUNCATED)
@@ -0,0 +1,121 @@
+import asyncio
+import json
+from uuid import uuid4
+
+from apps.dimatech.outbox import MemorySink, SinkError, dispatch_batch, dispatch_outbox
+from tests.databases import SCHEMA, asyncpg_url, connect, create_schema
+
+INSERT_EVENT = "INSERT INTO outbox (event_id, topic, payload) VALUES ($1, 'transaction.created', $2::jsonb)"
+
+
+class FailingSink(object):
+    async def send(self, events):
+        raise SinkError('Sink answered 503')
+
+
+class BuggySink(MemorySink):
+    """Fails once with an error the dispatcher does not expect"""
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    async def send(self, events):
+        if not self.failed:
+            self.failed = True
+            raise RuntimeError('bug')
+        await super().send(events)
+
+
+class RacingSink(MemorySink):
+    """Dispatches again from another connection while a batch is sent"""
+
+    def __init__(self, connection, other):
+        super().__init__()
+        self.connection = connection
+        self.other = other
+        self.in_transaction = None
+        self.delivered_by_other = None
+
+    async def send(self, events):
+        self.in_transaction = self.connection.is_in_transaction()
+        self.delivered_by_other = await dispatch_batch(self.other, MemorySink(), 10, 1, 300)
+        await super().send(events)
+
+
+async def outbox(database_url: str, count: int):
+    """Returns a connection to the tables of the tests with count events in the outbox"""
+    await create_schema(database_url)
+    connection = await connect(database_url)
+    for index in range(count):
+        await connection.execute(INSERT_EVENT, uuid4(), json.dumps({'index': index}))
+    return connection
+
+
+def test_dispatch_delivers_in_order_and_deletes(database_url):
+    async def scenario():
+        connection = await outbox(database_url, 3)
+        try:
+            sink = MemorySink()
+            assert await dispatch_batch(connection, sink, 2, 1, 300) == 2
+            assert await dispatch_batch(connection, sink, 2, 1, 300) == 1
+            assert await dispatch_batch(connection, sink, 2, 1, 300) == 0
+            assert [event['data']['index'] for event in sink.events] == [0, 1, 2]
+            assert await connection.fetchval('SELECT count(*) FROM outbox') == 0
+        finally:
+            await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_batch_is_delayed(database_url):
+    async def scenario():
+        connection = await outbox(database_url, 2)
+        try:
+            assert await dispatch_batch(connection, FailingSink(), 10, 1, 300) == 0
+            rows = await connection.fetch('SELECT attempts, last_error, available_at > now() AS delayed FROM outbox')
+            assert [(row['attempts'], row['delayed']) for row in rows] == [(1, True), (1, True)]
+            assert all('503' in row['last_error'] for row in rows)
+            assert await dispatch_batch(connection, MemorySink(), 10, 1, 300) == 0
+        finally:
+            await connection.close()
+
+    asyncio.run(scenario())
+
+
+def test_batch_is_leased_while_sent(database_url):
+    async def scenario():
+        connection = await outbox(database_url, 2)
+        other = await connect(database_url)
+        try:
+            sink = RacingSink(connection, other)
+            assert await dispatch_batch(connection, sink, 10, 1, 300) == 2
+            # no transaction is held over the send and the leased events are not claimed twice
+            assert sink.in_transaction is False
+            assert sink.delivered_by_other == 0
+            assert len(sink.events) == 2
+        finally:
+            await asyncio.gather(connection.close(), other.close())
+
+    asyncio.run(scenario())
+
+
+def test_dispatcher_survives_unexpected_errors(database_url):
+    async def scenario():
+        connection = await outbox(database_url, 2)
+        sink = BuggySink()
+        url = f'{asyncpg_url(database_url)}?search_path={SCHEMA}'
+        dispatcher = asyncio.ensure_future(dispatch_outbox([url], sink, 10, 0.01, 0.01, 300, lease=0.1))
+        try:
+            for _ in range(200):
+                if len(sink.events) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            assert sink.failed and len(sink.events) == 2
+        finally:
+            dispatcher.cancel()
+            await asyncio.gather(dispatcher, return_exceptions=True)
+            await connection.close()
+        assert dispatcher.cancelled()
+
+    asyncio.run(scenario())
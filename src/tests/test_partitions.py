@@ -0,0 +1,44 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from apps.dimatech.views import TransactionAPI, CustomerBillAPI
+from core.extentions.exceptions import ArchivedRange
+
+SINCE = datetime(2025, 3, 1, tzinfo=timezone.utc)
+
+
+def request(months, **args):
+    async def gather(function):
+        return months
+
+    return SimpleNamespace(args=args, ctx=SimpleNamespace(shards=SimpleNamespace(gather=gather)))
+
+
+@pytest.mark.parametrize('args', [
+    {},
+    {'filter[created_at][gte]': '2025-03-01'},
+    {'filter[created_at][lte]': '2025-04-10T00:00:00+00:00'},
+    {'filter[created_at][gte]': 'not a date'},
+])
+def test_ranges_of_attached_months_are_read(args):
+    asyncio.run(TransactionAPI().check_archived(request([SINCE, None], **args)))
+
+
+@pytest.mark.parametrize('args, month', [
+    ({'filter[created_at][gte]': '2025-02-14', 'filter[created_at][lte]': '2025-05-01'}, '2025-02'),
+    ({'filter[created_at][lte]': '2024-12-31'}, '2024-12'),
+    ({'filter[created_at][gte]': '2025-03-01T01:00:00+02:00'}, '2025-02'),
+])
+def test_ranges_of_archived_months_are_refused(args, month):
+    with pytest.raises(ArchivedRange) as refused:
+        asyncio.run(TransactionAPI().check_archived(request([None, SINCE], **args)))
+    assert (refused.value.table, f'{refused.value.month:%Y-%m}') == ('transaction', month)
+
+
+def test_nothing_archived_or_not_partitioned():
+    args = {'filter[created_at][gte]': '2020-01-01'}
+    asyncio.run(TransactionAPI().check_archived(request([None], **args)))
+    asyncio.run(CustomerBillAPI().check_archived(request([SINCE], **args)))
@@ -0,0 +1,134 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from Crypto.Hash import SHA1
+from sanic.request import RequestParameters
+from sqlalchemy import select, func
+
+from apps.auth.models import User
+from apps.dimatech.models import CustomerBillModel, DeletionModel, OutboxModel, TransactionModel
+from apps.dimatech.validators import TransactionWebhookValidator
+from apps.dimatech.views import BaseAPI, CustomerBillAPI, CustomerBillDetailAPI, TransactionAPI
+from apps.payment.views import transaction_webhook
+from core.helpers.sharding import jump_hash
+from tests.databases import sharded_ledger
+
+USERS = 20
+
+
+async def create_users(session, count: int) -> list:
+    async with session.begin():
+        users = [User(username=f'user{index}', password_hash=b'', salt=b'') for index in range(count)]
+        session.add_all(users)
+    return [user.id for user in users]
+
+
+async def create_bills(shards, user_ids: list) -> list:
+    bill_ids = []
+    for user_id in user_ids:
+        ledger = shards.for_user(user_id)
+        async with ledger.begin():
+            bill = CustomerBillModel(user_id=user_id, balance=100)
+            ledger.add(bill)
+        bill_ids.append(bill.id)
+    return bill_ids
+
+
+def stub_request(session, shards, **args):
+    return SimpleNamespace(args=RequestParameters({name: [value] for name, value in args.items()}),
+                           ctx=SimpleNamespace(session=session, shards=shards))
+
+
+def test_routing_follows_jump_hash(database_url, shard_urls):
+    async def scenario():
+        async with sharded_ledger(database_url, shard_urls) as (session, shards):
+            user_ids = await create_users(session, USERS)
+            owners = {user_id: jump_hash(user_id, len(shard_urls)) for user_id in user_ids}
+            assert len(set(owners.values())) > 1
+
+            for user_id, owner in owners.items():
+                assert shards.for_user(user_id) is shards.get(owner)
+            await create_bills(shards, user_ids)
+
+            for index in range(len(shard_urls)):
+                ledger = shards.get(index)
+                rows = (await ledger.execute(select(CustomerBillModel.user_id))).scalars().all()
+                await ledger.rollback()
+                assert sorted(rows) == sorted(user_id for user_id, owner in owners.items() if owner == index)
+
+    asyncio.run(scenario())
+
+
+def test_admin_fan_out_merges_by_id(database_url, shard_urls):
+    async def scenario():
+        async with sharded_ledger(database_url, shard_urls) as (session, shards):
+            user_ids = await create_users(session, USERS)
+            bill_ids = await create_bills(shards, user_ids)
+            usernames = dict(zip(user_ids, (f'user{index}' for index in range(USERS))))
+
+            admin = SimpleNamespace(role='Admin', identity='admin')
+            bills = await BaseAPI.get(CustomerBillAPI(), stub_request(session, shards), token=admin)
+            assert [bill['id'] for bill in bills] == sorted(bill_ids)
+            assert all(bill['username'] == usernames[bill['user_id']] for bill in bills)
+
+            bills = await BaseAPI.get(CustomerBillAPI(), stub_request(session, shards, sort='-id'), token=admin)
+            assert [bill['id'] for bill in bills] == sorted(bill_ids, reverse=True)
+
+    asyncio.run(scenario())
+
+
+def test_webhook_writes_to_owning_shard(app, database_url, shard_urls):
+    async def scenario():
+        async with sharded_ledger(database_url, shard_urls) as (session, shards):
+            user_id = (await create_users(session, 1))[0]
+            owner = jump_hash(user_id, len(shard_urls))
+
+            data = {'transaction_id': 1, 'user_id': user_id, 'bill_id': 10 ** 6, 'amount': '10.5'}
+            data['signature'] = SHA1.new(f"{app.config.SIGNING_KEY}:1:{user_id}:{10 ** 6}:10.5".encode()).hexdigest()
+            request = SimpleNamespace(json=data, ctx=SimpleNamespace(session=session, shards=shards))
+            response = await transaction_webhook.__wrapped__(request, body=TransactionWebhookValidator(**data))
+            assert response.status == 201
+            bill_id = json.loads(response.body)['bill_id']
+            assert bill_id != 10 ** 6
+
+            for index in range(len(shard_urls)):
+                ledger = shards.get(index)
+                bills = (await ledger.execute(select(CustomerBillModel.id, CustomerBillModel.balance))).all()
+                transactions = (await ledger.execute(
+                    select(TransactionModel.bill_id, TransactionModel.amount))).all()
+                events = (await ledger.execute(select(OutboxModel.topic))).scalars().all()
+                await ledger.rollback()
+                if index == owner:
+                    assert bills == [(bill_id, 1050)]
+                    assert transactions == [(bill_id, 1050)]
+                    assert events == ['transaction.created']
+                else:
+                    assert bills == transactions == events == []
+
+    asyncio.run(scenario())
+
+
+def test_deleted_bill_is_hidden_and_scheduled_once(database_url, shard_urls):
+    async def scenario():
+        async with sharded_ledger(database_url, shard_urls) as (session, shards):
+            user_ids = await create_users(session, 2)
+            bill_ids = await create_bills(shards, user_ids)
+            for user_id, bill_id in zip(user_ids, bill_ids):
+                ledger = shards.for_user(user_id)
+                async with ledger.begin():
+                    ledger.add(TransactionModel(user_id=user_id, bill_id=bill_id, amount=100))
+
+            request = stub_request(session, shards)
+            response = await CustomerBillDetailAPI.delete.__wrapped__(CustomerBillDetailAPI(), request, bill_ids[0])
+            assert response.status == 202
+            again = await CustomerBillDetailAPI.delete.__wrapped__(CustomerBillDetailAPI(), request, bill_ids[0])
+            assert (again.status, again.headers['Location']) == (202, response.headers['Location'])
+            assert (await session.execute(select(func.count(DeletionModel.id)))).scalar() == 1
+            await session.rollback()
+
+            admin = SimpleNamespace(role='Admin', identity='admin')
+            transactions = await BaseAPI.get(TransactionAPI(), stub_request(session, shards), token=admin)
+            assert [transaction['bill_id'] for transaction in transactions] == bill_ids[1:]
+
+    asyncio.run(scenario())
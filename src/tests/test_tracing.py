@@ -0,0 +1,57 @@
+from contextvars import copy_context
+
+import pytest
+
+from core.helpers.tracing import MemoryExporter, Tracer, current_span, parse_traceparent
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+def trace(tracer, traceparent=None, fail=False):
+    """Runs a request with a child span in a context of its own"""
+    def request():
+        root = tracer.start_trace('GET products', traceparent)
+        current_span.set(root)
+        try:
+            with tracer.span('db.statement', 'client'):
+                if fail:
+                    raise ValueError('broken')
+        except ValueError:
+            pass
+        tracer.end(root, **{'http.status_code': 200})
+        return root
+
+    return copy_context().run(request)
+
+
+def test_parse_traceparent():
+    assert parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}-01') == (TRACE_ID, PARENT_ID, True)
+    assert parse_traceparent(f' 00-{TRACE_ID.upper()}-{PARENT_ID}-00 ') == (TRACE_ID, PARENT_ID, False)
+    assert parse_traceparent(f'00-{"0" * 32}-{PARENT_ID}-01') is None
+    assert parse_traceparent(f'00-{TRACE_ID}-{PARENT_ID}') is None
+
+
+def test_sampled_trace_is_exported():
+    exporter = MemoryExporter()
+    root = trace(Tracer(exporter, sample_rate=1.0))
+    child, exported_root = exporter.spans
+    assert exported_root is root and root.attributes == {'http.status_code': 200}
+    assert (child.name, child.kind, child.trace_id, child.parent_id) == ('db.statement', 'client', root.trace_id,
+                                                                         root.span_id)
+    assert child.end is not None and child.status == 'ok'
+
+
+@pytest.mark.parametrize('flags, exported', [('01', 2), ('00', 0)])
+def test_traceparent_decides_sampling(flags, exported):
+    exporter = MemoryExporter()
+    root = trace(Tracer(exporter, sample_rate=0.0), f'00-{TRACE_ID}-{PARENT_ID}-{flags}')
+    assert (root.trace_id, root.parent_id) == (TRACE_ID, PARENT_ID)
+    assert len(exporter.spans) == exported
+
+
+def test_failed_span_records_error():
+    exporter = MemoryExporter()
+    trace(Tracer(exporter, sample_rate=1.0), fail=True)
+    child = exporter.spans[0]
+    assert child.status == 'error' and child.attributes['error'] == "ValueError('broken')"